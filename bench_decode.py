@@ -0,0 +1,72 @@
+import json
+import logging
+import os
+import sys
+import time
+
+from urllib import parse
+from xml.etree import ElementTree
+
+from http_utils import decode_post_json, decode_post_xml, decode_post_xml_generic, html_msg_to_dict
+
+# Decode cost per POST body, the parsers in http_utils vs the eval() path they replaced,
+# and per WeChat XML message, the regex fast path vs ElementTree
+#   python bench_decode.py [N]
+
+log = logging.getLogger(__name__)
+
+WECHAT_TEXT_XML = ("<xml><ToUserName><![CDATA[gh_123456789abc]]></ToUserName><FromUserName><![CDATA[o_user_0001]]></FromUserName>"
+                   "<CreateTime>1600000000</CreateTime><MsgType><![CDATA[text]]></MsgType><Content><![CDATA[你好，我想买东西]]></Content>"
+                   "<MsgId>1234567890123456</MsgId></xml>")
+WECHAT_EVENT_XML = ("<xml>\n<ToUserName><![CDATA[gh_123456789abc]]></ToUserName>\n<FromUserName><![CDATA[o_user_0001]]></FromUserName>\n"
+                    "<CreateTime>1600000000</CreateTime>\n<MsgType><![CDATA[event]]></MsgType>\n<Event><![CDATA[CLICK]]></Event>\n"
+                    "<EventKey><![CDATA[]]></EventKey>\n</xml>")
+
+# The old decoder, copied here to compare against. Runs the body as Python: never use it on real requests
+def eval_decode_post_json(data_string):
+    return eval(data_string)
+
+def run_benchmark(n = 2000):
+    event = {"ToUserName": "gh_123456789abc", "FromUserName": "o_user_0001", "CreateTime": 1600000000,
+             "MsgType": "event", "Event": "subscribe", "EventKey": ""}
+    small = json.dumps(event)
+    big = json.dumps(dict(event, Items=[dict(event, Idx=i) for i in range(300)]))
+    form = "userID=user_0001&message=" + parse.quote("你好，我想买东西") + "&msg_type=raw"
+    cases = [("small json", small, decode_post_json, eval_decode_post_json),
+             ("big json ({}KB)".format(len(big) // 1024), big, decode_post_json, eval_decode_post_json),
+             ("form", form, html_msg_to_dict, None)]
+    for name, body, fast, slow in cases:
+        line = "{:<16}".format(name)
+        for label, fn in (("parser", fast), ("eval", slow)):
+            if fn is None:
+                continue # The old form decoder could not url-decode so there is nothing fair to compare
+            start = time.perf_counter()
+            for i in range(n):
+                fn(body)
+            line += " | {} {:8.1f}us".format(label, (time.perf_counter() - start) / n * 1e6)
+        print(line)
+
+# The XML decoder before the fast path: ElementTree, with the root and the dict formatted into INFO logs
+def old_decode_post_xml(xml_data_string):
+    root = ElementTree.fromstring(xml_data_string)
+    log.info("XML root object: {}".format(root))
+    data_d = {n.tag: n.text for n in root.iter()}
+    log.info("XML decoded data: {}".format(data_d))
+    return data_d
+
+# Per message decode cost, before vs ElementTree alone vs the fast path. Logs go to /dev/null at INFO like a server's would
+def run_xml_benchmark(n = 20000):
+    logging.basicConfig(level=logging.INFO, stream=open(os.devnull, "w"))
+    for name, body in (("text message", WECHAT_TEXT_XML), ("click event", WECHAT_EVENT_XML)):
+        line = "{:<16}".format(name)
+        for label, fn in (("before", old_decode_post_xml), ("parser", decode_post_xml_generic), ("fast", decode_post_xml)):
+            start = time.perf_counter()
+            for i in range(n):
+                fn(body)
+            line += " | {} {:6.2f}us".format(label, (time.perf_counter() - start) / n * 1e6)
+        print(line)
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    run_benchmark(n)
+    run_xml_benchmark(n * 10)
@@ -0,0 +1,231 @@
+# Append only journal of chat snapshots, so conversations survive restarts
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+DEFAULT_JOURNAL_FILENAME = "sessions.journal"
+COMPACT_MIN_BYTES = 4 * 1024 * 1024 # Don't bother compacting small journals
+COMPACT_RATIO = 4 # Compact once the file is this many times bigger than the live records
+DEFAULT_RETENTION = 30 * 24 * 60 * 60 # Seconds. A chat not written for this long is forgotten
+EXPIRE_INTERVAL = 60 * 60 # Seconds between looks for expired chats
+
+RECORD_PREFIX = b'{"u":'
+TIME_MARK = b',"t":'
+SNAPSHOT_MARK = b',"s":'
+DELETED = b"null" # Snapshot of a deleted chat
+
+# Every turn appends one line: {"u": chatID, "t": unix time, "s": ChatManager snapshot}
+# The latest line of a user wins. Turns that do not change the snapshot are not written.
+# On startup only the user IDs are read to build an index of where each user's latest line is.
+# The snapshot itself is read when that user sends their first message (load), so startup stays fast.
+# A line cut off by a crash is ignored. Lines from before "t" was added count as written at startup.
+# Chats not written for retention seconds are never loaded again. They are dropped from the index (when the journal is opened,
+# by expire, or when asked for) and from the file at the next compaction.
+# A deleted chat gets a line with a null snapshot, so it stays deleted after a restart.
+class SessionJournal:
+    METRIC_COUNTERS = ("appends", "skipped", "replays", "compactions", "expired", "deleted") # Keys of get_metrics that only go up
+
+    def __init__(self, filepath = None, fsync = False, retention = DEFAULT_RETENTION):
+        self.filepath = filepath or os.path.join(os.getcwd(), DEFAULT_JOURNAL_FILENAME)
+        self.fsync = fsync # Flushing survives a crash of the process. fsync also survives a crash of the machine
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.index = {} # chatID -> (offset, length, time written) of the latest line
+        self.checksums = {} # chatID -> crc32 of the latest snapshot. To skip unchanged turns. Only kept while the chat is in memory
+        self.live_bytes = 0
+        self.last_expire = time.time()
+        self.metrics = {"appends": 0, "skipped": 0, "replays": 0, "compactions": 0, "expired": 0, "deleted": 0}
+        self._build_index()
+        self.fp = open(self.filepath, "ab")
+
+    @staticmethod
+    def _encode_record(chatID, snapshot, written):
+        uid = json.dumps(chatID, ensure_ascii=False).encode("utf-8")
+        return RECORD_PREFIX + uid + TIME_MARK + str(int(written)).encode("ascii") + SNAPSHOT_MARK + snapshot + b"}\n"
+
+    # Returns (chatID, time written or None, snapshot bytes) of one line or None if the line is broken
+    @staticmethod
+    def _decode_record(line):
+        if not line.startswith(RECORD_PREFIX) or not line.endswith(b"}\n"):
+            return None
+        try:
+            text = line.decode("utf-8")
+            chatID, end = json.JSONDecoder().raw_decode(text, len(RECORD_PREFIX))
+        except ValueError:
+            return None
+        rest = text[end:].encode("utf-8")
+        written = None
+        if rest.startswith(TIME_MARK):
+            end = rest.find(SNAPSHOT_MARK)
+            if end < 0 or not rest[len(TIME_MARK):end].isdigit():
+                return None
+            written = int(rest[len(TIME_MARK):end])
+            rest = rest[end:]
+        if not rest.startswith(SNAPSHOT_MARK):
+            return None
+        return chatID, written, rest[len(SNAPSHOT_MARK):-2]
+
+    def _build_index(self):
+        if not os.path.isfile(self.filepath):
+            return
+        good_end = 0
+        now = time.time()
+        cutoff = now - self.retention
+        with open(self.filepath, "rb") as f:
+            offset = 0
+            for line in f:
+                record = self._decode_record(line)
+                if record is None:
+                    log.warning("<SESSION JOURNAL> Skipping broken line at byte %s", offset)
+                else:
+                    chatID, written, snapshot = record
+                    if snapshot == DELETED or (written is not None and written < cutoff):
+                        self._drop_index(chatID) # Expired before this start, left out like a deleted chat
+                    else:
+                        self._set_index(chatID, offset, len(line), now if written is None else written)
+                    good_end = offset + len(line)
+                offset += len(line)
+
+        if good_end < offset:
+            # Cut off the torn tail so new lines start on a fresh line
+            with open(self.filepath, "r+b") as f:
+                f.truncate(good_end)
+        log.info("<SESSION JOURNAL> Indexed %s chats from %s", len(self.index), self.filepath)
+
+    def _set_index(self, chatID, offset, length, written):
+        self._drop_index(chatID)
+        self.index[chatID] = (offset, length, written)
+        self.live_bytes += length
+
+    def _drop_index(self, chatID):
+        old = self.index.pop(chatID, None)
+        if old is not None:
+            self.live_bytes -= old[1]
+        self.checksums.pop(chatID, None)
+
+    # Call with self.lock held
+    def _write(self, record):
+        offset = self.fp.tell()
+        self.fp.write(record)
+        self.fp.flush()
+        if self.fsync:
+            os.fsync(self.fp.fileno())
+        return offset
+
+    def append(self, chatID, snapshot):
+        checksum = zlib.crc32(snapshot)
+        with self.lock:
+            if self.checksums.get(chatID) == checksum:
+                self.metrics["skipped"] += 1
+                return
+            now = time.time()
+            record = self._encode_record(chatID, snapshot, now)
+            offset = self._write(record)
+            self._set_index(chatID, offset, len(record), now)
+            self.checksums[chatID] = checksum
+            self.metrics["appends"] += 1
+
+    # The chat left memory. Its next turn is written even if nothing changed, the checksum is not worth keeping for every chat
+    def release(self, chatID):
+        with self.lock:
+            self.checksums.pop(chatID, None)
+
+    def delete(self, chatID):
+        with self.lock:
+            if not chatID in self.index:
+                return
+            self._write(self._encode_record(chatID, DELETED, time.time()))
+            self._drop_index(chatID)
+            self.metrics["deleted"] += 1
+
+    # Forgets the chats not written for self.retention seconds. Their lines go at the next compaction
+    def expire(self, now = None):
+        now = now or time.time()
+        with self.lock:
+            self.last_expire = now
+            cutoff = now - self.retention
+            expired = [chatID for chatID, (offset, length, written) in self.index.items() if written < cutoff]
+            for chatID in expired:
+                self._drop_index(chatID)
+            self.metrics["expired"] += len(expired)
+        if expired:
+            log.info("<SESSION JOURNAL> Expired %s chats", len(expired))
+        return len(expired)
+
+    # Returns the latest snapshot of chatID or None
+    def load(self, chatID):
+        with self.lock:
+            location = self.index.get(chatID)
+            if location is None:
+                return None
+            offset, length, written = location
+            if written < time.time() - self.retention:
+                # Past retention but the next expire pass has not come yet. It must not come back to life meanwhile
+                self._drop_index(chatID)
+                self.metrics["expired"] += 1
+                return None
+            with open(self.filepath, "rb") as f:
+                f.seek(offset)
+                line = f.read(length)
+            self.metrics["replays"] += 1
+
+        record = self._decode_record(line)
+        if record is None:
+            log.error("<SESSION JOURNAL> Broken line for %s", chatID)
+            return None
+        return record[2]
+
+    def __contains__(self, chatID):
+        with self.lock:
+            return chatID in self.index
+
+    # Rewrites the journal with only the latest line of each chat. Deleted and expired chats are left out
+    def compact(self):
+        with self.lock:
+            tmp_path = self.filepath + ".compact"
+            new_index = {}
+            self.fp.flush()
+            with open(self.filepath, "rb") as src, open(tmp_path, "wb") as dst:
+                for chatID, (offset, length, written) in self.index.items():
+                    src.seek(offset)
+                    line = src.read(length)
+                    new_index[chatID] = (dst.tell(), length, written)
+                    dst.write(line)
+                dst.flush()
+                os.fsync(dst.fileno())
+            self.fp.close()
+            os.replace(tmp_path, self.filepath)
+            self.fp = open(self.filepath, "ab")
+            self.index = new_index
+            self.live_bytes = sum(entry[1] for entry in new_index.values())
+            self.metrics["compactions"] += 1
+            log.info("<SESSION JOURNAL> Compacted to %s bytes", self.live_bytes)
+
+    # Called by the backup timer. Also looks for expired chats every EXPIRE_INTERVAL
+    def maybe_compact(self):
+        if time.time() - self.last_expire > EXPIRE_INTERVAL:
+            self.expire()
+        with self.lock:
+            if self.fp.closed:
+                return
+            size = self.fp.tell()
+            needed = size > COMPACT_MIN_BYTES and size > COMPACT_RATIO * self.live_bytes
+        if needed:
+            self.compact()
+
+    def get_metrics(self):
+        with self.lock:
+            out = self.metrics.copy()
+            out["chats"] = len(self.index)
+            out["live_bytes"] = self.live_bytes
+            out["file_bytes"] = self.fp.tell()
+            return out
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
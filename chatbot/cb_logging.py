@@ -0,0 +1,97 @@
+# Logging for the servers, off the request threads.
+# A request thread only puts the LogRecord on a queue. A background thread (QueueListener) formats it and writes it out,
+# so a slow terminal or docker log pipe never holds up a turn.
+# Messages are formatted when written, so log with arguments instead of formatting first:
+#   log.info("Reply for %s: %s", uid, text)      not      log.info("Reply for {}: {}".format(uid, text))
+# and a message below its logger's level costs one level check.
+# Arguments that are dicts or lists (like a chat's info) can change before the writer gets to them, so those messages are formatted right away.
+import logging
+import queue
+import sys
+
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+LOG_QUEUE_SIZE = 10000 # Records waiting for the writer. When full new records are dropped, the request does not wait
+
+# Per module levels for the servers. Logger names are module names (logging.getLogger(__name__)), a package name covers its modules
+SERVER_LOG_LEVELS = {
+    "chatbot": logging.WARNING, # Per turn state dumps, see ChatManager.respond_to_message. Set to DEBUG to follow a conversation
+    "http_utils": logging.WARNING, # Every decoded body
+    "http_server.access": logging.WARNING, # One line per request
+}
+
+class LazyQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # QueueHandler formats the message here, on the calling thread. Leave that to the writer unless the arguments can change
+    def prepare(self, record):
+        args = record.args
+        if args and (isinstance(args, dict) or any(isinstance(a, (dict, list, set)) for a in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_listener = None
+_handler = None
+_logger_handlers = [] # (logger name, handler) from add_logger_handler
+
+# Also writes what logger_name (or a child of it) logs with handler, e.g. to a file of its own.
+# Once setup_logging has run the background writer does it, until then the handler sits on the logger
+def add_logger_handler(logger_name, handler):
+    handler.addFilter(logging.Filter(logger_name))
+    _logger_handlers.append((logger_name, handler))
+    if _listener is None:
+        logging.getLogger(logger_name).addHandler(handler)
+    else:
+        _listener.handlers = _listener.handlers + (handler,)
+
+# Sends everything logged in the process through one queue to handlers (stderr by default).
+# levels: {logger name: level}, e.g. SERVER_LOG_LEVELS. Calling it again replaces the previous setup
+def setup_logging(level = logging.INFO, levels = None, handlers = None, queue_size = LOG_QUEUE_SIZE, fmt = LOG_FORMAT):
+    global _listener, _handler
+    stop_logging()
+    if handlers is None:
+        handlers = [logging.StreamHandler(sys.stderr)]
+    for handler in handlers:
+        if handler.formatter is None:
+            handler.setFormatter(logging.Formatter(fmt))
+
+    _handler = LazyQueueHandler(queue.Queue(queue_size))
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    for name, module_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    for logger_name, handler in _logger_handlers:
+        logging.getLogger(logger_name).removeHandler(handler)
+        handlers = list(handlers) + [handler]
+
+    _listener = QueueListener(_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+# Writes out what is still queued
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+LOGGING_METRIC_COUNTERS = ("dropped",) # Keys of get_logging_metrics that only go up
+
+def get_logging_metrics():
+    if _handler is None:
+        return {}
+    return {"queued": _handler.queue.qsize(), "dropped": _handler.dropped}
@@ -0,0 +1,129 @@
+# Where the time of a turn goes, in Prometheus' text format
+import re
+import threading
+
+from bisect import bisect_left
+
+# Seconds. Turns take a few ms, a slow SQL lookup or pay request can take seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+METRIC_PREFIX = "chatbot_"
+UNSAFE_NAME_RE = re.compile(r"[^A-Za-z0-9_]")
+
+# Counts of observations per bucket, like a Prometheus histogram. Buckets are cumulative only when rendered
+class Histogram:
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+# Stage timings, counters, and the get_metrics() of other parts of the server.
+# Meant to be cheap enough to leave on: a stage is timed with two perf_counter() calls and one observe()
+#   start = time.perf_counter()
+#   ... stage ...
+#   METRICS.observe("fetch_reply", time.perf_counter() - start)
+class MetricsRegistry:
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.stages = {} # stage -> Histogram
+        self.counters = {} # name -> int
+        self.collectors = {} # name -> (fn() returning a dict of numbers (nested dicts are flattened), keys that are counters)
+        self.local = threading.local() # The trace of the thread's current turn, see start_trace
+
+    def observe(self, stage, seconds):
+        i = bisect_left(self.buckets, seconds)
+        with self.lock:
+            hist = self.stages.get(stage)
+            if hist is None:
+                hist = Histogram(self.buckets)
+                self.stages[stage] = hist
+            hist.counts[i] += 1
+            hist.sum += seconds
+            hist.count += 1
+        trace = getattr(self.local, "trace", None)
+        if trace is not None:
+            trace[stage] = trace.get(stage, 0.0) + seconds
+
+    # Also keeps the stages this thread observes from now on, until stop_trace() returns them as {stage: seconds}.
+    # For looking at one turn, e.g. a captured request (http_capture.py)
+    def start_trace(self):
+        self.local.trace = {}
+
+    def stop_trace(self):
+        trace = getattr(self.local, "trace", None)
+        self.local.trace = None
+        return trace or {}
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    # fn is called every time the metrics are rendered, e.g. AdmissionControl.get_metrics.
+    # counters: the keys of fn's dict that only go up (nested keys joined with "_"). They are exported as counters
+    # named <name>_<key>_total, the rest as gauges
+    def add_collector(self, name, fn, counters = ()):
+        with self.lock:
+            self.collectors[name] = (fn, frozenset(counters))
+
+    def get_counters(self):
+        with self.lock:
+            return self.counters.copy()
+
+    # Returns {stage: (count, sum)}
+    def get_stage_totals(self):
+        with self.lock:
+            return {stage: (h.count, h.sum) for stage, h in self.stages.items()}
+
+    def render_prometheus(self):
+        with self.lock:
+            stages = [(stage, list(h.counts), h.sum, h.count) for stage, h in sorted(self.stages.items())]
+            counters = sorted(self.counters.items())
+            collectors = sorted(self.collectors.items())
+
+        lines = []
+        name = METRIC_PREFIX + "stage_seconds"
+        lines.append("# HELP {} Time spent in each stage of a turn".format(name))
+        lines.append("# TYPE {} histogram".format(name))
+        for stage, counts, total, count in stages:
+            cumulative = 0
+            for le, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, le, cumulative))
+            lines.append('{}_sum{{stage="{}"}} {:.6f}'.format(name, stage, total))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, count))
+
+        for counter, value in counters:
+            full_name = "{}{}_total".format(METRIC_PREFIX, counter)
+            lines.append("# TYPE {} counter".format(full_name))
+            lines.append("{} {}".format(full_name, value))
+
+        for collector, (fn, counter_keys) in collectors:
+            try:
+                values = fn()
+            except Exception as e:
+                lines.append("# {} failed: {}".format(collector, e))
+                continue
+            for key, value in _flatten("", values):
+                full_name = METRIC_PREFIX + collector + key
+                if key[1:] in counter_keys:
+                    lines.append("# TYPE {}_total counter".format(full_name))
+                    lines.append("{}_total {}".format(full_name, value))
+                else:
+                    lines.append("# TYPE {} gauge".format(full_name))
+                    lines.append("{} {}".format(full_name, value))
+        return "\n".join(lines) + "\n"
+
+# {"a": {"b": 1}} -> [("prefix_a_b", 1)]. Only numbers are kept
+def _flatten(prefix, values):
+    out = []
+    for key, value in values.items():
+        full_key = UNSAFE_NAME_RE.sub("_", "{}_{}".format(prefix, key))
+        if isinstance(value, dict):
+            out.extend(_flatten(full_key, value))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out.append((full_key, value))
+    return out
+
+# The one registry of the process. Shard workers have their own (see http_shard_server.py)
+METRICS = MetricsRegistry()
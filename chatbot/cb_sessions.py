@@ -0,0 +1,210 @@
+# Bounded store for the ChatManagers of a Chatbot
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_SESSIONS = 5000 # ChatManagers kept in memory
+DEFAULT_IDLE_TTL = 60 * 60 # Seconds without a message before a chat is spilled to disk
+DEFAULT_SPILL_FOLDER = "sessions"
+SPILL_EXTENSION = ".session"
+
+# Keeps at most max_sessions ChatManagers in memory, least recently used first out.
+# Chats idle for longer than idle_ttl are also moved out when sweep_idle is called.
+# Chats that leave memory are serialized to spill_dir with dump_fn and brought back with load_fn on the next message.
+# A chat that is checked out (a turn is running on it) is never evicted.
+#   dump_fn(manager) -> bytes, or None if the manager is saved somewhere else (nothing is spilled)
+#   load_fn(chatID, bytes) -> manager
+class SessionStore:
+    METRIC_COUNTERS = ("hits", "misses", "rehydrations", "evictions", "expirations", "spill_failures") # Keys of get_metrics that only go up
+
+    def __init__(self, dump_fn, load_fn, max_sessions = DEFAULT_MAX_SESSIONS, idle_ttl = DEFAULT_IDLE_TTL, spill_dir = None):
+        self.dump_fn = dump_fn
+        self.load_fn = load_fn
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.spill_dir = spill_dir or os.path.join(os.getcwd(), DEFAULT_SPILL_FOLDER)
+        self.lock = threading.RLock()
+        self.resident = OrderedDict() # chatID -> [manager, last_used, pins]. Oldest first
+        self.in_transit = set() # chatIDs being loaded or spilled by some thread, in neither resident nor (for sure) on disk
+        self.moved = threading.Condition(self.lock) # Notified when a chatID leaves in_transit
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "rehydrations": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "spill_failures": 0,
+        }
+
+    def _spill_path(self, chatID):
+        # chatIDs come from outside, so they are not used as filenames directly
+        name = hashlib.sha1(chatID.encode("utf-8")).hexdigest()
+        return os.path.join(self.spill_dir, name + SPILL_EXTENSION)
+
+    def _write_spill(self, chatID, data):
+        if not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir, exist_ok=True)
+        path = self._spill_path(chatID)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path) # Never leave a half written session behind
+
+    # Returns the spilled bytes of a chat, or None. The file stays until the chat has been loaded from it
+    def _read_spill(self, chatID):
+        path = self._spill_path(chatID)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _remove_spill(self, chatID):
+        path = self._spill_path(chatID)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    # Call with self.lock held. Waits (without the lock) until no other thread is loading or spilling chatID
+    def _wait_in_transit(self, chatID):
+        while chatID in self.in_transit:
+            self.moved.wait()
+
+    # Call with self.lock held
+    def _done_in_transit(self, chatID):
+        self.in_transit.discard(chatID)
+        self.moved.notify_all()
+
+    # Call without self.lock. Writes out chats taken out of memory by _take_over_cap or sweep_idle.
+    # Until a chat is written a checkout of it waits, so it never sees the chat missing from both memory and disk
+    def _spill(self, victims):
+        for chatID, manager in victims:
+            try:
+                data = self.dump_fn(manager)
+                if data is not None:
+                    self._write_spill(chatID, data)
+            except Exception as e:
+                with self.lock:
+                    self.metrics["spill_failures"] += 1
+                log.error("<SESSION STORE> Could not spill chat %s: %s", chatID, e)
+            finally:
+                with self.lock:
+                    self._done_in_transit(chatID)
+
+    # Call with self.lock held. Takes the least recently used chats out of memory until there are at most max_sessions.
+    # Returns them for _spill
+    def _take_over_cap(self):
+        victims = []
+        if len(self.resident) <= self.max_sessions:
+            return victims
+        for chatID in list(self.resident.keys()):
+            if len(self.resident) <= self.max_sessions:
+                break
+            entry = self.resident[chatID]
+            if entry[2] > 0:
+                continue # In use
+            self.resident.pop(chatID)
+            self.in_transit.add(chatID)
+            victims.append((chatID, entry[0]))
+            self.metrics["evictions"] += 1
+        return victims
+
+    # Returns the manager of chatID and marks it as in use. Every checkout must be followed by a checkin.
+    # If the chat is not in memory it is rehydrated from disk, or made with factory(chatID) if never seen before.
+    # Only one thread brings a chat into memory, others asking for it meanwhile wait for that one
+    def checkout(self, chatID, factory):
+        with self.lock:
+            self._wait_in_transit(chatID)
+            entry = self.resident.get(chatID)
+            if entry is not None:
+                self.metrics["hits"] += 1
+                entry[1] = time.time()
+                entry[2] += 1
+                self.resident.move_to_end(chatID)
+                return entry[0]
+            self.in_transit.add(chatID)
+
+        # Building a manager can mean a database lookup, so it is done outside the lock
+        try:
+            data = self._read_spill(chatID)
+            if data is None:
+                manager = factory(chatID)
+                found_key = "misses"
+            else:
+                manager = self.load_fn(chatID, data)
+                found_key = "rehydrations"
+                self._remove_spill(chatID) # Only now, a load that fails leaves the chat on disk for the next message
+        except Exception:
+            with self.lock:
+                self._done_in_transit(chatID)
+            raise
+
+        with self.lock:
+            self._done_in_transit(chatID)
+            self.resident[chatID] = [manager, time.time(), 1]
+            self.metrics[found_key] += 1
+            victims = self._take_over_cap()
+        self._spill(victims)
+        return manager
+
+    def checkin(self, chatID):
+        with self.lock:
+            entry = self.resident.get(chatID)
+            if entry is not None and entry[2] > 0:
+                entry[2] -= 1
+            victims = self._take_over_cap()
+        self._spill(victims)
+
+    # Spills every chat that has been idle for longer than idle_ttl
+    def sweep_idle(self, now = None):
+        now = now or time.time()
+        victims = []
+        with self.lock:
+            for chatID in list(self.resident.keys()):
+                entry = self.resident[chatID]
+                if now - entry[1] < self.idle_ttl:
+                    break # Ordered by last use, the rest are newer
+                if entry[2] > 0:
+                    continue
+                self.resident.pop(chatID)
+                self.in_transit.add(chatID)
+                victims.append((chatID, entry[0]))
+                self.metrics["expirations"] += 1
+        self._spill(victims)
+
+    # Like checkout, but only for a chat that is in memory: returns None instead of making or rehydrating one
+    def checkout_resident(self, chatID):
+        with self.lock:
+            entry = self.resident.get(chatID)
+            if entry is None:
+                return None
+            entry[2] += 1
+            return entry[0]
+
+    # Forgets chatID, in memory and on disk. The next message starts a new chat
+    def discard(self, chatID):
+        with self.lock:
+            self._wait_in_transit(chatID)
+            self.resident.pop(chatID, None)
+            self._remove_spill(chatID)
+
+    def resident_ids(self):
+        with self.lock:
+            return list(self.resident.keys())
+
+    def get_metrics(self):
+        with self.lock:
+            out = self.metrics.copy()
+            out["resident"] = len(self.resident)
+            return out
+
+    def __contains__(self, chatID):
+        with self.lock:
+            return chatID in self.resident
+
+    def __len__(self):
+        return len(self.resident)
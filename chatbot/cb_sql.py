@@ -1,8 +1,11 @@
 # A set of tools to interact with SQL
 import os
+import logging
 import pymssql as msql # Ignore the error message from this. But it means this is lib incompatible with Python 3.8 and above.
 import threading
 import chatbot.chatbot_utils as cu
+
+log = logging.getLogger(__name__)
 # from localfiles.details import get_read_details, get_write_details
 
 def get_read_details():
@@ -142,7 +145,7 @@ def check_local_files_bad(sql):
     if have_localfiles():
         return False
     else:
-        print("<CB SQL> No details file provided, unable to read/write to Database")
+        log.warning("<CB SQL> No details file provided, unable to read/write to Database")
         return True
 
 def add_to_str(s, thing):
@@ -194,25 +197,25 @@ class MSSQL_readwriter:
     def connect_to_write(self):
         global SQL_WRITE_ENABLED
         if SQL_WRITE_ENABLED:
-            print("Trying to connect to Write...")
+            log.info("Trying to connect to Write...")
             try:
                 
                 self.write_conn = msql.connect(server=db_host, user=db_user, password=db_pass, database=db_dbname,login_timeout=self.lto,timeout=self.qto)
-                print("Connected to Write!")
+                log.info("Connected to Write!")
             except Exception as e:
-                print("Write Connection Exception!",e)
+                log.error("Write Connection Exception! %s", e)
 
         
     def connect_to_read(self):
         global SQL_READ_ENABLED
         if SQL_READ_ENABLED:
-            print("Trying to connect to Read...")
+            log.info("Trying to connect to Read...")
             try:
                 self.read_conn = msql.connect(server=db_read_host, user=db_read_user, password=db_read_pass,login_timeout=self.lto,timeout=self.qto) 
                 # read_conn = msql.connect(server=db_read_host, user=db_read_user, password=db_read_pass, database=db_read_dbname) 
-                print("Connected to Read!")
+                log.info("Connected to Read!")
             except Exception as e:
-                print("Read Connection Exception!",e)
+                log.error("Read Connection Exception! %s", e)
 
 
     def insert_test(self):
@@ -222,7 +225,7 @@ class MSSQL_readwriter:
             slots = "(userID, city)"
             # vals = ('testuid', 'abc')
             sqlcmd = "INSERT INTO " + tablename + " " + slots + " VALUES (%s, %s)"
-            print("query:",sqlcmd)
+            log.debug("query: %s", sqlcmd)
             self.commit_to_con(connection, sqlcmd, vals)
             
         finally:
@@ -234,7 +237,7 @@ class MSSQL_readwriter:
             return []
         
         if self.cannot_read():
-            print("<FETCH FROM CON> No Connection, returning empty dict")
+            log.warning("<FETCH FROM CON> No Connection, returning empty dict")
             return {}
 
         conn = self.read_conn
@@ -246,7 +249,7 @@ class MSSQL_readwriter:
                 result = []
             return result
         except Exception as e:
-            print("<FETCH ALL ERROR>", e)
+            log.error("<FETCH ALL ERROR> %s", e)
 
     def fetch_lines_matching_value(self, tablename, column_name, value):
         cond = "WHERE " + column_name + "='" + str(value) + "'"
@@ -256,7 +259,7 @@ class MSSQL_readwriter:
     # Writes to the connection
     def commit_to_con(self,conn, comcmd, comvals):
         if SQL_WRITE_ENABLED:
-            print("<BACKEND WARNING: Writing to SQL has been disabled> Restore it in cb_sql.py.\nCommand not executed:{}".format(comcmd))
+            log.warning("<BACKEND WARNING: Writing to SQL has been disabled> Restore it in cb_sql.py. Command not executed: %s", comcmd)
             return
 
         if check_local_files_bad("COMMIT"):
@@ -268,10 +271,9 @@ class MSSQL_readwriter:
 
             # connection is not autocommit by default. Must commit to save changes.
             conn.commit()
-            print("Committed to db")
+            log.debug("Committed to db")
         except Exception as e:
-            print("EXCEPTION! Rolling back", e)
-            print("Failed command:",comcmd)
+            log.error("EXCEPTION! Rolling back %s. Failed command: %s", e, comcmd)
             conn.rollback()
 
     # Writes to a predefined table
@@ -281,7 +283,7 @@ class MSSQL_readwriter:
         connection = self.write_conn
         userids = self.fetch_all_from_con(tablename, columns = "userID")
         userids = map(lambda x: x['userID'],userids)
-        print("uids",userids)
+        log.debug("uids %s", userids)
         
         users = list(users_info.keys())
         
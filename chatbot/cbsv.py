@@ -2,7 +2,9 @@
 import os
 import re
 import json
+import logging
 
+log = logging.getLogger(__name__)
 
 WRITE_TO_FILE = 1 # Switch to turn of writing for testing purposes.
 
@@ -91,7 +93,7 @@ def check_input_against_db(msg, db, exact = False):
 
 def dump_to_json(filename, data, DEBUG = 0, OVERRIDE = 0):
     if not WRITE_TO_FILE and not OVERRIDE: 
-        print("<BACKEND WARNING: Writing to file has been disabled> Restore it in cbsv.py\n {} remains unchanged".format(filename))
+        log.warning("<BACKEND WARNING: Writing to file has been disabled> Restore it in cbsv.py. %s remains unchanged", filename)
         return
     try:
         with open(filename,'w+', encoding='utf8') as f:
@@ -99,16 +101,16 @@ def dump_to_json(filename, data, DEBUG = 0, OVERRIDE = 0):
         if DEBUG: print("Finished writing to " + str(filename))
         
     except FileNotFoundError as fnf_error:
-        print(fnf_error)
+        log.error("%s", fnf_error)
     
 
 def read_json(json_filename):
     try:
         with open(json_filename, 'r',encoding="utf-8") as f:
-            data = json.loads(f.read(),encoding="utf-8")
+            data = json.loads(f.read())
         return data
     except Exception as e:
-        print("Exception opening{}".format(json_filename), e)
+        log.error("Exception opening %s: %s", json_filename, e)
         return {}
         
 
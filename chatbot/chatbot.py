@@ -1,5 +1,8 @@
+import logging
 import re
 import threading
+from chatbot.cb_sessions import SessionStore, DEFAULT_MAX_SESSIONS, DEFAULT_IDLE_TTL
+from chatbot.cb_journal import SessionJournal
 from chatbot.initalizers import master_initalize
 from chatbot.chatbot_supp import *
 from chatbot.chatclass import *
@@ -7,6 +10,8 @@ from chatbot.chatbot_be import DatabaseRunner
 
 DEBUG = 0
 
+log = logging.getLogger(__name__) # After the * imports, which bring their own log
+
 # The main file that ties everything together.
 # This is more or less the API center with the all important method: "get_bot_reply"
 # Calls all the supporting functions from chatclass, chatbot_supp, and initalizers
@@ -52,92 +57,169 @@ def format_text(text):
 # Big Chatbot class
 class Chatbot():
     timeout = 15
-    def __init__(self):
+    # Only max_sessions chats are kept in memory. The rest are saved in session_dir and loaded again on their next message
+    # With use_journal every turn is also written to the journal at journal_path, so chats carry on after a restart.
+    # The journal then replaces session_dir.
+    def __init__(self, max_sessions = DEFAULT_MAX_SESSIONS, session_idle_ttl = DEFAULT_IDLE_TTL, session_dir = None,
+                 use_journal = True, journal_path = None):
         self.PREV_REPLY_FLAG = "prev_state_message"
-        self.chat_dict = {}
+        self.sessions = SessionStore(self._dump_chatmgr, self._load_chatmgr, max_sessions, session_idle_ttl, session_dir)
+        self.journal = SessionJournal(journal_path) if use_journal else None
         self.triggered = False
+        self.trigger_lock = threading.Lock() # Guards triggered
+        self.backup_running = threading.Lock()
     
     def _fetch_user_DB_info(self, user):
         return self.dbr.fetch_user_info(user)
 
-    def make_new_chatmgr(self, chat):
-        makeCM = lambda c: ChatManager(c, self.cl, self.ip, self.pk, self.rg, self.dm, self.gk)
+    def make_new_chatmgr(self, chat, lookup_user = True):
+        makeCM = lambda c: ChatManager(c, self.cl, self.ip, self.pk, self.rg, self.dm, self.gk, lookup_user = lookup_user)
         return makeCM(chat)
 
-    def start_bot(self, cb_resource_filename = "" , backend_read = True, backend_write = False):
-        comps = master_initalize(cb_resource_filename)
+    # components: the output of master_initalize, to skip reading the resources again (see http_shard_server.py)
+    def start_bot(self, cb_resource_filename = "" , backend_read = True, backend_write = False, components = None, db_filename = "database.json"):
+        comps = components if components is not None else master_initalize(cb_resource_filename)
         self.cl = comps['calculator']
         self.dm = comps['dmanager']
         self.ip = comps['iparser']
         self.pk = comps['pkeeper']
         self.rg = comps['replygen']
         self.gk = comps['gkeeper']
-        self.dbr = DatabaseRunner(read_sql=backend_read, write_to_sql=backend_write)
+        self.dbr = DatabaseRunner(read_sql=backend_read, write_to_sql=backend_write, db_filename=db_filename)
         self.dm.set_runner(self.dbr)
-        print("SHEBAO chatbot started!")
+        log.info("SHEBAO chatbot started!")
         return
 
     def trigger_backup(self):
-        if not self.triggered:
+        with self.trigger_lock:
+            if self.triggered:
+                return
             self.triggered = True
-            self.set_backup_alarm()
+        self.set_backup_alarm()
 
     def set_backup_alarm(self):
         if not self.triggered:
             # No need for backup when no new messages
             return
-        if DEBUG: print("Scheduled an event in",self.timeout,"s")
+        log.debug("Scheduled an event in %s s", self.timeout)
         timer = threading.Timer(self.timeout, self.backup_chats)
         timer.start()
 
+    # Each chat is checked out and locked while it is written, so it is not evicted or in the middle of a turn
     def backup_chats(self):
-        if DEBUG: print("Backing up chat...")
-        for c in list(self.chat_dict.keys()):
-            self.chat_dict[c].backup_chat()
-        self.triggered = False
+        if not self.backup_running.acquire(blocking=False):
+            return # Another backup is still going
+        try:
+            log.debug("Backing up chat...")
+            for chatID in self.sessions.resident_ids():
+                chat_mgr = self.sessions.checkout_resident(chatID)
+                if chat_mgr is None:
+                    continue # Left memory since
+                try:
+                    with chat_mgr.lock:
+                        chat_mgr.backup_chat()
+                finally:
+                    self.sessions.checkin(chatID)
+            self.sessions.sweep_idle()
+            if not self.journal is None:
+                self.journal.maybe_compact()
+        finally:
+            self.backup_running.release()
+        with self.trigger_lock:
+            self.triggered = False
         self.set_backup_alarm()
 
+    # Returns a new ChatManager
     def make_new_chat(self,chatID):
         # Looks in the database for existing info
         chat_hist = {}
         newchat = Chat(chatID, chat_hist)
-        new_manager = self.make_new_chatmgr(newchat)
-        self.chat_dict[chatID] = new_manager
-        return
+        return self.make_new_chatmgr(newchat)
+
+    # For the session store. Chats never seen in memory since the start are looked up in the journal
+    def _open_chat(self, chatID):
+        if not self.journal is None:
+            data = self.journal.load(chatID)
+            if not data is None:
+                return self._load_chatmgr(chatID, data)
+        return self.make_new_chat(chatID)
+
+    # For the session store. The chat log is written out instead of being saved with the session
+    def _dump_chatmgr(self, chat_mgr):
+        chat_mgr.backup_chat()
+        if not self.journal is None:
+            self.journal.release(chat_mgr.chatID)
+            return None # Already in the journal
+        return chat_mgr.snapshot()
+
+    # Forgets everything about chatID (in memory, spilled and journaled). The chat log stays
+    def delete_chat(self, chatID):
+        self.sessions.discard(chatID)
+        if not self.journal is None:
+            self.journal.delete(chatID)
+
+    def _load_chatmgr(self, chatID, data):
+        chat_mgr = self.make_new_chatmgr(Chat(chatID, {}), lookup_user = False)
+        chat_mgr.restore(data)
+        return chat_mgr
+
+    # Journals the state of chat_mgr after a turn. A failed write only costs the chat its restart
+    def _journal_turn(self, chatID, chat_mgr):
+        if self.journal is None:
+            return
+        try:
+            self.journal.append(chatID, chat_mgr.snapshot())
+        except Exception as e:
+            log.error("<JOURNAL> Could not journal chat %s: %s", chatID, e)
+
+    # Hits, misses, evictions etc. of the session store (and the journal)
+    SESSION_METRIC_COUNTERS = SessionStore.METRIC_COUNTERS + tuple("journal_" + key for key in SessionJournal.METRIC_COUNTERS)
+
+    def get_session_metrics(self):
+        metrics = self.sessions.get_metrics()
+        if not self.journal is None:
+            metrics["journal"] = self.journal.get_metrics()
+        return metrics
 
     def clean_message(self, rawtext):
         cln_txt = format_text(rawtext)
         return cln_txt
 
-    def _switch_chat_manager(self, chatid):
-        # Create a new chat if never chat before
-        if not chatid in self.chat_dict:
-            self.make_new_chat(chatid)
-        return self.chat_dict[chatid]
-
     # Returns a tuple of (ResponseAction, intent breakdown, current info)
     def _get_reply_obj(self, chatID, msg, op_print):
         self.trigger_backup()
-        curr_chat_mgr = self._switch_chat_manager(chatID)
-        if DEBUG: print("Current chat manager is for", chatID)
-        f_msg = self.clean_message(msg)
-        reply_tuple = curr_chat_mgr.respond_to_message(f_msg, op_print = op_print)
+        # Creates a new chat if never chat before
+        curr_chat_mgr = self.sessions.checkout(chatID, self._open_chat)
+        try:
+            log.debug("Current chat manager is for %s", chatID)
+            f_msg = self.clean_message(msg)
+            with curr_chat_mgr.lock:
+                reply_tuple = curr_chat_mgr.respond_to_message(f_msg, op_print = op_print)
+                self._journal_turn(chatID, curr_chat_mgr)
+        finally:
+            self.sessions.checkin(chatID)
         return reply_tuple
 
     # Returns a ResponseAction
     def get_bot_response(self, chatID, msg, op_print = True):
         r_action, bd, curr_info = self._get_reply_obj(chatID, msg, op_print)
-        if op_print: print("<GET BOT REPLY> Current Info: {}".format(curr_info))
+        if op_print: log.info("<GET BOT REPLY> Current Info: %s", curr_info)
         return r_action
 
     # Asks chatmanager to read the long history and parse selectively.
     def parse_transferred_messages(self, chatID, history):
-        curr_chat_mgr = self._switch_chat_manager(chatID)
-        curr_chat_mgr.read_chat_history(history)
+        curr_chat_mgr = self.sessions.checkout(chatID, self._open_chat)
+        try:
+            with curr_chat_mgr.lock:
+                curr_chat_mgr.read_chat_history(history)
+                self._journal_turn(chatID, curr_chat_mgr)
+        finally:
+            self.sessions.checkin(chatID)
         return
 
 if __name__ == "__main__":
     # Local running
+    logging.basicConfig(level=logging.INFO, format="%(message)s") # Shows the per turn printout
     cbrfn = "wechat_chatbot_resource.json"
     bot = Chatbot()
     bot.start_bot(cb_resource_filename = cbrfn, backend_read = False)
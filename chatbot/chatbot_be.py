@@ -1,5 +1,6 @@
 # Chatbot Backend
 import os
+import logging
 import threading
 from copy import deepcopy
 from decimal import Decimal
@@ -8,6 +9,8 @@ from datetime import datetime
 from chatbot.cbsv import read_json, dump_to_json, check_file_exists, CHINA_CITIES
 from chatbot.cb_sql import MSSQL_readwriter
 
+log = logging.getLogger(__name__)
+
 
 dbfolder = "userdata"
 SUPER_DEBUG = 0
@@ -16,12 +19,15 @@ READ_FROM_JSON = 1
 WRITE_TO_JSON = 1
 
 class DatabaseRunner():
-    def __init__(self, read_sql = True, write_to_sql = False):
+    # Processes sharing a working directory need their own db_filename, the whole file is rewritten on every backup
+    def __init__(self, read_sql = True, write_to_sql = False, db_filename = "database.json"):
         self.backup_delay = 30
         self.timer_on = False
+        self.db_lock = threading.RLock() # self.database is written by request threads and dumped by the backup timer
         self.read_sql = read_sql
         self.write_to_sql = write_to_sql
         
+        self.dbfilename = db_filename
         if READ_FROM_JSON:
             self.database = self._read_json_db()
         else:
@@ -32,14 +38,13 @@ class DatabaseRunner():
     def _read_json_db(self):
         def _create_json_db():
             if not check_file_exists(self.dbfilepath):
-                print("Creating empty database file")
+                log.info("Creating empty database file")
                 dump_to_json(self.dbfilepath,{}, OVERRIDE = 1) # Create an empty file
             return
 
         base_directry = os.getcwd()
-        dbfilename = "database.json"
-        # self.dbfilepath = os.path.join(base_directry,dbfolder,dbfilename)
-        self.dbfilepath = os.path.join(base_directry,dbfilename) # For testing purpose
+        # self.dbfilepath = os.path.join(base_directry,dbfolder,self.dbfilename)
+        self.dbfilepath = os.path.join(base_directry,self.dbfilename) # For testing purpose
         _create_json_db()
 
         if DEBUG: print("Loading info from", self.dbfilepath)
@@ -92,7 +97,7 @@ class DatabaseRunner():
                 deciding_entry_val = ed_entry.get(deciding_key,"")
                 for v in valid_vals:
                     if v in deciding_entry_val:
-                        print("<FILTER> basic dict entry: ", ed_entry, "DV:",deciding_entry_val)
+                        log.debug("<FILTER> basic dict entry: %s DV: %s", ed_entry, deciding_entry_val)
                         if out == {}:
                             out.update(ed_entry)
                             break
@@ -244,27 +249,30 @@ class DatabaseRunner():
 
         found_in_sql = _fetch_from_SQL(user)
 
-        if not found_in_sql: 
-            _fetch_from_JSON(user)
-        
-        return (found_in_sql, self.database[user])
+        with self.db_lock:
+            if not found_in_sql: 
+                _fetch_from_JSON(user)
+            
+            return (found_in_sql, self.database[user])
 
     def trigger_backup(self):
-        if self.timer_on:
-            return
-        self.timer_on = True
+        with self.db_lock:
+            if self.timer_on:
+                return
+            self.timer_on = True
         backuptimer = threading.Timer(self.backup_delay, self._true_write_to_db)
         backuptimer.start()
 
     def write_to_db(self, chatid, info):
-        if not chatid in self.database:
-            # Create empty entry for new user
-            self.database[chatid] = {}
+        with self.db_lock:
+            if not chatid in self.database:
+                # Create empty entry for new user
+                self.database[chatid] = {}
 
-        # Write to a dict that will later be pushed to the db
-        self.database[chatid].update({"userID":chatid})
-        self.database[chatid].update(info)
-        if DEBUG: print("<Write to DB> self.db", self.database)
+            # Write to a dict that will later be pushed to the db
+            self.database[chatid].update({"userID":chatid})
+            self.database[chatid].update(info)
+            if DEBUG: print("<Write to DB> self.db", self.database)
 
         # Set timer to write
         self.trigger_backup()
@@ -276,19 +284,20 @@ class DatabaseRunner():
                     self.database.pop(user)
 
         if DEBUG: print("Writing userinfo to database")
-        destroy_local_empty_records()
-        if WRITE_TO_JSON:
-            dump_to_json(self.dbfilepath, self.database)
-        elif self.write_to_sql:
-            self.SQLrw.write_to_sqltable(self.database)
-        self.timer_on = False
+        with self.db_lock:
+            destroy_local_empty_records()
+            if WRITE_TO_JSON:
+                dump_to_json(self.dbfilepath, self.database)
+            elif self.write_to_sql:
+                self.SQLrw.write_to_sqltable(self.database)
+            self.timer_on = False
 
 # Assumes messages are in a list structure
 def record_chatlog_to_json(chatID, chatlog):
     direct = os.getcwd()
     log_folder = "chatlogs"
     if not os.path.isdir(os.path.join(direct,log_folder)):
-        print("Creating chatlogs folder...")
+        log.info("Creating chatlogs folder...")
         os.mkdir(os.path.join(direct,"chatlogs")) # If no folder, make a folder
     
     log_filepath = os.path.join(direct,"chatlogs/" + chatID + ".json")
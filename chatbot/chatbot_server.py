@@ -3,6 +3,7 @@
 # QIAN NIU SERVER
 
 #import asyncio
+import logging
 import sys
 import socketio
 from aiohttp import web
@@ -11,6 +12,8 @@ from chatbot.chatbot import Chatbot
 # This file opens a server that is a front for the chatbot. 
 # Right now it defaults to localhost:8080 due to aiohttp
 
+log = logging.getLogger(__name__)
+
 sio = socketio.AsyncServer()
 app = web.Application() # This is implicitly an aiohttp apparently
 sio.attach(app)
@@ -57,14 +60,13 @@ def index(request):
 @sio.event
 async def connect(sid, environ):
     sio.enter_room(sid, sid) # Take a client and put them into a room that is their socket ID
-    print("############## New connection! ##############")
-    print("Contacted by someone at", sid)
+    log.info("New connection from %s", sid)
     greet = robotify(welcome_msg)
     await sio.emit('message', greet, room=sid)
 
 @sio.event
 async def disconnect(sid):
-    print('disconnect', sid)
+    log.info("Disconnect %s", sid)
 
 idmap = {}
 
@@ -83,7 +85,7 @@ async def chat_message(sid, msg):
     else:
         uid = idmap[sid] if sid in idmap else sid
         await sio.emit('message',display_own_message(msg,uid),room=sid)
-        print("Recieved from",uid,"Content:",msg)
+        log.debug("Recieved from %s Content: %s", uid, msg)
         text, bd, curr_info = get_bot_reply(bot, uid, msg)
         await sio.emit('message', text, room=sid)
         await sio.emit('message', bd, room=sid)
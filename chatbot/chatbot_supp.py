@@ -4,12 +4,16 @@ import chatbot.cbsv as cbsv
 import chatbot.chatbot_utils as cu
 import logging
 
+from chatbot.cb_metrics import METRICS
+
 SUPER_DEBUG = 0
 DEBUG = 1
 CALCULATOR_DEBUG = 0
 
 DEBUG = DEBUG or SUPER_DEBUG
 
+log = logging.getLogger(__name__)
+
 # Have a message class? Or some sort of flag for messages. Indicate state-changing messages.
 PREV_STATE_F = {"key":"299 PREV_STATE", "gated": False} # HARDCODED
 SAME_STATE_F_OBJ = {"key":"same_state","gated":False} # HARDCODED
@@ -104,7 +108,7 @@ class Understanding:
         return self.sip.get_slots()
 
     def printout(self):
-        print("UNDERSTANDING OBJ PRINTOUT Intent: ", self.intent, " SIP: ", self.sip.toString())
+        log.debug("UNDERSTANDING OBJ PRINTOUT Intent: %s SIP: %s", self.intent, self.sip.toString())
 
 class ResponseAction:
     textmsg_flag = "text_reply"
@@ -156,14 +160,13 @@ class ResponseAction:
             out += "| Payload: {}".format(self.payload)
         return out
 
-class ReqGatekeeper:
-    def __init__(self, conds, default_slot_vals):
+# Working values of the gatekeeper for one conversation.
+# The gate can stay closed across turns (waiting for the user to give info), so each ChatManager owns one.
+class GateContext:
+    def __init__(self):
         self.requirements = []
         self.slots = []
         self.gate_closed = False
-        self.conds = conds
-        self.default_slot_vals = default_slot_vals
-        self.def_slot_flag = "DEFAULT_SV" # HARDCODED
 
     def open_gate(self):
         self.gate_closed = False
@@ -175,12 +178,25 @@ class ReqGatekeeper:
 
     def get_slots(self):        
         return self.slots.copy()
+
+# Shared by every ChatManager. Holds only config; everything that changes lives in a GateContext.
+class ReqGatekeeper:
+    def __init__(self, conds, default_slot_vals):
+        self.conds = conds
+        self.default_slot_vals = default_slot_vals
+        self.def_slot_flag = "DEFAULT_SV" # HARDCODED
+
+    def new_context(self):
+        return GateContext()
+
+    def get_slots(self, gctx):        
+        return gctx.get_slots()
     
     def _get_slots_name_list(self, sl):
         return list(map(lambda x: x[0],sl))
 
-    def get_slot_names(self):
-        return self._get_slots_name_list(self.get_slots())
+    def get_slot_names(self, gctx):
+        return self._get_slots_name_list(self.get_slots(gctx))
 
     # def get_default_slots(self):
     #     slots = self.get_slots()
@@ -190,10 +206,10 @@ class ReqGatekeeper:
     # def get_def_slot_names(self):
     #     return self._get_slots_name_list(self.get_default_slots())
 
-    def is_gated(self):
-        return self.gate_closed
+    def is_gated(self, gctx):
+        return gctx.gate_closed
 
-    def _add_cond_req_slots(self, info):
+    def _add_cond_req_slots(self, gctx, info):
         # Additional reqs slot addition
         for detail, conditions in self.conds.items():
             fetch = cu.dive_for_values([detail,],info,DEBUG=1)
@@ -204,9 +220,9 @@ class ReqGatekeeper:
                     if fetched[0] == val:
                         for slot in slots_list:
                             # Only add if slot does not exist
-                            if not slot[0] in info and not slot[0] in self.get_slot_names():
-                                logging.debug("<CONDITIONAL REQS> Update COND slots: {}".format(slot))
-                                self.slots.append(slot)
+                            if not slot[0] in info and not slot[0] in self.get_slot_names(gctx):
+                                log.debug("<CONDITIONAL REQS> Update COND slots: %s", slot)
+                                gctx.slots.append(slot)
                         break
 
     @classmethod
@@ -217,14 +233,14 @@ class ReqGatekeeper:
         reqlist = []
         for slot in slots.copy():
             reqlist.append(getname(slot))
-        if DEBUG: print("<slots_to_reqs> return:", reqlist)
+        log.debug("<slots_to_reqs> return: %s", reqlist)
         return reqlist  
 
     # Only used for printing purposes
-    def get_requirements(self):
-        return self.requirements.copy()
+    def get_requirements(self, gctx):
+        return gctx.requirements.copy()
 
-    def scan_state_obj(self, state_obj, info):
+    def scan_state_obj(self, gctx, state_obj, info):
         if "gated" not in state_obj:
             return
 
@@ -232,16 +248,16 @@ class ReqGatekeeper:
         if not state_obj["gated"] or len(slots) < 1:
             return
        
-        self.close_gate()
-        self.slots = slots.copy()
-        self._add_cond_req_slots(info)
-        if DEBUG: print("<SCAN STATE OBJ> slots:",slots)
-        self.requirements = ReqGatekeeper.slots_to_reqs(self.slots)      
+        gctx.close_gate()
+        gctx.slots = slots.copy()
+        self._add_cond_req_slots(gctx, info)
+        log.debug("<SCAN STATE OBJ> slots: %s", slots)
+        gctx.requirements = ReqGatekeeper.slots_to_reqs(gctx.slots)      
 
     # This iterates through the slots and removes every entry that already has a value, leaving the slots that are missing values
-    def _get_unfilled_slots(self, info):
-        self._add_cond_req_slots(info) # Adding slots now because information may have changed
-        uf_slots = self.get_slots() # get_slots returns a copy already
+    def _get_unfilled_slots(self, gctx, info):
+        self._add_cond_req_slots(gctx, info) # Adding slots now because information may have changed
+        uf_slots = self.get_slots(gctx) # get_slots returns a copy already
         for s in uf_slots.copy():
             detail = s[0]
             if detail in info:
@@ -250,31 +266,31 @@ class ReqGatekeeper:
 
     # If pass, returns True, (Pending state)
     # If fail, returns False, (Next state)
-    def try_gate(self, info):
+    def try_gate(self, gctx, info):
         def is_passed(us):
             return (len(us) == 0)
 
-        if not self.gate_closed:
+        if not gctx.gate_closed:
             # If the gate is open
             passed = True
             unfilled_slots = []
 
         else:
-            # if SUPER_DEBUG: print("<TRY GATE> Trying with info:",info, "required:",self.get_requirements())
+            # if SUPER_DEBUG: print("<TRY GATE> Trying with info:",info, "required:",self.get_requirements(gctx))
             # for catgry in list(info.keys()):
-            unfilled_slots = self._get_unfilled_slots(info)
+            unfilled_slots = self._get_unfilled_slots(gctx, info)
 
-            if DEBUG: print("<TRY GATE> Unfilled_slots:",unfilled_slots)
+            log.debug("<TRY GATE> Unfilled_slots: %s", unfilled_slots)
             if len(unfilled_slots) == 0:
-                self.open_gate()
+                gctx.open_gate()
 
             passed = is_passed(unfilled_slots)
         
         return (passed, unfilled_slots)
 
     # For now this fills default slots with their default values.
-    def preprocess(self, curr_info):
-        unfilled_slots = self._get_unfilled_slots(curr_info)
+    def preprocess(self, gctx, curr_info):
+        unfilled_slots = self._get_unfilled_slots(gctx, curr_info)
         topup = self.assign_default_values(unfilled_slots)[1]
         return topup
 
@@ -292,7 +308,7 @@ class ReqGatekeeper:
                     val = self.default_slot_vals[slotname]
                     info_topup[slotname] = val
                     post_unfilled.remove(slot)
-                    if DEBUG: print("<DEFAULT VALS> {} assigned default value: {}".format(slotname, val))
+                    log.debug("<DEFAULT VALS> %s assigned default value: %s", slotname, val)
         if SUPER_DEBUG: print("<DEFAULT VALS> post top up", info_topup)
         return (post_unfilled, info_topup)
 
@@ -532,7 +548,7 @@ class InfoParser():
             grp_num = vs.get("group_pos")
             pv = pos_regex(pattern, grp_num)
             if not pv == "":
-                if DEBUG: print("<VAL SLOTS> PV", pv)
+                log.debug("<VAL SLOTS> PV %s", pv)
                 wk = vs.get("key")
                 out_dict[wk] = pv
 
@@ -713,6 +729,21 @@ class InfoParser():
 
         return output
 
+# Local/working values used for one call of Calculator.calculate
+class CalcContext:
+    def __init__(self):
+        self.precalc_list = []
+        self.l_calc_ext = {}
+        self.calc_topup = {}
+        self.feedback_count = 0
+
+    def add_precalc(self, calcname):
+        self.precalc_list.append(calcname)
+    
+    def check_precalc_skip(self, calcname):
+        return calcname in self.precalc_list
+
+# Shared by every ChatManager. Only reads the formulae; the working values of a calculation live in a CalcContext.
 class Calculator():
     def __init__(self, formulae):
         self.DEBUG = CALCULATOR_DEBUG
@@ -725,24 +756,8 @@ class Calculator():
 
         self.formula_db = formulae
         self.build_output_db(self.formula_db)
-        self.feedback_count = 0
         return
 
-    # Resets all local/working values used for calculation
-    def reset_calc_cache(self):
-        self._reset_precalc_list()
-        self.l_calc_ext = {}
-        self.calc_topup = {}
-
-    def _reset_precalc_list(self):
-        self.precalc_list = []
-        
-    def add_precalc(self, calcname):
-        self.precalc_list.append(calcname)
-    
-    def check_precalc_skip(self, calcname):
-        return calcname in self.precalc_list
-
     # Builds a lookup table of Output -> Formula Key (name)
     def build_output_db(self, fdb):
         def _make_key(fname, pv):
@@ -777,10 +792,9 @@ class Calculator():
     # Main Callable function #
     # Returns the topup dict and the calc_extension dict
     def calculate(self, curr_state, curr_info):
-        self.feedback_count = 0
-        self.reset_calc_cache()
-        self._do_all_calculations(curr_state, curr_info)
-        return (self.calc_topup, self.l_calc_ext)
+        cctx = CalcContext()
+        self._do_all_calculations(cctx, curr_state, curr_info)
+        return (cctx.calc_topup, cctx.l_calc_ext)
     
     # Looks through the formula table to get a list of formulas that must be executed before proceeding
     def trace_req_vars(self, req_vars):
@@ -818,19 +832,19 @@ class Calculator():
         return frm
 
     # Traces required variables and executes whatever produces the variables
-    def precalculate(self, f, info):
+    def precalculate(self, cctx, f, info):
         rvs = self._get_req_vars(f)
         fkey_list = self.trace_req_vars(rvs)
         self.debug_print("<PRECALCULATING>" + str(fkey_list))
         for fkey in fkey_list:
-            if not self.check_precalc_skip(fkey):
-                self.add_precalc(fkey)
-                self.new_resolve_formula(fkey, info) # This calls precalculate
+            if not cctx.check_precalc_skip(fkey):
+                cctx.add_precalc(fkey)
+                self.new_resolve_formula(cctx, fkey, info) # This calls precalculate
         return
 
     # Performs calculations and formats text message replies 
     ############## Major function ##############
-    def _do_all_calculations(self, curr_state, info):
+    def _do_all_calculations(self, cctx, curr_state, info):
         CALC_DEBUG = self.DEBUG
         CALC_SUPER_DEBUG = self.SUPER_DEBUG
         enhanced = info.copy()
@@ -839,7 +853,7 @@ class Calculator():
         # Calculations
         state_calcs = self._get_calcs(curr_state)
         for fname in state_calcs:
-            self.new_resolve_formula(fname, enhanced)
+            self.new_resolve_formula(cctx, fname, enhanced)
             # if CALC_DEBUG: print("<RESOLVE FORMULA> Intermediate enh",enhanced)
         
         if CALC_SUPER_DEBUG: print("<RESOLVE FORMULA> Postcalc enh",enhanced)
@@ -847,20 +861,20 @@ class Calculator():
         
         return
         
-    def detect_inf_feedback(self):
+    def detect_inf_feedback(self, cctx):
         limit = 10
-        self.feedback_count += 1
-        return self.feedback_count > limit
+        cctx.feedback_count += 1
+        return cctx.feedback_count > limit
     
-    def _assign_outputs(self, result_dict, formula, enhanced):
+    def _assign_outputs(self, cctx, result_dict, formula, enhanced):
         self.debug_print("<ASSIGN OUTPUTS>"+str(result_dict))
         target_key = self._get_writeto(formula)
         pv_flag = self._get_persist_value(formula)
         
         # Auto includes l_calc_ext and calc_topup
         def add_calc_enh(key, rawstr, rnd = 2, _pv = False):
-            local_calc_ext = self.l_calc_ext
-            calc_topup = self.calc_topup
+            local_calc_ext = cctx.l_calc_ext
+            calc_topup = cctx.calc_topup
 
             flt = cu.cbround(rawstr,rnd)
             if SUPER_DEBUG: print("<ENHANCE> Adding to Calc Ext {}:{}".format(key,rawstr))
@@ -881,7 +895,7 @@ class Calculator():
                         add_calc_enh(tk,result, _pv = pv_flag)
 
                 else:
-                    print("<RESOLVE FORMULA> ERROR {} not found in formula".format(vdk))
+                    log.error("<RESOLVE FORMULA> %s not found in formula", vdk)
             return 
 
         if isinstance(target_key, list):
@@ -893,16 +907,17 @@ class Calculator():
         return
 
     # Calculates, then assigns values to relevant keys
-    def new_resolve_formula(self, fkey, info):
-        if self.detect_inf_feedback():
+    def new_resolve_formula(self, cctx, fkey, info):
+        if self.detect_inf_feedback(cctx):
             cu.log_error("<NEW RESOLVE FORMULA> Infinite Precalc Feedback Loop")
 
         form = self._get_formula_obj(fkey)
-        self.precalculate(form, info) # This calls new_resolve_formula. Beware of infinite feedback loops
+        METRICS.count("formula_evaluations")
+        self.precalculate(cctx, form, info) # This calls new_resolve_formula. Beware of infinite feedback loops
         self.debug_print("<NEW RESOLVE FORMULA> Performing: "+fkey)
         if SUPER_DEBUG: print("<NEW RESOLVE FORMULA> Current info:",info)
         vd = self._core_resolve_formula(form, info)
-        self._assign_outputs(vd, form, info)
+        self._assign_outputs(cctx, vd, form, info)
         return
 
     def _core_resolve_formula(self, f, enh):
@@ -912,7 +927,7 @@ class Calculator():
             treeval = self.resolve_tree(f, enh)
             writeto = self._get_writeto(f) # Assuming only 1 writeto
             if isinstance(writeto, list):
-                print("<CORE RESOLVE FORMULA> ERROR expected str but got", writeto)
+                log.error("<CORE RESOLVE FORMULA> Expected str but got %s", writeto)
                 raise Exception("Tree writeto exception")
             return {self.std_output_key:treeval}
         else:
@@ -930,7 +945,7 @@ class Calculator():
                     final = cu.dive_for_dot_values(branch, info, DEBUG=SUPER_DEBUG, as_val = 1)
                     
                     if final == {}:
-                        if DEBUG: print("<SECONDARY SLOT GETV> {} not found in info".format(branch))
+                        log.debug("<SECONDARY SLOT GETV> %s not found in info", branch)
                         final = ""
                     return final
 
@@ -1048,7 +1063,7 @@ class Calculator():
                 isnumbr = cbsv.is_number(vname)
                 rel_val = vname if isnumbr else vdic.get(vname) # variables can be real numbers or variable names
                 if rel_val == "":
-                    print("<FORMULA OPERATION> ERROR no value for {} in {}".format(vname, varnames))
+                    log.error("<FORMULA OPERATION> No value for %s in %s", vname, varnames)
                     rel_val = 0
 
                 if out == None:
@@ -1075,7 +1090,7 @@ class Calculator():
                 opr = lambda a,b: (1 if (a > 0 or b > 0) else 0)
             else:
                 emsg = "<RESOLVE FORMULA> ERROR Unknown operator:"+opname
-                print(emsg)
+                log.error(emsg)
                 raise Exception(emsg)
                 # opr = lambda a,b: a # Unknown operator just returns a
             return opr
@@ -1090,7 +1105,7 @@ class Calculator():
                     vkey, tval, fval = setval
 
                     if not k in vd:
-                        print("<COND VALS> WARNING {} not in info".format(k))
+                        log.warning("<COND VALS> %s not in info", k)
                         met = False
                     else:
                         if isinstance(v, list):
@@ -1,8 +1,22 @@
 import os
+import logging
+import threading
 import datetime as dt
+
+from logging.handlers import RotatingFileHandler
+from chatbot.cb_logging import add_logger_handler
 # Useful Functions
 DEBUG_DEFAULT = 0
 
+ERROR_LOG_NAME = "chatbot.errors"
+ERROR_LOG_FILENAME = "errorlog.txt"
+ERROR_LOG_MAX_BYTES = 1024 * 1024
+ERROR_LOG_BACKUPS = 3
+_error_journal = None
+_error_journal_lock = threading.Lock()
+
+log = logging.getLogger(__name__)
+
 # Wrapper function for dive_for_values where the detail path is a dot list
 def dive_for_dot_values(dot_locs, info_dir, failzero = False, DEBUG = DEBUG_DEFAULT, as_val = 0, full_path = 1):
     if not isinstance(dot_locs, str):
@@ -18,7 +32,7 @@ def dive_for_dot_values(dot_locs, info_dir, failzero = False, DEBUG = DEBUG_DEFA
                     out_dict.update(dive_result) # Dive result must be a dict
                 return out_dict
         else:
-            print("<DIVE FOR DOT> Bad input. Expected string or list of strings but got:", dot_locs)
+            log.warning("<DIVE FOR DOT> Bad input. Expected string or list of strings but got: %s", dot_locs)
             return {}
 
     new_nest_list = _docloc_to_list(dot_locs)
@@ -41,7 +55,7 @@ def dive_for_values(nest_list, info_dir, failzero = False, DEBUG = DEBUG_DEFAULT
                     nest_list = inner_list # Single value but accidentially in a list
         elif isinstance(inner_list[0], str) and isinstance(inner_list[1], list):
             if not len(inner_list) == 2:
-                print("<DIVE> Bad list length, expected len 2 but got len",len(inner_list),nest_list)
+                log.warning("<DIVE> Bad list length, expected len 2 but got len %s %s", len(inner_list), nest_list)
                 return {}
                 
     dive_result = _dive(nest_list, info_dir, "", failzero = failzero, DEBUG = DEBUG)
@@ -66,11 +80,11 @@ def _dive(c_list, c_dir, prefix, failzero = False, DEBUG = DEBUG_DEFAULT, full_p
                 if failzero:
                     for vn in valname:
                         if isinstance(vn, list):
-                            print("<DIVE> vn is a list",vn)
+                            log.warning("<DIVE> vn is a list %s", vn)
                             return out
                         out[vn] = 0
                 else:
-                    if DEBUG: print("<DIVE> ERROR! Cannot find subdict<{}> in {}".format(nextdirname,c_dir))
+                    if DEBUG: log.debug("<DIVE> ERROR! Cannot find subdict<%s> in %s", nextdirname, c_dir)
                     return out 
             else:
                 nextdir = c_dir[nextdirname]
@@ -84,7 +98,7 @@ def _dive(c_list, c_dir, prefix, failzero = False, DEBUG = DEBUG_DEFAULT, full_p
                 # Returns 0
                 out[valname] = 0
             else:
-                if DEBUG: print("<DIVE> ERROR! Cannot find variable<{}>".format(valname))
+                if DEBUG: log.debug("<DIVE> ERROR! Cannot find variable<%s>", valname)
     
     return out
 
@@ -134,7 +148,7 @@ def dotpop(dotloc, original_info):
         if ddir in curr_d:
             curr_d = curr_d.get(ddir)
         else:
-            print("<DOTPOP> WARNING ", ddir,"not found in",original_info)
+            log.warning("<DOTPOP> %s not found in %s", ddir, original_info)
     return False
 
 def add_enh(key, value, ext_dict, subdict_name, topup, enhanced, persist = False, overwrite = False, DEBUG = 0):
@@ -155,18 +169,25 @@ def add_enh(key, value, ext_dict, subdict_name, topup, enhanced, persist = False
         enhanced[subdict_name].update(ext_dict) # Write to the the subdict in enhanced
     return
 
+# Chatbot errors (bad formulae, missing info...) are appended to errorlog.txt, which is rotated by size so it never grows without end.
+# They also go to the normal log. Both are written by the log writer thread (see cb_logging), not by the turn
+def _get_error_journal():
+    global _error_journal
+    with _error_journal_lock:
+        if _error_journal is None:
+            journal = logging.getLogger(ERROR_LOG_NAME)
+            try:
+                handler = RotatingFileHandler(os.path.join(os.getcwd(), ERROR_LOG_FILENAME), maxBytes=ERROR_LOG_MAX_BYTES,
+                                              backupCount=ERROR_LOG_BACKUPS, encoding="utf-8", delay=True)
+                handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+                add_logger_handler(ERROR_LOG_NAME, handler)
+            except Exception as e:
+                log.error("Could not open the error journal: %s", e)
+            _error_journal = journal
+        return _error_journal
+
 def log_error(elog):
-    print("###! ERROR LOG !###",elog)
-    chatbot_directory = os.getcwd()
-    filename = os.path.join(chatbot_directory,"errorlog.txt")
-    
-    try:
-        with open (filename, "w+") as f:
-            prevs = f.read()
-            new = prevs + elog
-            f.write(new)
-    except Exception as e:
-        print("Failed to log error!", e)
+    _get_error_journal().error("###! ERROR LOG !### %s", elog)
     return
 
 
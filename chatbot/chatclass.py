@@ -4,13 +4,17 @@ import chatbot.cbsv as cbsv
 import chatbot.chatbot_be as chatbot_be
 import chatbot.chatbot_utils as cu
 import copy
+import json
 import os
 import re
 import random
 import string
 import logging
+import threading
+import time
 
 from datetime import datetime
+from chatbot.cb_metrics import METRICS
 from chatbot.chatbot_supp import SIP, Understanding, ResponseAction
 from chatbot.chatbot_utils import dive_for_dot_values, dive_for_values, cbround, dotpop, get_yearmonth
 
@@ -19,6 +23,10 @@ DEBUG = 1
 
 DEBUG = DEBUG or SUPER_DEBUG
 
+SNAPSHOT_VERSION = 1
+
+log = logging.getLogger(__name__)
+
 # A conversation thread manager using stack and dict
 class StateThreader():
     def __init__(self, default_state):
@@ -39,7 +47,7 @@ class StateThreader():
     def _get_threadID(self, state):
         tid = state.get("thread","")
         if tid == "":
-            print("<GET THREADID> State has no thread", state)
+            log.error("<GET THREADID> State has no thread %s", state)
             raise Exception("THREAD ID EXCEPTION")
         return tid
 
@@ -49,7 +57,7 @@ class StateThreader():
 
     def _thread_same_state(self, nstate):
         # print("new vs old", nstate, self.get_curr_thread_state())
-        if DEBUG: print("StateThreader samestate:",self.get_curr_thread()._is_same_state(nstate))
+        log.debug("StateThreader samestate: %s", self.get_curr_thread()._is_same_state(nstate))
         return self.get_curr_thread()._is_same_state(nstate)
 
     def _thread_same_id(self, tid):
@@ -74,7 +82,7 @@ class StateThreader():
             self.threadmap.pop(deadthreadID)
 
             new_headID = self.threadIDstack[-1]
-            if DEBUG : print("KILLING THREAD:",deadthreadID,"NEW HEAD:",new_headID)
+            log.debug("KILLING THREAD: %s NEW HEAD: %s", deadthreadID, new_headID)
 
     def switch_thread_to(self, threadID):
         # Push to front of stack
@@ -119,17 +127,45 @@ class StateThreader():
     def set_thread_pending(self, hs, ps):
         self.get_curr_thread().set_pending_state(hs,ps)
 
+    def has_pending_in(self, threadID):
+        thrd = self.threadmap.get(threadID)
+        return thrd is not None and thrd.has_pending_state()
+
     # If has pending, returns pending
     # If nothing pending, returns given_next_state
     def move_forward(self, given_next_state):
         if self.get_curr_thread().has_pending_state():
-            if DEBUG: print("Unlocking...")
+            log.debug("Unlocking...")
             self.get_curr_thread().unlock_pending_state()
             self.state_changed = True
         else:
             self.state_changed = self.update_thread_state(given_next_state)
         return self.get_curr_thread_state()
 
+    # Compact form for snapshots. state_ref turns a state object into something small (see PolicyKeeper.state_to_ref)
+    # Thread histories are not kept
+    def dump_compact(self, state_ref):
+        threads = {}
+        for tid, thrd in self.threadmap.items():
+            entry = [state_ref(thrd.get_curr_state())]
+            if thrd.has_pending_state():
+                entry.append(state_ref(thrd.get_pending_state()))
+            threads[tid] = entry
+        out = {"k": self.threadIDstack, "t": threads}
+        if not self.state_changed:
+            out["c"] = 0
+        return out
+
+    def load_compact(self, compact, ref_state):
+        self.threadIDstack = list(compact["k"])
+        self.threadmap = {}
+        for tid, entry in compact["t"].items():
+            thrd = ConvoThread(ref_state(entry[0]))
+            if len(entry) > 1:
+                thrd.pend_state = ref_state(entry[1])
+            self.threadmap[tid] = thrd
+        self.state_changed = bool(compact.get("c", 1))
+
 # A conversation thread
 # Tracks state
 class ConvoThread:
@@ -167,9 +203,9 @@ class ConvoThread:
 
     def set_pending_state(self, holdstate, pstate):
         if self.has_pending_state():
-            if DEBUG: print("<ConvoThread> Existing pend state:{} new:{}".format(self.get_pending_state(), pstate))
+            log.debug("<ConvoThread> Existing pend state:%s new:%s", self.get_pending_state(), pstate)
             return
-        if DEBUG: print("<ConvoThread> Setting pending state:",pstate)
+        log.debug("<ConvoThread> Setting pending state: %s", pstate)
         self.pend_state = pstate
         self.update_state(holdstate)
         return
@@ -213,20 +249,23 @@ class ZoneTracker:
 
 # Coordinates everything about a chat
 class ChatManager:
-    def __init__(self, chat, calc, iparser, pkeeper, replygen, dmanager, gkeeper):
+    # lookup_user = False skips the database lookup. Used when the chat is restored from a saved session
+    def __init__(self, chat, calc, iparser, pkeeper, replygen, dmanager, gkeeper, lookup_user = True):
         # Internal properties
         self.chat = chat
         self.chatID = self.chat.getID()
         self.samestateflag = False
         self.active = True
+        self.lock = threading.Lock() # Held for a turn. Backups take it too, so they never see a chat halfway through one
 
         # Helper classes
         self.calculator = calc
         self.iparser = iparser
         self.pkeeper = pkeeper
         self.replygen = replygen
-        self.dmanager = dmanager.clone(self.chatID)
+        self.dmanager = dmanager.clone(self.chatID, lookup_user = lookup_user)
         self.gatekeeper = gkeeper
+        self.gate_ctx = gkeeper.new_context() # Gatekeeper working values for this chat
         self.statethreader = StateThreader(pkeeper.GET_INITIAL_STATE())
         self.ztracker = ZoneTracker()
         self.INFORM_INT = pkeeper.GET_INFORM_INTENT() # TODO Not very good OOP
@@ -254,26 +293,42 @@ class ChatManager:
             no_reply = ""
             return (no_reply, {}, self._get_current_info())
 
-        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~&") # For clarity in terminal     
-        print("<RESPOND TO MESSAGE> Message recieved: ",msg)
+        log.debug("<RESPOND TO MESSAGE> Message recieved: %s", msg)
+        # Stage timings go to /metrics, see cb_metrics.py
+        t0 = time.perf_counter()
         uds, NLP_bd, nums = self._policykeeper_parse(msg)
+        t1 = time.perf_counter()
+        METRICS.observe("policykeeper_parse", t1 - t0)
         
         self.goto_next_state(uds, msg, nums)
         
+        t2 = time.perf_counter()
         calc_ext_dict = self._calculate()
+        t3 = time.perf_counter()
+        METRICS.observe("calculate", t3 - t2)
         r_action, topup = self._fetch_reply(uds,calc_ext_dict)
         reply = r_action.get_replytext()
+        t4 = time.perf_counter()
+        METRICS.observe("fetch_reply", t4 - t3)
 
         self._record_messages_in_chat(msg, reply)
 
+        t5 = time.perf_counter()
         self._post_process(uds, topup)
+        t6 = time.perf_counter()
+        METRICS.observe("post_process", t6 - t5)
+        METRICS.observe("turn", t6 - t0)
+        METRICS.count("turns")
 
         curr_info = self._get_current_info()
-        if op_print: print("回复: \r\n'{}' \r\n智能理解:\r\n{} \r\n信息:{}".format(r_action.tostring(), NLP_bd, curr_info)) # Operational Printout
+        if op_print and log.isEnabledFor(logging.INFO):
+            log.info("回复: \r\n'%s' \r\n智能理解:\r\n%s \r\n信息:%s", r_action.tostring(), NLP_bd, curr_info) # Operational Printout
         return (r_action, NLP_bd, curr_info)
 
     # Decides which state to advance to next.
-    # Contains a loop to handle traversing several crossroads seamlessly
+    # Contains a loop to handle traversing several crossroads seamlessly.
+    # Crossroads cannot form cycles (checked at load, see crossroad_closure) so it ends after at most PolicyKeeper.MAX_XROAD_HOPS crossroads
+    # and one retry of the gate
     def goto_next_state(self, understanding, msg, nums):
         sip = understanding.get_sip()
 
@@ -285,8 +340,10 @@ class ChatManager:
         trigger_repeat = False
         gate_repeat = False
         count = 0
+        max_repeats = self.pkeeper.MAX_XROAD_HOPS + 1
         while True:
-            print("<GOTO NEXT STATE> stateobj:", d_state_obj.get("key"))
+            t_iter = time.perf_counter()
+            log.debug("<GOTO NEXT STATE> stateobj: %s", d_state_obj.get("key"))
             # Gatekeeper reqs
             self._get_slots_from_state(d_state_obj)
             # Parse for slots
@@ -306,11 +363,15 @@ class ChatManager:
                 trigger_repeat = True
 
             trigger_repeat = crossroad_traverse or trigger_repeat
-            if trigger_repeat and count < 10:
+            METRICS.observe("goto_next_state_iteration", time.perf_counter() - t_iter)
+            if trigger_repeat and count < max_repeats:
                 trigger_repeat = False
-                print("<GOTO NEXT STATE> REPEATING", d_state_obj, "count", count)
+                log.debug("<GOTO NEXT STATE> REPEATING %s count %s", d_state_obj, count)
+                METRICS.count("crossroad_repeats")
                 count += 1
                 continue
+            if trigger_repeat:
+                log.warning("<GOTO NEXT STATE> Stopped after %s repeats, next state was %s", count, d_state_obj.get("key"))
             break
         return
 
@@ -323,13 +384,14 @@ class ChatManager:
     # Clears the specified slots
     def _general_preprocess(self, sip):
         clearlist = sip.get_pre_clears()
-        print("<PREPROCESSING>", sip.toString(), "THINGS TO CLEAR:", clearlist)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("<PREPROCESSING> %s THINGS TO CLEAR: %s", sip.toString(), clearlist)
         self.push_detail_to_clear(clearlist)
 
     # Also converts samestate SIP to a state obj
     def _sip_to_stateobj(self, sip):
         if sip.is_same_state():
-            if DEBUG: print("<REACTION> SAME STATE FLAGGED")
+            log.debug("<REACTION> SAME STATE FLAGGED")
             self.samestateflag = True
             stateobj = self._get_curr_state()
         else:
@@ -349,7 +411,7 @@ class ChatManager:
 
         stateobj = self._sip_to_stateobj(sip)
         
-        if DEBUG: print("<REACTION> Curr state", self._get_curr_state()["key"], "Nxt stateobj", stateobj["key"])
+        log.debug("<REACTION> Curr state %s Nxt stateobj %s", self._get_curr_state()["key"], stateobj["key"])
         
         # Check if current target state is in a zone_policy crossroad 
         ow_flag, stateobj = self._xroad_policy_overwrite(stateobj)
@@ -367,12 +429,12 @@ class ChatManager:
         self.statethreader.move_forward(state)
 
     def _get_slots_from_state(self, stateobj):
-        self.gatekeeper.scan_state_obj(stateobj, self._get_current_info())
+        self.gatekeeper.scan_state_obj(self.gate_ctx, stateobj, self._get_current_info())
 
     def _try_gatekeeper_gate(self):
         curr_info = self._get_current_info()
         if SUPER_DEBUG: print("<CHAT MGR TRY GATE> Current info:",curr_info)
-        pf, rs = self.gatekeeper.try_gate(curr_info)
+        pf, rs = self.gatekeeper.try_gate(self.gate_ctx, curr_info)
         return (pf, rs)
 
     # CHANGES STATE
@@ -387,7 +449,7 @@ class ChatManager:
         
         passed, req_slots = self._try_gatekeeper_gate()
 
-        if DEBUG: print("Gate passed:",passed)
+        log.debug("Gate passed: %s", passed)
 
         if passed:
             self._move_forward_state(nextstate)
@@ -400,11 +462,26 @@ class ChatManager:
 
         return passed
 
-    # Overwrites state if currently in zone policy aka crossroad
+    # Overwrites state if currently in zone policy aka crossroad.
+    # Open crossroads on the way (see open_crossroads) are decided right away on the same info instead of on the next pass of goto_next_state.
+    # Only in the current thread and with nothing pending there, so skipping the stop leaves the threads as the stop would have
     def _xroad_policy_overwrite(self, og_nxt_state):
+        def can_pass(state):
+            if not self.pkeeper.is_open_crossroad(state):
+                return False
+            thread = state["thread"]
+            return thread == self.statethreader.get_curr_threadID() and not self.statethreader.has_pending_in(thread)
+
         csk = self._get_csk()
         info = self._get_current_info()
         overwrite_flag, ow_state = self.pkeeper.xroad_policy_overwrite(csk,info)
+        while overwrite_flag and can_pass(ow_state):
+            passed, next_state = self.pkeeper.xroad_policy_overwrite(ow_state["key"], info)
+            if not passed:
+                break
+            log.debug("<XROAD POL OVERWRITE> Went through %s", ow_state["key"])
+            METRICS.count("crossroads_passed")
+            ow_state = next_state
         if overwrite_flag:
             next_state = ow_state
         else:
@@ -415,7 +492,7 @@ class ChatManager:
     def push_req_slots_to_dm(self, required_slots):
         if len(required_slots) > 0:
             required_info = list(map(lambda x: x[0],required_slots)) # First element
-            print("pushslotstodm Reqinfo",required_info)
+            log.debug("pushslotstodm Reqinfo %s", required_info)
             info_entry = {"requested_info": required_info}
             self.push_detail_to_dm(info_entry)
         return
@@ -428,7 +505,7 @@ class ChatManager:
         info["calc_ext"] = calc_ext #Add calc ext to the info to be passed in
 
         curr_state = self._get_curr_state()
-        if DEBUG: print("<Fetch Reply> Current State",curr_state.get("key","unknown"))
+        log.debug("<Fetch Reply> Current State %s", curr_state.get("key","unknown"))
         ssflag = self.samestateflag
         return self.replygen.get_reply(curr_state, intent, ssflag, info)
 
@@ -443,7 +520,7 @@ class ChatManager:
 
     # Asks iparser to parse the message
     def _parse_message_details(self, msg, intent, nums):
-        slots = self.gatekeeper.get_slots() # Only look out for what is needed
+        slots = self.gatekeeper.get_slots(self.gate_ctx) # Only look out for what is needed
         details = self.iparser.parse(msg, slots, intent)
 
         # Append parsed number to details
@@ -487,9 +564,9 @@ class ChatManager:
         return 
 
     def read_chat_history(self, history_list):
-        if DEBUG: print("Reading chat history")
+        log.debug("Reading chat history")
         hist_info = self.iparser.parse_chat_history(history_list)
-        print("<HISTORY> Info obtained:", hist_info)
+        log.debug("<HISTORY> Info obtained: %s", hist_info)
         self.dmanager.log_detail(hist_info, OVERWRITE=0)
         return
 
@@ -497,7 +574,7 @@ class ChatManager:
     # Updates slot values
     def _gatekeeper_preprocess(self):
         curr_info = self._get_current_info()
-        gk_topup = self.gatekeeper.preprocess(curr_info) # Fill default slot values AFTER parsing
+        gk_topup = self.gatekeeper.preprocess(self.gate_ctx, curr_info) # Fill default slot values AFTER parsing
         self.push_detail_to_dm(gk_topup, ow=0)
         return
 
@@ -510,17 +587,141 @@ class ChatManager:
         self.chat.record_to_database()
         return
 
+    ### Snapshots
+    # Everything that belongs to this chat alone, as compact versioned JSON bytes.
+    # States are stored by name, and only info that differs from a new chat is kept.
+    # The shared helper classes and the chat log are left out.
+    def snapshot(self):
+        snap = {
+            "v": SNAPSHOT_VERSION,
+            "t": self.statethreader.dump_compact(self.pkeeper.state_to_ref),
+        }
+        info = self.dmanager.get_snapshot_info()
+        if info:
+            snap["i"] = info
+        gate_slots = self.gate_ctx.get_slots()
+        if self.gate_ctx.gate_closed or gate_slots:
+            snap["g"] = [int(self.gate_ctx.gate_closed), gate_slots]
+        if self.samestateflag:
+            snap["s"] = 1
+        if not self.active:
+            snap["a"] = 0
+        return json.dumps(snap, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    # Loads a snapshot into this ChatManager. Meant for one made with lookup_user = False
+    def restore(self, data):
+        snap = json.loads(data.decode("utf-8"))
+        version = snap.get("v")
+        if not version == SNAPSHOT_VERSION:
+            raise Exception("<RESTORE> Unknown snapshot version {}".format(version))
+
+        self.statethreader.load_compact(snap["t"], self.pkeeper.ref_to_state)
+        self.dmanager.load_snapshot_info(snap.get("i", {}))
+        closed, gate_slots = snap.get("g", [0, []])
+        self.gate_ctx = self.gatekeeper.new_context()
+        self.gate_ctx.gate_closed = bool(closed)
+        self.gate_ctx.slots = gate_slots
+        self.gate_ctx.requirements = [slot[0] for slot in gate_slots]
+        self.samestateflag = bool(snap.get("s", 0))
+        self.active = bool(snap.get("a", 1))
+        self.ztracker.update_zones_from_dm(self.dmanager)
+        return
+
+# Flattens the Policies into {(state key, intent key): SIP} so finding the next state is one dict lookup.
+# A state's own rules come before the default set and the first rule for an intent wins, same as scanning Policy.get_intents()
+def compile_transitions(policy_rules):
+    transitions = {}
+    for state_key, policy in policy_rules.items():
+        for intent_lst in policy.get_intents():
+            for intent_key, next_sip in intent_lst:
+                transitions.setdefault((state_key, intent_key), next_sip)
+    return transitions
+
+# Turns the crossroad policies ({state key: [detail name, {detail value: state name, "DEFAULT": state name}]}) into decision tables
+# {state key: (detail name, {detail value: state obj}, default state obj or None)} so a crossroad is decided with one dict lookup
+def compile_crossroads(crossroad_policies, state_lib):
+    state_keys = {state["key"] for state in state_lib.values()}
+    tables = {}
+    for xroad, (detail_name, branches) in crossroad_policies.items():
+        if not xroad in state_keys:
+            raise Exception("Crossroad policy for a state that does not exist: <{}>".format(xroad))
+        paths = {}
+        for detail_value, destination_state in branches.items():
+            if not destination_state in state_lib:
+                raise Exception("Illegal state in policy <{}>: {}->{}".format(xroad, detail_value, destination_state))
+            paths[detail_value] = state_lib[destination_state]
+        default_state = paths.pop("DEFAULT", None)
+        tables[xroad] = (detail_name, paths, default_state)
+    return tables
+
+def _crossroad_destinations(table):
+    detail_name, paths, default_state = table
+    out = list(paths.values())
+    if default_state is not None:
+        out.append(default_state)
+    return out
+
+# Which crossroads each crossroad can lead to, directly or through others: {state key: tuple of crossroad state keys}.
+# A crossroad that can lead back to itself would send the chat around forever, so that raises here instead of at runtime
+def crossroad_closure(xroad_tables):
+    closure = {}
+    def visit(xroad, path):
+        if xroad in closure:
+            return closure[xroad]
+        if xroad in path:
+            cycle = path[path.index(xroad):] + [xroad]
+            raise Exception("Crossroad cycle: {}".format(" -> ".join(cycle)))
+        reachable = []
+        for state in _crossroad_destinations(xroad_tables[xroad]):
+            next_xroad = state["key"]
+            if not next_xroad in xroad_tables:
+                continue
+            for r in (next_xroad,) + visit(next_xroad, path + [xroad]):
+                if not r in reachable:
+                    reachable.append(r)
+        closure[xroad] = tuple(reachable)
+        return closure[xroad]
+
+    for xroad in xroad_tables:
+        visit(xroad, [])
+    return closure
+
+# Crossroads a chat can go straight through: no gate or calcs of their own, not terminal, and in the same thread as every state they lead to.
+# Stopping on one would only parse, calculate and decide again on the same info, so the next crossroad can be decided right away
+def open_crossroads(xroad_tables, state_lib):
+    states = {state["key"]: state for state in state_lib.values()}
+    out = set()
+    for xroad, table in xroad_tables.items():
+        state = states[xroad]
+        thread = state.get("thread", "")
+        if state.get("gated") and len(state.get("req_info", [])) > 0:
+            continue
+        if state.get("calcs") or state.get("terminal_state") or thread in ("", "NONE"):
+            continue
+        if all(dest.get("thread") == thread for dest in _crossroad_destinations(table)):
+            out.add(xroad)
+    return out
+
 # Keeps policies
 # Also deciphers messages
 class PolicyKeeper:
-    def __init__(self, policy_rules, crossroad_policies, intent_dict, state_lib, predictor, menu_maps, initial_state_name = "init"):
+    # transitions: compile_transitions(policy_rules), if it was already made. Same for xroad_tables (compile_crossroads)
+    def __init__(self, policy_rules, crossroad_policies, intent_dict, state_lib, predictor, menu_maps, initial_state_name = "init", transitions = None,
+                 xroad_tables = None):
         self.POLICY_RULES = policy_rules
+        self.TRANSITIONS = transitions if transitions is not None else compile_transitions(policy_rules)
         self.XROAD_POLICIES = crossroad_policies
+        self.XROAD_TABLES = xroad_tables if xroad_tables is not None else compile_crossroads(crossroad_policies, state_lib)
+        self.XROAD_CLOSURE = crossroad_closure(self.XROAD_TABLES)
+        self.OPEN_XROADS = open_crossroads(self.XROAD_TABLES, state_lib)
+        # Most crossroads one turn can go through. Entering one and then every crossroad it can lead to, each at most once
+        self.MAX_XROAD_HOPS = max([len(r) + 1 for r in self.XROAD_CLOSURE.values()] + [0])
         self.INTENT_DICT = intent_dict
         self.STATE_DICT = state_lib
         self.MENU_MAPS = menu_maps
         self.predictor = predictor
         self.isn = initial_state_name
+        self.STATE_NAMES = {state["key"]: name for name, state in state_lib.items()} # state key -> name in STATE_DICT
 
     def GET_INITIAL_STATE(self):
         initstate = self.STATE_DICT[self.isn]
@@ -585,12 +786,36 @@ class PolicyKeeper:
         else:
             # Call NLP Model predict
             intent, breakdown, nums = self._freetext_predict(msg)
-            print("<GET UNDERSTANDING> NLP intent:",intent)
+            log.debug("<GET UNDERSTANDING> NLP intent: %s", intent)
 
         # Check intent against background info
         uds = self.intent_to_next_state(csk, intent)
         return uds, breakdown, nums
 
+    # Small reference to a state object for snapshots.
+    # A library state becomes its name. A modified copy (like TMP_recv_info with its req_info) becomes [name, changed fields]
+    def state_to_ref(self, state):
+        name = self.STATE_NAMES.get(state.get("key"))
+        if name is None:
+            return [None, state] # Not from the library. Keep all of it
+        lib_state = self.STATE_DICT[name]
+        if state == lib_state:
+            return name
+        if any(not k in state for k in lib_state):
+            return [None, state]
+        changed = {k: v for k, v in state.items() if not (k in lib_state and lib_state[k] == v)}
+        return [name, changed]
+
+    def ref_to_state(self, ref):
+        if isinstance(ref, str):
+            return self.STATE_DICT[ref].copy()
+        name, fields = ref
+        if name is None:
+            return fields
+        state = self.STATE_DICT[name].copy()
+        state.update(fields)
+        return state
+
     def _create_state_obj(self, skey):
         if not skey in self.STATE_DICT:
             raise Exception("<PolicyKeeper> Illegal state:{}".format(skey))
@@ -599,65 +824,39 @@ class PolicyKeeper:
 
     # METHOD FOR NLP
     def intent_to_next_state(self, curr_state_key, intent):
-        csk = curr_state_key
-        if intent in self.INTENT_DICT:
-            intent_obj = self.INTENT_DICT[intent]
-        else:
-            intent_obj = False
-
-        policy = self.POLICY_RULES[csk]
-        default_null_int = self.INTENT_DICT["no_intent"]
-        uds = Understanding(intent_obj, default_null_int, SIP.same_state())
-        for intent_lst in policy.get_intents():
-            if 0: print("intent_list",list(map(lambda x: x[0],intent_lst)))
-            for pair in intent_lst:
-                c_int, next_sip = pair
-                if intent == c_int:
-                    if SUPER_DEBUG: print("<INTENT MATCH>",intent)
-                    uds = Understanding(intent_obj, intent_obj, next_sip)
-                    return uds
-        return uds
-
+        intent_obj = self.INTENT_DICT.get(intent, False)
+        next_sip = self.TRANSITIONS.get((curr_state_key, intent))
+        if next_sip is None:
+            # No rule for this intent here. Stay
+            return Understanding(intent_obj, self.INTENT_DICT["no_intent"], SIP.same_state())
+        if SUPER_DEBUG: print("<INTENT MATCH>",intent)
+        return Understanding(intent_obj, intent_obj, next_sip)
+
+    # Returns (True, state obj) when csk is a crossroad that sends the chat on given info, else (False, "").
+    # A detail that is missing goes to DEFAULT, and with no DEFAULT the chat stays on the crossroad
     def xroad_policy_overwrite(self, csk, info):
-        def check_zonepolicies(state_key):
-            return state_key in self.XROAD_POLICIES
-
-        def determine_subsequent_sip(curr_info, zpd):
-            detail_name, paths = zpd
-            # Zone policy
-            default_target = paths.get("DEFAULT",None)
-            if detail_name in curr_info:
-                z_val = str(curr_info[detail_name]) # Force value to string
-                if isinstance(z_val, list):
-                    # Subtree
-                    return determine_subsequent_sip(curr_info, z_val)
-                else:
-                    if z_val in paths:
-                        target = paths[z_val]
-                    else:
-                        if SUPER_DEBUG: print("<XROAD POL OVERWRITE> Detail:", detail_name,"Value:", z_val)
-                        target = default_target
-                    next_sip = self._create_state_obj(target)
-                    if SUPER_DEBUG: print("<XROAD POL OVERWRITE> new SIP:",next_sip)
-                    return (True, next_sip)
-            else:
-                # Detail is not in info
-                if SUPER_DEBUG: print("<XROAD POL OVERWRITE> Detail {} not in curr_info: {}".format(detail_name, curr_info))
-                if not default_target is None:
-                    next_sip = self._create_state_obj(default_target)
-                    if SUPER_DEBUG: print("<XROAD POL OVERWRITE> DEFAULT new SIP:",next_sip)
-                    return (True, next_sip)
-
+        log.debug("<XROAD POL OVERWRITE> curr state key: %s", csk)
+        table = self.XROAD_TABLES.get(csk)
+        if table is None:
             return (False, "")
 
-        if DEBUG: print("<XROAD POL OVERWRITE> curr state key:",csk)
+        detail_name, paths, default_state = table
+        if detail_name in info:
+            z_val = str(info[detail_name]) # Force value to string
+            next_state = paths.get(z_val, default_state)
+            if next_state is None:
+                raise Exception("<PolicyKeeper> Crossroad {} has no branch for {}: {}".format(csk, detail_name, z_val))
+            return (True, next_state)
 
-        if check_zonepolicies(csk):
-            zpd = self.XROAD_POLICIES[csk]
-            return determine_subsequent_sip(info,zpd)
-        else:
+        if default_state is None:
+            if SUPER_DEBUG: print("<XROAD POL OVERWRITE> Detail {} not in curr_info: {}".format(detail_name, info))
             return (False, "")
-        
+        return (True, default_state)
+
+    def is_open_crossroad(self, state):
+        return state.get("key") in self.OPEN_XROADS
+
+SERVER_INFO_KEYS = {"state_curr_hour", "state_month", "state_curr_day", "yyyymm"} # Written by DetailManager._update_server_state_info
 
 # MANAGES DETAILS
 class DetailManager:
@@ -694,7 +893,7 @@ class DetailManager:
         return
 
     def log_detail(self, new_info, OVERWRITE = 1, DEBUG = 0):
-        logging.info("New Detail: {}".format(new_info))
+        log.info("New Detail: %s", new_info)
         for d in new_info:
             deet = new_info[d]
             # Check to make sure its not empty
@@ -721,7 +920,7 @@ class DetailManager:
     def clear_details(self, detail_list):
         for d in detail_list:
             if d in self.chat_prov_info:
-                print("<CLEAR DETAIL> Removing empty",d)
+                log.debug("<CLEAR DETAIL> Removing empty %s", d)
                 self.chat_prov_info.pop(d)
         return
 
@@ -748,6 +947,23 @@ class DetailManager:
                 dic[key] = contents
         return dic
     
+    # Chat info for snapshots. Server info is left out because it is recalculated on load
+    def get_snapshot_info(self):
+        out = {}
+        for k, v in self.chat_prov_info.items():
+            if k in SERVER_INFO_KEYS:
+                continue
+            if k == "zones" and v == {}:
+                continue
+            out[k] = v
+        return out
+
+    def load_snapshot_info(self, info):
+        self.chat_prov_info = {"zones": {}}
+        self.chat_prov_info.update(info)
+        self._update_server_state_info()
+        return
+
     # Adds serverside info like date and time.
     # SUPER HARDCODED
     def _update_server_state_info(self):
@@ -778,7 +994,7 @@ class DetailManager:
             elif opr == "+":
                 final = av + bv
             else:
-                print("<SECONDARY SLOT GETV> unknown opr {}".format(opr))
+                log.warning("<SECONDARY SLOT GETV> unknown opr %s", opr)
                 final = av
             final = cbround(final, dp) # Round to specified dp
             if SUPER_DEBUG: print("<SS MINI CALC>", av, opr,bv,"=",final)
@@ -794,7 +1010,7 @@ class DetailManager:
                     final = dive_for_dot_values(branch, info, DEBUG=SUPER_DEBUG, as_val = 1)
                 
                 if final == {}:
-                    if DEBUG: print("<SECONDARY SLOT GETV> {} not found in info".format(branch))
+                    log.debug("<SECONDARY SLOT GETV> %s not found in info", branch)
                     final = ""
                 return final
 
@@ -923,12 +1139,13 @@ class DetailManager:
         return 
 
     # This is called during the creation of a new chat
-    def clone(self, chatID):   
+    def clone(self, chatID, lookup_user = True):   
         self._check_db_init()
         clonetrooper = DetailManager(self.vault, self.second_slots, self.zonelist)
         clonetrooper._set_chatID(chatID)
         clonetrooper.set_runner(self.dbrunner)
-        clonetrooper.check_database_for_user(chatID)
+        if lookup_user:
+            clonetrooper.check_database_for_user(chatID)
         return clonetrooper
 
     def write_info_to_db(self):
@@ -946,15 +1163,14 @@ class ReplyGenerator:
         self.humanizer = humanizer
         self.announcer = announcer
         self.listprinter = listprinter
-        self.hflag = True
         self.default_confused = def_confused
         
     # OVERALL METHOD
     def get_reply(self, curr_state, intent, secondslot, info = -1):
         if SUPER_DEBUG: print("<GET_REPLY> INFO calc_ext:",info.get("calc_ext", {}), "rep_ext", info.get("rep_ext", {}))
-        rdb = self.getreplydb(intent, curr_state, secondslot)
+        rdb, hflag = self.getreplydb(intent, curr_state, secondslot)
         infoplus = self._enhance_info(curr_state, info)
-        r_action, topup = self.generate_reply_message(rdb, curr_state, infoplus)
+        r_action, topup = self.generate_reply_message(rdb, curr_state, infoplus, hflag)
         return r_action, topup
 
     def _enhance_info(self,curr_state,info):
@@ -1087,7 +1303,7 @@ class ReplyGenerator:
         if RF_DEBUG: print("<ENH POST> Enhanced:", enhanced)
         return enhanced
 
-    # Returns the a reply database either from intent or from state
+    # Returns the a reply database either from intent or from state, and whether to humanify it
     def getreplydb(self, intent, curr_state, issamestate):
         def get_hflag(obj):
             # Default is true
@@ -1098,9 +1314,7 @@ class ReplyGenerator:
             if SUPER_DEBUG: print("<replydb> Pulling reply from:", obj["key"])
             return obj["replies"]
     
-        LOCALDEBUG = 0 or DEBUG
-        
-        if LOCALDEBUG: print("<REPLYDB> Curr State:", curr_state["key"], "Thread", curr_state["thread"])
+        log.debug("<REPLYDB> Curr State: %s Thread %s", curr_state["key"], curr_state["thread"])
 
         # Decides priority of lookup. 
         # If same state flagged, look at intents first
@@ -1108,6 +1322,7 @@ class ReplyGenerator:
         lookups = [intent, curr_state] if issamestate else [curr_state, intent]
 
         rdb = []
+        hflag = True
         # Retrieves the intent object from lookup
         for obj in lookups:
             if obj == cbsv.NO_INTENT():
@@ -1116,22 +1331,22 @@ class ReplyGenerator:
 
             if rdb == []:
                 rdb = get_replylist(obj) # this may be [] as well
-                self.hflag = get_hflag(obj)
+                hflag = get_hflag(obj)
             else:
                 break
 
         if rdb == []: rdb = self.default_confused # In case really no answer. Not to be confused with intentionally blank answers.
 
-        return rdb
+        return rdb, hflag
 
     # Takes in the replydatabase, current_state_obj, info
     # Returns a ResponseAction
-    def generate_reply_message(self, rdb, curr_state, info):
+    def generate_reply_message(self, rdb, curr_state, info, hflag = True):
         def rand_response(response_list):
             return random.choice(response_list)
 
         def _humanify(msg):
-            if not self.hflag:
+            if not hflag:
                 # Do nothing
                 return msg 
             return self.humanizer.humanify(msg,info)
@@ -1143,7 +1358,7 @@ class ReplyGenerator:
             return msg.replace("<>", "\r\n")
 
         reply_template = rand_response(rdb)
-        if DEBUG: print("<GEN REPLY> Template:",reply_template)
+        log.debug("<GEN REPLY> Template: %s", reply_template)
         if SUPER_DEBUG: print("<GEN REPLY> Enhanced info:",info)
         
         # Pre-enhancement additions to base template
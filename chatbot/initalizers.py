@@ -4,9 +4,11 @@ import logging
 
 from chatbot.cbsv import read_json
 from chatbot.chatbot_supp import SIP, Policy, InfoVault, InfoParser, ReqGatekeeper, Humanizer, Calculator, Announcer, ListPrinter
-from chatbot.chatclass import DetailManager, ReplyGenerator, PolicyKeeper
+from chatbot.chatclass import DetailManager, ReplyGenerator, PolicyKeeper, compile_transitions, compile_crossroads, crossroad_closure
 from chatbot.regex_predictor import Regex_Predictor
 
+log = logging.getLogger(__name__)
+
 def init_calculator(jdata):
     formulae = jdata["formulae"]
     return Calculator(formulae)
@@ -46,16 +48,21 @@ def init_policykeeper(jdata, pdata):
     def default_target_state(intent):
         return intent["default_target"]
 
+    sip_cache = {} # destination -> SIP. Every rule going to the same place shares one SIP
     # In: list of [current_state, destination]
     # To create the classmethod SIPs
     def create_policy_tuple(pair):
         state, destination = pair
         if len(destination) < 4:
             name = INTENTS[state]["key"]
-            print("Warning! {} has bad destination: {}".format(name,destination))
-            target_state = SIP.same_state()
+            log.warning("%s has bad destination: %s", name, destination)
+            destination = "SAME_STATE"
+
+        target_state = sip_cache.get(destination)
+        if target_state is not None:
+            return (state, target_state)
 
-        elif destination == "SAME_STATE":
+        if destination == "SAME_STATE":
             target_state = SIP.same_state()
         # elif destination == "GO_BACK_STATE": # TODO: See if this feature is needed or not
         #     target_state = SIP.go_back_state()
@@ -63,6 +70,7 @@ def init_policykeeper(jdata, pdata):
             target_state = SIP.exit_pocket()
         else:
             target_state = SIP(STATES[destination])
+        sip_cache[destination] = target_state
 
         return (state, target_state)
 
@@ -77,12 +85,17 @@ def init_policykeeper(jdata, pdata):
                 out.append(create_policy_tuple(pair))
         return out
     
-    def check_xroad_policies(p, state_dict):
-        for xroad, contents in p.items():
-            relevant_detail, branches = contents
-            for detail_value, destination_state in branches.items():
-                if not destination_state in state_dict:
-                    raise Exception("Illegal state in policy <{}>: {}->{}".format(xroad, detail_value, destination_state))
+    # A crossroad that no rule, default intent or other crossroad goes to never gets to decide anything
+    def check_xroads_reachable(xroad_tables, transitions, initial_state_name):
+        reached = {STATES[initial_state_name]["key"]}
+        reached.update(sip.get_state_key() for sip in transitions.values() if not sip.is_same_state())
+        for detail_name, paths, default_state in xroad_tables.values():
+            reached.update(state["key"] for state in paths.values())
+            if default_state is not None:
+                reached.add(default_state["key"])
+        for xroad in xroad_tables:
+            if not xroad in reached:
+                log.warning("Crossroad %s is unreachable, nothing leads to it", xroad)
         return
 
     policy_rules = pdata["policy_rules"] # This is true for now. Might change
@@ -124,13 +137,17 @@ def init_policykeeper(jdata, pdata):
             continue # Don't overwrite existing policy lookup values
         POLICY_RULES[k] = make_policy([])
 
+    TRANSITIONS = compile_transitions(POLICY_RULES)
+
+    initial_state_name = pdata.get("initial_state", "init") # DEFAULTS TO INIT
+
     try:
         XROAD_POLICIES = pdata["crossroad_policies"]
-        check_xroad_policies(XROAD_POLICIES, STATES)
+        XROAD_TABLES = compile_crossroads(XROAD_POLICIES, STATES)
+        crossroad_closure(XROAD_TABLES) # Raises on a cycle
     except Exception as e:
         raise Exception("Init exception! {}".format(e))
-    
-    initial_state_name = pdata.get("initial_state", "init") # DEFAULTS TO INIT
+    check_xroads_reachable(XROAD_TABLES, TRANSITIONS, initial_state_name)
 
     menu_map = pdata.get("menu_maps", []) # This is using get because it is optional
 
@@ -139,7 +156,8 @@ def init_policykeeper(jdata, pdata):
 
     pp = Regex_Predictor() # This is functionally a Dud
 
-    return PolicyKeeper(POLICY_RULES, XROAD_POLICIES, INTENTS, STATES, pp, menu_map, initial_state_name=initial_state_name)
+    return PolicyKeeper(POLICY_RULES, XROAD_POLICIES, INTENTS, STATES, pp, menu_map, initial_state_name=initial_state_name,
+                        transitions=TRANSITIONS, xroad_tables=XROAD_TABLES)
 
 def init_replygen(jdata, inf):
     def _init_listprinter(info):
@@ -166,7 +184,7 @@ def master_initalize(resource_filename = "chatbot_resource.json"):
     # MATCH_DB = jdata["match_db"]
     direct = os.path.dirname(os.path.realpath(__file__)) # Not using cwd because this is called from another directory
 
-    logging.info("<master initalize> reading from " + resource_filename)
+    log.info("<master initalize> reading from %s", resource_filename)
     jdata_filepath = os.path.join(direct,resource_filename)
     jdata = read_json(jdata_filepath)
     pr_filepath = os.path.join(direct,jdata["policy_data_location"])
@@ -182,4 +200,90 @@ def master_initalize(resource_filename = "chatbot_resource.json"):
     components["pkeeper"] = init_policykeeper(jdata,pdata)
     components["replygen"] = init_replygen(jdata,sideinfo)
 
-    return components
\ No newline at end of file
+    return components
+
+# The old scan of the Policies vs the compiled transitions, over every state x intent (and one unknown intent)
+def run_policy_benchmark(resource_filename = "wechat_chatbot_resource.json", rounds = 200):
+    import time
+    from chatbot.chatbot_supp import Understanding
+
+    pkeeper = master_initalize(resource_filename)["pkeeper"]
+
+    # intent_to_next_state before the table
+    def scan_intent_to_next_state(csk, intent):
+        intent_obj = pkeeper.INTENT_DICT[intent] if intent in pkeeper.INTENT_DICT else False
+        uds = Understanding(intent_obj, pkeeper.INTENT_DICT["no_intent"], SIP.same_state())
+        for intent_lst in pkeeper.POLICY_RULES[csk].get_intents():
+            for c_int, next_sip in intent_lst:
+                if intent == c_int:
+                    return Understanding(intent_obj, intent_obj, next_sip)
+        return uds
+
+    cases = [(csk, intent) for csk in pkeeper.POLICY_RULES for intent in list(pkeeper.INTENT_DICT) + ["not_an_intent"]]
+    for csk, intent in cases:
+        old, new = scan_intent_to_next_state(csk, intent), pkeeper.intent_to_next_state(csk, intent)
+        assert old.get_intent() is new.get_intent() and old.get_orig_intent() is new.get_orig_intent(), (csk, intent)
+        assert old.get_sip() is new.get_sip() or (old.get_sip().is_same_state() and new.get_sip().is_same_state()), (csk, intent)
+
+    for label, fn in (("scan", scan_intent_to_next_state), ("table", pkeeper.intent_to_next_state)):
+        start = time.perf_counter()
+        for i in range(rounds):
+            for csk, intent in cases:
+                fn(csk, intent)
+        print("{:<5} {:6.2f}us a lookup".format(label, (time.perf_counter() - start) / (rounds * len(cases)) * 1e6))
+    sips = {id(sip) for sip in pkeeper.TRANSITIONS.values()}
+    print("{} states x {} intents: {} transitions sharing {} SIPs".format(
+        len(pkeeper.POLICY_RULES), len(pkeeper.INTENT_DICT), len(pkeeper.TRANSITIONS), len(sips)))
+
+# The old walk of the crossroad policies vs the decision tables, for every branch of every crossroad plus a missing and an unknown value
+def run_crossroad_benchmark(resource_filename = "wechat_chatbot_resource.json", rounds = 2000):
+    import time
+
+    pkeeper = master_initalize(resource_filename)["pkeeper"]
+    xlog = logging.getLogger("chatbot.chatclass")
+
+    # xroad_policy_overwrite before the tables
+    def walk_xroad_policy_overwrite(csk, info):
+        def determine_subsequent_sip(curr_info, zpd):
+            detail_name, paths = zpd
+            default_target = paths.get("DEFAULT", None)
+            if detail_name in curr_info:
+                z_val = str(curr_info[detail_name])
+                target = paths[z_val] if z_val in paths else default_target
+                return (True, pkeeper._create_state_obj(target))
+            if not default_target is None:
+                return (True, pkeeper._create_state_obj(default_target))
+            return (False, "")
+
+        xlog.debug("<XROAD POL OVERWRITE> curr state key: %s", csk)
+        if csk in pkeeper.XROAD_POLICIES:
+            return determine_subsequent_sip(info, pkeeper.XROAD_POLICIES[csk])
+        return (False, "")
+
+    cases = [("init", {})]
+    for xroad, (detail_name, paths) in pkeeper.XROAD_POLICIES.items():
+        cases.append((xroad, {}))
+        values = list(paths) + (["not_a_value"] if "DEFAULT" in paths else [])
+        cases.extend((xroad, {detail_name: value}) for value in values)
+    for csk, info in cases:
+        old, new = walk_xroad_policy_overwrite(csk, info), pkeeper.xroad_policy_overwrite(csk, info)
+        assert old[0] == new[0] and old[1] is new[1], (csk, info)
+
+    for label, fn in (("walk", walk_xroad_policy_overwrite), ("table", pkeeper.xroad_policy_overwrite)):
+        start = time.perf_counter()
+        for i in range(rounds):
+            for csk, info in cases:
+                fn(csk, info)
+        print("{:<5} {:6.2f}us a crossroad".format(label, (time.perf_counter() - start) / (rounds * len(cases)) * 1e6))
+    print("{} crossroads, at most {} in one turn. Open: {}".format(
+        len(pkeeper.XROAD_TABLES), pkeeper.MAX_XROAD_HOPS, sorted(pkeeper.OPEN_XROADS)))
+    for xroad, reachable in sorted(pkeeper.XROAD_CLOSURE.items()):
+        if reachable:
+            print("  {} -> {}".format(xroad, ", ".join(reachable)))
+
+if __name__ == "__main__":
+    from sys import argv
+
+    # python -m chatbot.initalizers [resource file]
+    run_policy_benchmark(*argv[1:2])
+    run_crossroad_benchmark(*argv[1:2])
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import time
+
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+
+from http_capture import BUSY_ACTION, CACHED_ACTION, TrafficCapture
+from http_files_utils import StaticFiles
+from http_reply_cache import Uncached, reply_cache_key
+from chatbot.cb_logging import SERVER_LOG_LEVELS, setup_logging, stop_logging
+from chatbot.cb_metrics import METRICS
+from http_server import ChatbotServer, DEFAULT_PORT, METRICS_PATH, register_metrics, start_chatbot
+from http_utils import DECODE_ERRORS, MAX_BODY_BYTES, decode_post
+from http_wx_xml import busy_reply
+
+# asyncio front end for the WeChat public account.
+# Same GET/POST semantics as http_server.ChatbotServer (echo auth, openid callback, redir, XML replies)
+# and the same Chatbot, RequestBoss, per-user locks and reply cache, which live on the ChatbotServer class.
+# The event loop only does socket work. Anything that can block (bot turns, WeChat API calls) runs in a bounded executor,
+# so thousands of idle keep-alive connections from the WeChat proxies cost a socket each and nothing else.
+
+DEFAULT_WORKERS = 8 # Threads running bot turns
+DEFAULT_MAX_PENDING = 256 # Turns allowed to wait for a worker before new requests wait on the loop
+KEEPALIVE_TIMEOUT = 75 # Seconds an idle connection is kept open
+
+INDEX_PAGE_PATH = "/index.html"
+
+log = logging.getLogger("http_async_server") # Named, not __name__, so it is the same when run as __main__
+
+class AsyncChatbotFrontend:
+    def __init__(self, workers = DEFAULT_WORKERS, max_pending = DEFAULT_MAX_PENDING, static_dir = None):
+        if ChatbotServer.chatbot is None:
+            ChatbotServer.chatbot = start_chatbot()
+        self.chatbot = ChatbotServer.chatbot
+        self.rb = ChatbotServer.rb
+        self.rb.start_jobs()
+        register_metrics(ChatbotServer)
+        self.user_locks = ChatbotServer.user_locks
+        self.reply_cache = ChatbotServer.reply_cache
+        self.late_replies = ChatbotServer.late_replies
+        self.admission = ChatbotServer.admission
+        self.capture = ChatbotServer.capture
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending
+        self.pending = None # Semaphore. Made when the loop is running
+        self.static_files = StaticFiles(static_dir) if static_dir else ChatbotServer.static_files # Same allowlist as http_server
+
+    # Runs a blocking function on the executor without letting the queue grow past max_pending
+    async def _offload(self, fn, *args):
+        if self.pending is None:
+            self.pending = asyncio.Semaphore(self.max_pending)
+        async with self.pending:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, fn, *args)
+
+    # Blocking. Runs on the executor
+    def _get_bot_response(self, post_info_dict):
+        uid = post_info_dict.get("FromUserName", "")
+        msg = post_info_dict.get("Content", "")
+        log.info("<ASYNC SERVER GET BOT REPLY> USER <%s>:%s", uid, msg)
+        with self.user_locks.hold(uid):
+            return self.chatbot.get_bot_response(uid, msg)
+
+    # Blocking. Runs on the executor. record is the request's capture record or None, see http_capture.py
+    # Returns the encoded reply, or None if the body does not decode
+    def _post_turn(self, post_data_raw, started_at, record = None):
+        t0 = time.perf_counter()
+        try:
+            post_req_info = decode_post(post_data_raw)
+        except DECODE_ERRORS as e:
+            log.warning("Refusing a POST body that does not decode: %s", e)
+            return None
+        METRICS.observe("decode_post", time.perf_counter() - t0)
+
+        release = self.admission.releaser() # Called when the turn ends or is given up on, whichever comes first
+
+        def make_message():
+            if record is not None:
+                METRICS.start_trace()
+            try:
+                response_action = self._get_bot_response(post_req_info)
+                if record is not None:
+                    record["action"] = response_action.action_type
+                return self.rb.build_reply_message(response_action, post_req_info)
+            finally:
+                release() # Held until the turn is done, even if its reply goes out late (but see LateReplyKeeper's turn_timeout)
+                if record is not None:
+                    record["stages"].update(METRICS.stop_trace())
+
+        def answer():
+            uid = post_req_info.get("FromUserName", "")
+            shed_reason = self.admission.acquire(uid)
+            if shed_reason is not None:
+                log.warning("<ADMISSION> Shedding a message from %s: %s", uid, shed_reason)
+                if record is not None:
+                    record["action"] = BUSY_ACTION
+                return Uncached(busy_reply(post_req_info)) # Its retries get another go once there is room
+            return self.late_replies.answer(uid, make_message, started_at, release)
+
+        # WeChat retries get the reply of the first try
+        if record is not None:
+            record["action"] = CACHED_ACTION
+        t1 = time.perf_counter()
+        encoded = self.reply_cache.get_or_compute(reply_cache_key(post_req_info), answer, lambda: busy_reply(post_req_info))
+        t2 = time.perf_counter()
+        METRICS.observe("get_encoded_reply", t2 - t1)
+        if record is not None:
+            record["stages"]["decode_post"] = t1 - t0
+            record["stages"]["get_encoded_reply"] = t2 - t1
+            record["status"] = 200
+            self.capture.add(record, post_req_info)
+        return encoded
+
+    def _default_GET_response(self, request):
+        path = request.path
+        # Empty path = "/"
+        if len(path) <= 1:
+            raise web.HTTPSeeOther(INDEX_PAGE_PATH)
+
+        if "/" in path[1:]:
+            # Don't let people dig around in subdirectories
+            raise web.HTTPNotFound()
+
+        filename = path[1:]
+        asset = self.static_files.get(filename)
+        if asset is None:
+            raise web.HTTPNotFound()
+
+        if ".txt" in path:
+            log.debug("Retrieving file: %s", filename)
+            headers = {
+                "Content-Type": "text",
+                "Content-Disposition": "attachment; filename=%s" % filename
+            }
+            return web.FileResponse(asset.filepath, headers=headers)
+        return web.FileResponse(asset.filepath)
+
+    async def handle_get(self, request):
+        log.debug("GET request for %s", request.path_qs)
+        record = self.capture.sample("GET", request.path_qs)
+        t0 = time.perf_counter()
+        # interpret_get can queue the payment follow up (a file write), so it goes to the executor too
+        reply_flag, response_content = await self._offload(self.rb.interpret_get, request.path_qs, request.headers)
+        if record is None:
+            return self._get_response(request, reply_flag, response_content)
+
+        record["stages"]["interpret_get"] = time.perf_counter() - t0
+        record["action"] = reply_flag
+        try:
+            response = self._get_response(request, reply_flag, response_content)
+            record["status"] = response.status
+            return response
+        except web.HTTPException as e:
+            record["status"] = e.status # Redirects and 404s are raised
+            raise
+        finally:
+            self.capture.add(record)
+
+    def _get_response(self, request, reply_flag, response_content):
+        if reply_flag == "text":
+            log.info("GET response:\n%s", response_content)
+            return web.Response(text=response_content, content_type="text/html")
+
+        elif reply_flag == "redirect":
+            log.info("Redirecting GET request")
+            raise web.HTTPSeeOther(response_content)
+
+        log.debug("<no_action> Calling the default GET response")
+        return self._default_GET_response(request)
+
+    async def handle_post(self, request):
+        started_at = time.time()
+        post_data_raw = await request.read()
+        log.debug("POST request,\nPath: %s\nHeaders:\n%s\n", request.path, request.headers)
+        record = self.capture.sample("POST", request.path_qs)
+        encoded = await self._offload(self._post_turn, post_data_raw, started_at, record)
+        if encoded is None:
+            raise web.HTTPBadRequest()
+        return web.Response(body=encoded, content_type="text/html")
+
+    async def handle_metrics(self, request):
+        body = METRICS.render_prometheus().encode("utf-8")
+        return web.Response(body=body, headers={"Content-Type": "text/plain; version=0.0.4"})
+
+    def make_app(self):
+        app = web.Application(client_max_size=MAX_BODY_BYTES) # Bigger bodies get a 413 before they are read
+        app.router.add_get(METRICS_PATH, self.handle_metrics)
+        app.router.add_get("/{tail:.*}", self.handle_get)
+        app.router.add_post("/{tail:.*}", self.handle_post)
+        app.on_cleanup.append(self._shutdown)
+        return app
+
+    async def _shutdown(self, app):
+        self.executor.shutdown(wait=False)
+        self.capture.stop()
+
+# capture_rate: share of requests (0-1) written to capture.jsonl for replays, see http_capture.py
+def run(port = DEFAULT_PORT, workers = DEFAULT_WORKERS, max_pending = DEFAULT_MAX_PENDING, capture_rate = None):
+    setup_logging(logging.INFO, SERVER_LOG_LEVELS)
+    if capture_rate:
+        ChatbotServer.capture = TrafficCapture(sample_rate=capture_rate)
+    ChatbotServer.capture.start()
+    frontend = AsyncChatbotFrontend(workers=workers, max_pending=max_pending)
+    log.info("Starting async http server on port %s...", port)
+    web.run_app(frontend.make_app(), host="0.0.0.0", port=port, keepalive_timeout=KEEPALIVE_TIMEOUT)
+    log.critical("Stopping async http server...\n")
+    stop_logging()
+
+if __name__ == "__main__":
+    from sys import argv
+
+    # python http_async_server.py [port] [workers] [capture=RATE]
+    port = int(argv[1]) if len(argv) > 1 else DEFAULT_PORT
+    workers = int(argv[2]) if len(argv) > 2 and argv[2].isdigit() else DEFAULT_WORKERS
+    capture_rate = None
+    for arg in argv[2:]:
+        if arg.startswith("capture="):
+            capture_rate = float(arg[len("capture="):])
+    run(port=port, workers=workers, capture_rate=capture_rate)
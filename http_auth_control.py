@@ -1,10 +1,16 @@
 import logging
 import hashlib
+import itertools
 import time
 
 from random import randint
 from http_utils import get_ip_from_header
 from http_customer_manager import CustomerMaster
+from http_expiring import ExpiringMap
+
+log = logging.getLogger(__name__)
+
+AUTH_STATE_TTL = 60 * 60 # Seconds a state_id (and what hangs off it) is kept. The pay link is dead long before
 
 # Takes in dict, api key as string
 # Returns a string
@@ -19,8 +25,7 @@ def get_signature(payload, api_secret_key):
         combined = ""
         for e in elements:
             combined += e
-        
-        print("<SIGNATURE GET COMBINED> COMBINED str output {}".format(combined[:-1]))
+
         return combined[:-1] # Remove the last "&"
 
     def calculate_signature(payload_str, api_key):
@@ -29,25 +34,27 @@ def get_signature(payload, api_secret_key):
         # Hash using MD5
         hashed = hashlib.md5(temp_str.encode())
         signature = hashed.hexdigest().upper()
-        print("SIGNATURE {}".format(signature))
         return signature
 
     payload_str = get_combined(payload)
     return calculate_signature(payload_str, api_secret_key)
 
+_trade_counter = itertools.count()
+
+# Unique per order. The payment queue uses it to spot duplicates, so two orders in the same second must differ
 def get_out_trade_number():
     curr_time = int(time.time())
-    return "OTN" + str(curr_time)[:28]
+    return "OTN" + str(curr_time) + "{:06d}".format(next(_trade_counter) % 1000000)
 
 class AuthController:
     def __init__(self):
-        self.user_state_map = {} # User -> State
-        self.state_user_map = {} # State -> User
-        self.user_callbacks = {}
+        self.user_state_map = ExpiringMap(AUTH_STATE_TTL) # User -> State
+        self.state_user_map = ExpiringMap(AUTH_STATE_TTL) # State -> User
+        self.user_callbacks = ExpiringMap(AUTH_STATE_TTL) # User -> (ResponseAction, POST info)
         self.cust_master = CustomerMaster()
 
     def _state_id_exists(self, state_id):
-        return state_id in self.state_user_map.keys()
+        return state_id in self.state_user_map
 
     def _add_stateid(self, user_ID, sid):
         self.user_state_map[user_ID] = sid
@@ -55,7 +62,7 @@ class AuthController:
 
     def state_id_to_user(self, sid):
         if not self._state_id_exists(sid):
-            logging.error("<state_id to user> state_id {} does not exist".format(sid))
+            log.error("<state_id to user> state_id %s does not exist", sid)
             return False
         return self.state_user_map.get(sid)   
 
@@ -79,9 +86,16 @@ class AuthController:
         self.cust_master.log_open_id(state, openid)
         
 
+    # The code of the openid callback, to be exchanged for the openid off the request path
+    def auth_fetch_code(self, state_id):
+        if not self._state_id_exists(state_id):
+            log.error("<AUTH FETCH CODE> state_id %s does not exist", state_id)
+            return False
+        return self.cust_master.fetch_code(state_id)
+
     def auth_fetch_open_id(self, state_id):
         if not self._state_id_exists(state_id):
-            logging.error("<AUTH FETCH OPEN ID> state_id {} does not exist".format(state_id))
+            log.error("<AUTH FETCH OPEN ID> state_id %s does not exist", state_id)
             return False
         return self.cust_master.fetch_open_id(state_id)
 
@@ -90,13 +104,14 @@ class AuthController:
         return
 
     def pop_callback_info(self, state_id):
-        if not state_id in self.state_user_map.keys():
-            raise Exception("State id {} does not have belong to any user".format(state_id))
         user_ID = self.state_user_map.get(state_id)
+        if user_ID is None:
+            raise Exception("State id {} does not have belong to any user".format(state_id))
     
-        if not user_ID in self.user_callbacks.keys():
+        callback_info = self.user_callbacks.get(user_ID)
+        if callback_info is None:
             raise Exception("User {} does not have callback information".format(user_ID))
-        return self.user_callbacks.get(user_ID)
+        return callback_info
 
     def stash_ip(self, state_id, header_dict):
         ip_addr = get_ip_from_header(header_dict)
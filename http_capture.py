@@ -0,0 +1,215 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# Keeps a sample of the real traffic, to replay it later with http_loadtest.py --replay.
+# Off unless a sample rate is set. The request thread only puts a dict on an in-memory ring (a deque, which takes
+# appends from many threads without a lock). A background thread turns the dicts into JSON lines and writes them out,
+# so capturing never puts disk I/O or JSON encoding on the request path. When the writer falls behind the oldest records are dropped.
+# One line per request:
+#   {"ts": 1700000000.1, "method": "POST", "path": "/", "request": {decoded message}, "action": "text_reply",
+#    "status": 200, "stages": {"decode_post": 0.00001, "turn": 0.0031, ...}}
+# action is the ResponseAction's action_type, or CACHED_ACTION/BUSY_ACTION when the chatbot was not asked.
+# GETs have "request": null and the reply flag of RequestBoss.interpret_get as action.
+# Files are rotated by size like logs: capture.jsonl, capture.jsonl.1, ...
+
+DEFAULT_CAPTURE_FILENAME = "capture.jsonl"
+RING_SIZE = 4096 # Records waiting for the writer
+FLUSH_INTERVAL = 1.0 # Seconds between writes
+MAX_FILE_BYTES = 16 * 1024 * 1024
+BACKUP_COUNT = 3 # Rotated files kept
+
+# What happens to the Content of captured messages (and the query strings of GETs)
+MASK_KEEP = "keep" # Nothing. Only for test accounts
+MASK_SHAPE = "shape" # Same length and kind of characters, but no words or numbers. Menu choices ("1", "12") are kept
+MASK_DROP = "drop" # Emptied
+MENU_CHOICE_MAX_LEN = 2
+
+CACHED_ACTION = "reply_cache" # A retry answered from the reply cache
+BUSY_ACTION = "busy" # Shed by admission control
+
+DIGIT_RE = re.compile(r"\d")
+LATIN_RE = re.compile(r"[A-Za-z]")
+OTHER_RE = re.compile(r"[^\x00-\x7f]")
+
+def mask_content(text, mode = MASK_SHAPE):
+    if mode == MASK_KEEP or not text:
+        return text
+    if mode == MASK_DROP:
+        return ""
+    if len(text) <= MENU_CHOICE_MAX_LEN and text.isdigit():
+        return text
+    return OTHER_RE.sub("某", LATIN_RE.sub("x", DIGIT_RE.sub("0", text)))
+
+class TrafficCapture:
+    METRIC_COUNTERS = ("dropped", "written", "rotations", "write_errors") # Keys of get_metrics that only go up
+
+    def __init__(self, filepath = None, sample_rate = 0.0, mask = MASK_SHAPE, ring_size = RING_SIZE,
+                 max_bytes = MAX_FILE_BYTES, backup_count = BACKUP_COUNT, flush_interval = FLUSH_INTERVAL):
+        self.filepath = filepath or os.path.join(os.getcwd(), DEFAULT_CAPTURE_FILENAME)
+        self.sample_rate = sample_rate
+        self.mask = mask
+        self.ring = deque(maxlen=ring_size)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.user_salt = os.urandom(8) # FromUserNames are hashed, the same way for the life of the process so conversations stay together
+        self.writer = None
+        self.stopping = threading.Event()
+        # Only the writer thread touches these, except dropped which requests bump without a lock (so it can undercount)
+        self.metrics = {"dropped": 0, "written": 0, "rotations": 0, "write_errors": 0}
+
+    def is_enabled(self):
+        return self.sample_rate > 0
+
+    # Starts the writer. Does nothing if capturing is off
+    def start(self):
+        if not self.is_enabled() or self.writer is not None:
+            return
+        self.writer = threading.Thread(target=self._write_loop, name="traffic-capture", daemon=True)
+        self.writer.start()
+        log.info("<CAPTURE> Capturing %.1f%% of requests to %s", self.sample_rate * 100, self.filepath)
+
+    # Writes what is left on the ring
+    def stop(self):
+        if self.writer is None:
+            return
+        self.stopping.set()
+        self.writer.join()
+        self.writer = None
+
+    # Returns a record to fill in for this request if it is sampled, else None.
+    # The record's stages are filled by the server, see ChatbotServer.do_POST
+    def sample(self, method, path):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return {"ts": time.time(), "method": method, "path": path, "request": None, "action": None, "status": None, "stages": {}}
+
+    # Puts a filled in record on the ring. request is the decoded message, it is masked by the writer
+    def add(self, record, request = None):
+        record["request"] = request
+        if len(self.ring) == self.ring.maxlen:
+            self.metrics["dropped"] += 1
+        self.ring.append(record)
+
+    def _mask_request(self, request):
+        masked = {}
+        for key, value in request.items():
+            if key == "xml":
+                continue # Whitespace after <xml>, or the whole body when it was not XML
+            if key == "Content" and isinstance(value, str):
+                value = mask_content(value, self.mask)
+            elif key == "FromUserName" and self.mask != MASK_KEEP and isinstance(value, str):
+                value = "u_" + hashlib.sha1(self.user_salt + value.encode("utf-8")).hexdigest()[:16]
+            masked[key] = value
+        return masked
+
+    # GET query strings carry auth codes and openids
+    def _mask_path(self, path):
+        if self.mask == MASK_KEEP or not "?" in path:
+            return path
+        path, query = path.split("?", 1)
+        keys = [part.split("=", 1)[0] for part in query.split("&") if part]
+        return path + "?" + "&".join(key + "=" for key in keys)
+
+    def _to_line(self, record):
+        record = dict(record)
+        if isinstance(record["request"], dict):
+            record["request"] = self._mask_request(record["request"])
+        record["path"] = self._mask_path(record["path"])
+        stages = dict(record["stages"]) # A turn that went late can still be adding to it
+        record["stages"] = {stage: round(seconds, 6) for stage, seconds in stages.items()}
+        return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def _drain(self):
+        lines = []
+        while True:
+            try:
+                record = self.ring.popleft()
+            except IndexError:
+                break
+            try:
+                lines.append(self._to_line(record))
+            except Exception as e:
+                log.warning("<CAPTURE> Could not encode a record: %s", e)
+        return lines
+
+    def _rotate(self, fp):
+        fp.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            older = "{}.{}".format(self.filepath, i)
+            if os.path.exists(older):
+                os.replace(older, "{}.{}".format(self.filepath, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.filepath, self.filepath + ".1")
+        else:
+            os.remove(self.filepath)
+        self.metrics["rotations"] += 1
+        return open(self.filepath, "ab")
+
+    def _write_loop(self):
+        fp = open(self.filepath, "ab")
+        try:
+            while True:
+                stopping = self.stopping.wait(self.flush_interval)
+                lines = self._drain()
+                try:
+                    for line in lines:
+                        if fp.tell() + len(line) > self.max_bytes and fp.tell() > 0:
+                            fp = self._rotate(fp)
+                        fp.write(line)
+                    fp.flush()
+                    self.metrics["written"] += len(lines)
+                except OSError as e:
+                    self.metrics["write_errors"] += 1
+                    log.error("<CAPTURE> Could not write to %s: %s", self.filepath, e)
+                if stopping:
+                    break
+        finally:
+            fp.close()
+
+    def get_metrics(self):
+        out = self.metrics.copy()
+        out["pending"] = len(self.ring)
+        out["sample_rate"] = self.sample_rate
+        return out
+
+# Cost of capturing on the request path, and a look at what ends up in the file
+def run_benchmark(n = 100000):
+    import tempfile
+
+    request = {"xml": None, "ToUserName": "gh_123456789abc", "FromUserName": "o_user_0001", "CreateTime": "1700000000",
+               "MsgType": "text", "Content": "我在上海，电话13800138000", "MsgId": "1234567890"}
+    filepath = os.path.join(tempfile.mkdtemp(), DEFAULT_CAPTURE_FILENAME)
+    for rate in (0.0, 0.1, 1.0):
+        capture = TrafficCapture(filepath, sample_rate=rate, max_bytes=256 * 1024, ring_size=n)
+        capture.start()
+        start = time.perf_counter()
+        for i in range(n):
+            record = capture.sample("POST", "/")
+            if record is not None:
+                record["stages"]["decode_post"] = 0.00001
+                record["action"] = "text_reply"
+                capture.add(record, request)
+        per_request = (time.perf_counter() - start) / n * 1e6
+        capture.stop()
+        print("sample rate {:4.0%}: {:5.2f}us a request | {}".format(rate, per_request, capture.get_metrics()))
+
+    with open(filepath, encoding="utf-8") as f:
+        line = json.loads(f.readline())
+    assert line["request"]["Content"] == "某某某某某某某00000000000", line
+    assert line["request"]["FromUserName"] != request["FromUserName"] and "xml" not in line["request"], line
+    assert mask_content("1") == "1" and mask_content("abc", MASK_DROP) == ""
+    print(json.dumps(line, ensure_ascii=False))
+
+if __name__ == "__main__":
+    run_benchmark()
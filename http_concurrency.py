@@ -0,0 +1,157 @@
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+from http_expiring import ExpiringMap
+
+# Serializes work per user while letting different users run in parallel.
+# WeChat expects the replies of one subscriber to come back in the order the messages were sent,
+# so every turn for a FromUserName holds that user's lock.
+# Locks are refcounted and dropped once nobody is waiting on them, so the table does not grow with the subscriber count.
+class UserLockTable:
+    def __init__(self):
+        self.table_lock = threading.Lock()
+        self.locks = {} # user_ID -> [lock, refcount]
+
+    def _checkout(self, user_ID):
+        with self.table_lock:
+            entry = self.locks.get(user_ID)
+            if entry is None:
+                entry = [threading.Lock(), 0]
+                self.locks[user_ID] = entry
+            entry[1] += 1
+            return entry[0]
+
+    def _checkin(self, user_ID):
+        with self.table_lock:
+            entry = self.locks[user_ID]
+            entry[1] -= 1
+            if entry[1] == 0:
+                self.locks.pop(user_ID)
+
+    # Usage:
+    #   with user_locks.hold(uid):
+    #       do the turn
+    @contextmanager
+    def hold(self, user_ID):
+        lock = self._checkout(user_ID)
+        lock.acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+            self._checkin(user_ID)
+
+    def active_users(self):
+        with self.table_lock:
+            return len(self.locks)
+
+DEFAULT_MAX_TURNS = 16 # Turns running at once. Keep under http_late_reply.DEFAULT_LATE_WORKERS
+DEFAULT_MAX_PENDING_TURNS = 64 # Turns waiting for a slot. More than that are shed right away
+PENDING_TIMEOUT = 1.0 # Seconds a turn waits for a slot before it is shed. Leaves most of WeChat's 5s for the turn
+USER_RATE = 1.0 # Messages a second one user can keep sending
+USER_BURST = 5 # Messages one user can send at once before USER_RATE applies
+
+SHED_RATE_LIMITED = "rate_limited"
+SHED_QUEUE_FULL = "queue_full"
+SHED_TIMEOUT = "queue_timeout"
+
+# Admission control in front of the chatbot, so a spike makes some users wait or get a "busy" reply
+# instead of making every turn slow.
+#   - at most max_turns turns run, up to max_pending more wait for a slot (first come first served) for pending_timeout
+#   - every user has a token bucket (user_rate a second, user_burst deep) so one chatty FromUserName cannot fill the queue
+# Usage:
+#   reason = admission.acquire(uid)
+#   if reason is not None:
+#       shed (reason is one of the SHED_ values)
+#   else:
+#       try: do the turn
+#       finally: admission.release()
+# A turn that can be let go in two places (it ended, or it ran too long, see LateReplyKeeper) uses
+# release = admission.releaser() and calls release() in both: only the first call gives the slot back.
+class AdmissionControl:
+    METRIC_COUNTERS = ("admitted", "waited", SHED_RATE_LIMITED, SHED_QUEUE_FULL, SHED_TIMEOUT, "shed") # Keys of get_metrics that only go up
+
+    def __init__(self, max_turns = DEFAULT_MAX_TURNS, max_pending = DEFAULT_MAX_PENDING_TURNS, pending_timeout = PENDING_TIMEOUT,
+                 user_rate = USER_RATE, user_burst = USER_BURST):
+        self.max_turns = max_turns
+        self.max_pending = max_pending
+        self.pending_timeout = pending_timeout
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.lock = threading.Lock()
+        self.running = 0
+        self.waiters = deque() # [Event, granted]. A released slot goes straight to the first one
+        # user_ID -> [tokens, last refill]. A bucket left alone long enough to be full again is dropped
+        self.buckets = ExpiringMap(user_burst / user_rate)
+        self.metrics = {"admitted": 0, "waited": 0, SHED_RATE_LIMITED: 0, SHED_QUEUE_FULL: 0, SHED_TIMEOUT: 0, "max_pending_seen": 0}
+
+    # Call with self.lock held. Takes one token from the user's bucket, False if it is empty
+    def _take_token(self, user_ID, now):
+        bucket = self.buckets.get(user_ID)
+        if bucket is None:
+            bucket = [float(self.user_burst), now]
+        tokens = min(self.user_burst, bucket[0] + (now - bucket[1]) * self.user_rate)
+        if tokens < 1:
+            return False
+        self.buckets[user_ID] = [tokens - 1, now]
+        return True
+
+    # Returns None when the turn may run (call release() after it), else the reason it was shed
+    def acquire(self, user_ID):
+        with self.lock:
+            if not self._take_token(user_ID, time.time()):
+                self.metrics[SHED_RATE_LIMITED] += 1
+                return SHED_RATE_LIMITED
+            if self.running < self.max_turns and not self.waiters:
+                self.running += 1
+                self.metrics["admitted"] += 1
+                return None
+            if len(self.waiters) >= self.max_pending:
+                self.metrics[SHED_QUEUE_FULL] += 1
+                return SHED_QUEUE_FULL
+            waiter = [threading.Event(), False]
+            self.waiters.append(waiter)
+            self.metrics["max_pending_seen"] = max(self.metrics["max_pending_seen"], len(self.waiters))
+
+        waiter[0].wait(self.pending_timeout)
+        with self.lock:
+            if waiter[1]:
+                self.metrics["admitted"] += 1
+                self.metrics["waited"] += 1
+                return None
+            self.waiters.remove(waiter)
+            self.metrics[SHED_TIMEOUT] += 1
+            return SHED_TIMEOUT
+
+    def release(self):
+        with self.lock:
+            if self.waiters:
+                waiter = self.waiters.popleft()
+                waiter[1] = True # The slot is handed over, self.running stays the same
+                waiter[0].set()
+            else:
+                self.running -= 1
+
+    # Returns a release() for one turn that can be called any number of times
+    def releaser(self):
+        lock = threading.Lock()
+        released = [False]
+
+        def release():
+            with lock:
+                if released[0]:
+                    return
+                released[0] = True
+            self.release()
+        return release
+
+    def get_metrics(self):
+        with self.lock:
+            out = self.metrics.copy()
+            out["running"] = self.running
+            out["pending"] = len(self.waiters)
+            out["shed"] = out[SHED_RATE_LIMITED] + out[SHED_QUEUE_FULL] + out[SHED_TIMEOUT]
+            return out
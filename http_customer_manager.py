@@ -2,14 +2,18 @@ import hashlib
 import logging
 import time
 import urllib
-import wechat_dev as wd
 
-from http_utils import RequestSender, ENCODING_USED
+from http_expiring import ExpiringMap
+from http_tokens import get_token_manager, CODE_TTL
+
+log = logging.getLogger(__name__)
+
+CUSTOMER_TTL = 60 * 60 # Seconds a state_id's CustomerManager is kept. Same as AUTH_STATE_TTL in http_auth_control
 
 # Manages the Managers
 class CustomerMaster:
     def __init__(self):
-        self.managers = {}
+        self.managers = ExpiringMap(CUSTOMER_TTL) # state_id -> CustomerManager
 
     def spawn_manager(self, state_id):
         self.managers[state_id] = CustomerManager()
@@ -19,30 +23,41 @@ class CustomerMaster:
         return self.managers[state_id]
 
     def _state_exists(self, state_id):
-        if not state_id in self.managers.keys():
+        if not state_id in self.managers:
             return False
         return True
 
-    def log_open_id(self, state_id, openid):
+    # code is what the openid callback gives, see CustomerManager
+    def log_open_id(self, state_id, code):
         if self._state_exists(state_id):
-            logging.warning("Manager {} already exists. Overwriting openID".format(state_id))
+            log.warning("Manager %s already exists. Overwriting openID", state_id)
             curr_mgr = self.get_the_manager(state_id)
         else:
             curr_mgr = self.spawn_manager(state_id)
-        curr_mgr.set_open_id(openid)
+        curr_mgr.set_code(code)
         return
 
     def fetch_open_id(self, state_id):
         if not self._state_exists(state_id):
-            logging.critical("Tried to fetch OpenID but Manager with state <{}> not found".format(state_id))
+            log.critical("Tried to fetch OpenID but Manager with state <%s> not found", state_id)
             return False
         curr_manager = self.managers.get(state_id)
         open_id = curr_manager.get_open_id()
         return open_id
     
+    # The code if it is still good, else False. Does not ask WeChat for anything
+    def fetch_code(self, state_id):
+        if not self._state_exists(state_id):
+            log.critical("Tried to fetch the code but Manager with state <%s> not found", state_id)
+            return False
+        curr_manager = self.managers.get(state_id)
+        if not curr_manager.has_valid_code():
+            return False
+        return curr_manager.code
+
     def stash_ip(self, state_id, ip):
         if self._state_exists(state_id):
-            logging.warning("Manager {} already exists. Overwriting IP".format(state_id))
+            log.warning("Manager %s already exists. Overwriting IP", state_id)
             curr_mgr = self.get_the_manager(state_id)
         else:
             curr_mgr = self.spawn_manager(state_id)
@@ -51,44 +66,49 @@ class CustomerMaster:
     
     def get_ip(self, state_id):
         if not self._state_exists(state_id):
-            logging.critical("Tried to fetch IP but Manager with state <{}> not found".format(state_id))
+            log.critical("Tried to fetch IP but Manager with state <%s> not found", state_id)
             return False
         mgr = self.get_the_manager(state_id)
         return mgr.get_ip()
 
 # Manages customer details.
 # Including OpenID and username.
+# The openid callback only gives a code. It is exchanged for the openid the first time the openid is needed.
 class CustomerManager:
-    openid_req_url = "https://api.weixin.qq.com/sns/oauth2/access_token?appid={app_id}&secret={secret}&code={code}&grant_type=authorization_code"
-    def __init__(self):
-        self.code_timer = 0
+    def __init__(self, token_manager = None):
+        self.tokens = token_manager or get_token_manager()
+        self.code = None
         self.code_recv_time = 0
-        self.sender = RequestSender()
-        self.req_details = {
-            "app_id": wd.get_wechat_app_id(),
-            "secret": wd.get_secret_key(),
-        }
+        self.openid = None
 
     def has_valid_code(self):
         curr_time = time.time()
-        return (curr_time - self.code_recv_time > self.code_timer)
+        return self.code is not None and (curr_time - self.code_recv_time < CODE_TTL)
 
+    # Asks WeChat (through the token manager, which caches and collapses repeated asks) for the openid behind the code
     def request_openid(self):
-        open_id_req_info = {} # TODO
-        self.openid_req_url.format(**open_id_req_info)
-        response = self.sender.send_GET(self.openid_req_url) # Response 
-        response_contents = response.content.decode(ENCODING_USED)
-        logging.debug("OPENID Request response: {}".format(response_contents))
-        return
+        if not self.has_valid_code():
+            raise Exception("No valid code to exchange for an openid (code {})".format(self.code))
+        oauth_reply = self.tokens.exchange_code(self.code)
+        log.debug("OPENID Request response: %s", oauth_reply)
+        self.openid = oauth_reply["openid"]
+        return self.openid
 
     def get_open_id(self):
+        if self.openid is None and self.has_valid_code():
+            self.request_openid()
         return self.openid
 
     def set_open_id(self, openid):
         self.openid = openid
 
+    def set_code(self, code):
+        self.code = code
+        self.code_recv_time = time.time()
+        self.openid = None
+
     def set_ip(self, ip):
         self.ip_address = ip
     
     def get_ip(self):
-        return self.ip_address
\ No newline at end of file
+        return self.ip_address
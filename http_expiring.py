@@ -0,0 +1,139 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+# A dict whose entries disappear after a while, for state that is only good for one flow
+# (auth state_ids, redirect urls, callback info...). Without it those maps grow with every user forever.
+#   - every entry has its own TTL (the map's ttl by default)
+#   - at most max_entries, the least recently written entry goes first
+#   - expired entries are swept on writes with a timing wheel: entries are put in a bucket per
+#     `resolution` seconds of expiry and whole past buckets are dropped, so every entry costs O(1) to expire.
+#     A key is in one bucket at a time: writing it again moves it, removing it takes it out
+# Thread safe. Supports the parts of dict the servers use: [], get, pop, in, len, keys.
+
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_RESOLUTION = 1.0 # Seconds per wheel bucket
+
+class ExpiringMap:
+    def __init__(self, ttl, max_entries = DEFAULT_MAX_ENTRIES, resolution = DEFAULT_RESOLUTION):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.resolution = resolution
+        self.lock = threading.RLock()
+        self.data = OrderedDict() # key -> [value, expires_at, bucket]. Least recently written first
+        self.wheel = {} # bucket -> set of the keys expiring in it
+        self.next_bucket = None # First bucket not swept yet
+        self.metrics = {"expired": 0, "evicted": 0}
+
+    def _bucket(self, t):
+        return int(t // self.resolution)
+
+    # Call with self.lock held. Takes key out of its wheel bucket
+    def _unlink(self, key, entry):
+        keys = self.wheel.get(entry[2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.wheel[entry[2]]
+
+    # Call with self.lock held
+    def _remove(self, key):
+        entry = self.data.pop(key)
+        self._unlink(key, entry)
+        return entry
+
+    # Call with self.lock held. Drops every bucket that is fully in the past
+    def _sweep(self, now):
+        now_bucket = self._bucket(now)
+        if self.next_bucket is None:
+            self.next_bucket = now_bucket
+            return
+        if now_bucket - self.next_bucket > len(self.wheel):
+            # Long quiet spell, only visit the buckets that exist
+            buckets = sorted(b for b in self.wheel if b < now_bucket)
+        else:
+            buckets = range(self.next_bucket, now_bucket)
+        for b in buckets:
+            keys = self.wheel.pop(b, None)
+            if keys is None:
+                continue
+            for key in keys:
+                if self.data.pop(key, None) is not None: # Everything in a past bucket has expired
+                    self.metrics["expired"] += 1
+        self.next_bucket = now_bucket
+
+    def set(self, key, value, ttl = None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self._sweep(now)
+            bucket = max(self._bucket(expires_at), self.next_bucket) # A bucket already swept would never be looked at again
+            entry = self.data.get(key)
+            if entry is None:
+                self.data[key] = [value, expires_at, bucket]
+            else:
+                self.data.move_to_end(key)
+                if entry[2] != bucket:
+                    self._unlink(key, entry)
+                entry[0], entry[1], entry[2] = value, expires_at, bucket
+            self.wheel.setdefault(bucket, set()).add(key)
+            while len(self.data) > self.max_entries:
+                old_key, old_entry = self.data.popitem(last=False)
+                self._unlink(old_key, old_entry)
+                self.metrics["evicted"] += 1
+
+    def get(self, key, default = None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return default
+            if entry[1] <= time.time():
+                self._remove(key)
+                self.metrics["expired"] += 1
+                return default
+            return entry[0]
+
+    def pop(self, key, default = None):
+        with self.lock:
+            if not key in self.data:
+                return default
+            entry = self._remove(key)
+            if entry[1] <= time.time():
+                return default
+            return entry[0]
+
+    # Drops everything expired now instead of on the next write
+    def sweep(self):
+        with self.lock:
+            self._sweep(time.time())
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __getitem__(self, key):
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        missing = object()
+        return self.get(key, missing) is not missing
+
+    def __len__(self):
+        return len(self.data)
+
+    def keys(self):
+        now = time.time()
+        with self.lock:
+            return [k for k, entry in self.data.items() if entry[1] > now]
+
+    def get_metrics(self):
+        with self.lock:
+            out = self.metrics.copy()
+            out["entries"] = len(self.data)
+            out["buckets"] = len(self.wheel)
+            out["wheel_keys"] = sum(len(keys) for keys in self.wheel.values())
+            return out
@@ -1,16 +1,154 @@
+import email.utils
+import fnmatch
+import gzip
+import mimetypes
 import os
 import logging
+import threading
+import time
 
-def _read_file(filepath, byte_limit = 1024):
-    fd = os.open(filepath, os.O_RDONLY) # Read only
-    read = os.read(fd,byte_limit)
-    return read
+log = logging.getLogger(__name__)
+
+SMALL_FILE_LIMIT = 256 * 1024 # Files up to this size are served from memory, bigger ones with sendfile
+STAT_INTERVAL = 1.0 # Seconds a cached file is trusted before it is checked against the disk again
+GZIP_MIN_BYTES = 512 # Smaller files are not worth compressing
+GZIP_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# The files in root that are handed out, as fnmatch patterns. The servers run in the same directory as their
+# journals, captures, error logs and database files, so anything not listed here is a 404.
+# MP_verify_*.txt is the file WeChat asks for to verify the domain
+STATIC_ALLOWLIST = ("index.html", "callback_landing.html", "favicon.ico", "MP_verify_*.txt")
+
+def _read_file(filepath, byte_limit = None):
+    with open(filepath, "rb") as f:
+        return f.read() if byte_limit is None else f.read(byte_limit)
 
 def get_file_as_bytes(relative_filepath):
     full_path = os.path.join(os.getcwd(), relative_filepath)
-    logging.debug("<get file as bytes> Full path: " + str(full_path))
+    log.debug("<get file as bytes> Full path: %s", full_path)
     if not os.path.isfile(full_path):
-        logging.warning("File not found {}".format(full_path))
+        log.warning("File not found %s", full_path)
         return False
     strem = _read_file(full_path)
-    return strem
\ No newline at end of file
+    return strem
+
+# One file as the server sends it. data is None for files too big to keep in memory
+class StaticAsset:
+    def __init__(self, filepath, stat_result, data = None):
+        self.filepath = filepath
+        self.size = stat_result.st_size
+        self.mtime = stat_result.st_mtime
+        self.etag = '"{:x}-{:x}"'.format(int(self.mtime), self.size)
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+        self.content_type = mimetypes.guess_type(filepath)[0] or "application/octet-stream"
+        self.data = data
+        self.gzip_data = None
+        self.checked_at = time.time()
+        if data is not None and self.size >= GZIP_MIN_BYTES and self.content_type.startswith(GZIP_TYPES):
+            compressed = gzip.compress(data, compresslevel=9) # Once per change of the file
+            if len(compressed) < self.size:
+                self.gzip_data = compressed
+
+    def is_stale(self, stat_result):
+        return stat_result.st_mtime != self.mtime or stat_result.st_size != self.size
+
+    # headers: the request's. True if the client's copy is still good (answer 304)
+    def is_not_modified(self, headers):
+        if_none_match = headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(",")]
+            return "*" in tags or self.etag in tags or ("W/" + self.etag) in tags
+        if_modified_since = headers.get("If-Modified-Since")
+        if if_modified_since:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return int(self.mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    # Returns None to send the whole file, (first, last) byte to send a part, or False if the range is outside the file (416).
+    # Only single ranges are handled, anything fancier gets the whole file
+    def get_range(self, headers):
+        value = headers.get("Range")
+        if not value or not value.startswith("bytes=") or "," in value:
+            return None
+        if_range = headers.get("If-Range")
+        if if_range is not None and if_range.strip() != self.etag:
+            return None # The client's part is from another version of the file
+        first, sep, last = value[len("bytes="):].strip().partition("-")
+        try:
+            if first == "":
+                if last == "" or int(last) == 0:
+                    return False
+                first, last = max(self.size - int(last), 0), self.size - 1 # Last n bytes
+            else:
+                first = int(first)
+                last = int(last) if last != "" else self.size - 1
+        except ValueError:
+            return None
+        if first < 0 or first > last or first >= self.size:
+            return False
+        return first, min(last, self.size - 1)
+
+# The files the servers hand out themselves (index.html, callback_landing.html, the WeChat verify .txt...).
+# Only plain files directly in root whose name is in allowlist, found by name.
+# Small files are read once and kept with their ETag and gzip version, so a landing page hit costs at most a stat a second.
+class StaticFiles:
+    METRIC_COUNTERS = ("hits", "loads", "not_found") # Keys of get_metrics that only go up
+
+    def __init__(self, root = None, small_limit = SMALL_FILE_LIMIT, stat_interval = STAT_INTERVAL, allowlist = STATIC_ALLOWLIST):
+        self.root = root or os.getcwd()
+        self.allowlist = allowlist
+        self.small_limit = small_limit
+        self.stat_interval = stat_interval
+        self.lock = threading.Lock()
+        self.assets = {} # filename -> StaticAsset
+        self.metrics = {"hits": 0, "loads": 0, "not_found": 0}
+
+    def _count(self, key):
+        with self.lock:
+            self.metrics[key] += 1
+
+    def is_allowed(self, filename):
+        if filename in ("", ".", "..") or os.path.basename(filename) != filename or "\\" in filename:
+            return False # Don't let people dig around in subdirectories
+        return any(fnmatch.fnmatchcase(filename, pattern) for pattern in self.allowlist)
+
+    # Returns the StaticAsset or None if there is no such file (or it is not to be handed out)
+    def get(self, filename):
+        if not self.is_allowed(filename):
+            self._count("not_found")
+            return None
+        now = time.time()
+        with self.lock:
+            asset = self.assets.get(filename)
+        if asset is not None and now - asset.checked_at < self.stat_interval:
+            self._count("hits")
+            return asset
+
+        filepath = os.path.join(self.root, filename)
+        try:
+            stat_result = os.stat(filepath)
+        except OSError:
+            stat_result = None
+        if stat_result is None or not os.path.isfile(filepath):
+            with self.lock:
+                self.assets.pop(filename, None)
+            self._count("not_found")
+            return None
+
+        if asset is not None and not asset.is_stale(stat_result):
+            asset.checked_at = now
+            self._count("hits")
+            return asset
+
+        data = _read_file(filepath) if stat_result.st_size <= self.small_limit else None
+        asset = StaticAsset(filepath, stat_result, data)
+        with self.lock:
+            self.assets[filename] = asset
+        self._count("loads")
+        return asset
+
+    def get_metrics(self):
+        with self.lock:
+            out = self.metrics.copy()
+            out["cached"] = len(self.assets)
+            return out
@@ -0,0 +1,189 @@
+import heapq
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Durable queue for work that should not hold up a request, e.g. sending the payment request after the openid callback.
+# Every change of a job is appended to a JSON lines file (and fsynced), so queued jobs survive a restart.
+# Jobs are keyed by an idempotency key (the out_trade_no for payments): submitting a key twice does nothing.
+# A job whose handler raises is retried with backoff until max_attempts, then marked failed.
+# Usage:
+#   jobs = JobQueue()
+#   jobs.register("wx_pay", send_payment)    # send_payment(payload) -> JSON-able result
+#   jobs.start()
+#   jobs.submit("wx_pay", out_trade_no, payload)
+
+DEFAULT_JOBS_FILENAME = "jobs.journal"
+DEFAULT_JOB_WORKERS = 4
+DEFAULT_MAX_ATTEMPTS = 5
+RETRY_BASE = 2.0 # Seconds. Wait up to RETRY_BASE * 2^attempt before trying again
+JOB_RETENTION = 7 * 24 * 60 * 60 # Finished jobs are kept this long, so late duplicates are still caught
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+class JobQueue:
+    METRIC_COUNTERS = ("submitted", "completed", "gave_up", "retries") # Keys of get_metrics that only go up. The rest are jobs per status now
+
+    def __init__(self, filepath = None, workers = DEFAULT_JOB_WORKERS, max_attempts = DEFAULT_MAX_ATTEMPTS):
+        self.filepath = filepath or os.path.join(os.getcwd(), DEFAULT_JOBS_FILENAME)
+        self.n_workers = workers
+        self.max_attempts = max_attempts
+        self.handlers = {} # kind -> handler(payload)
+        self.jobs = {} # key -> job dict
+        self.ready = [] # Heap of (run_at, seq, key)
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.fp = None
+        self.workers = []
+        self.counts = {"submitted": 0, "completed": 0, "gave_up": 0, "retries": 0}
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    # Loads the jobs left by the last run and starts the workers. Jobs that were running when it stopped run again.
+    def start(self):
+        with self.cond:
+            if self.fp is not None:
+                return
+            self._load()
+            self._rewrite()
+            self.fp = open(self.filepath, "a", encoding="utf-8")
+            for job in self.jobs.values():
+                if job["status"] in (JOB_QUEUED, JOB_RUNNING):
+                    job["status"] = JOB_QUEUED
+                    self._schedule(job["key"], time.time())
+
+        for i in range(self.n_workers):
+            worker = threading.Thread(target=self._work, name="job-worker-{}".format(i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        log.info("<JOBS> Started %s workers, %s jobs pending", self.n_workers, len(self.ready))
+
+    def _load(self):
+        if not os.path.isfile(self.filepath):
+            return
+        with open(self.filepath, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    job = json.loads(line)
+                except ValueError:
+                    log.warning("<JOBS> Skipping a broken line in %s", self.filepath)
+                    continue
+                self.jobs[job["key"]] = job # Latest line wins
+
+    # Call with self.cond held. Keeps the file to one line per job and drops old finished jobs
+    def _rewrite(self):
+        cutoff = time.time() - JOB_RETENTION
+        for key in list(self.jobs.keys()):
+            job = self.jobs[key]
+            if job["status"] in (JOB_DONE, JOB_FAILED) and job["updated"] < cutoff:
+                self.jobs.pop(key)
+        tmp_path = self.filepath + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for job in self.jobs.values():
+                f.write(json.dumps(job, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.filepath)
+
+    # Call with self.cond held
+    def _record(self, job):
+        job["updated"] = time.time()
+        self.fp.write(json.dumps(job, ensure_ascii=False) + "\n")
+        self.fp.flush()
+        os.fsync(self.fp.fileno()) # Jobs are rare and losing a payment is not ok
+
+    # Call with self.cond held
+    def _schedule(self, key, run_at):
+        self.seq += 1
+        heapq.heappush(self.ready, (run_at, self.seq, key))
+        self.cond.notify()
+
+    # Returns (copy of the job, True if it is new). A key that was seen before is not queued again
+    def submit(self, kind, key, payload):
+        if not kind in self.handlers:
+            raise Exception("No handler registered for job kind {}".format(kind))
+        with self.cond:
+            if self.fp is None:
+                raise Exception("JobQueue.start() was not called")
+            job = self.jobs.get(key)
+            if job is not None:
+                log.warning("<JOBS> Job %s already exists (%s), not queuing again", key, job["status"])
+                return dict(job), False
+            job = {
+                "key": key,
+                "kind": kind,
+                "payload": payload,
+                "status": JOB_QUEUED,
+                "attempts": 0,
+                "created": time.time(),
+            }
+            self.jobs[key] = job
+            self.counts["submitted"] += 1
+            self._record(job)
+            self._schedule(key, time.time())
+            return dict(job), True
+
+    def get_status(self, key):
+        with self.cond:
+            job = self.jobs.get(key)
+            return dict(job) if job is not None else None
+
+    def get_metrics(self):
+        with self.cond:
+            out = {JOB_QUEUED: 0, JOB_RUNNING: 0, JOB_DONE: 0, JOB_FAILED: 0}
+            for job in self.jobs.values():
+                out[job["status"]] += 1
+            out.update(self.counts)
+            return out
+
+    def _next_job(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                if self.ready and self.ready[0][0] <= now:
+                    run_at, seq, key = heapq.heappop(self.ready)
+                    job = self.jobs[key]
+                    job["status"] = JOB_RUNNING
+                    job["attempts"] += 1
+                    self._record(job)
+                    return job
+                timeout = self.ready[0][0] - now if self.ready else None
+                self.cond.wait(timeout)
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            handler = self.handlers[job["kind"]]
+            try:
+                result = handler(job["payload"])
+                error = None
+            except Exception as e:
+                log.exception("<JOBS> Job %s failed on attempt %s", job["key"], job["attempts"])
+                error = "{}: {}".format(type(e).__name__, e)
+
+            with self.cond:
+                if error is None:
+                    job["status"] = JOB_DONE
+                    job["result"] = result
+                    self.counts["completed"] += 1
+                elif job["attempts"] >= self.max_attempts:
+                    job["status"] = JOB_FAILED
+                    job["error"] = error
+                    self.counts["gave_up"] += 1
+                    log.critical("<JOBS> Job %s gave up after %s attempts: %s", job["key"], job["attempts"], error)
+                else:
+                    job["status"] = JOB_QUEUED
+                    job["error"] = error
+                    self.counts["retries"] += 1
+                    delay = random.uniform(0, RETRY_BASE * (2 ** job["attempts"]))
+                    self._schedule(job["key"], time.time() + delay)
+                self._record(job)
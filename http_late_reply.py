@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from http_tokens import TokenManager, get_token_manager, WECHAT_API_BASE, INVALID_TOKEN_ERRCODES
+from http_utils import RequestSender
+
+log = logging.getLogger(__name__)
+
+# WeChat gives a POST 5 seconds. After that it shows the user an error (and retries, see http_reply_cache.py).
+# Most turns take milliseconds, but the first contact SQL lookup or a payment round trip can take longer.
+# LateReplyKeeper gives every turn until REPLY_DEADLINE after the request came in.
+# A turn that is not done by then is answered with "success" (WeChat shows nothing),
+# and its reply is pushed to the user as a customer service message once it is ready.
+# A turn still running TURN_TIMEOUT after the request came in is given up: on_give_up is called (the server gives back
+# its admission slot there, so hung turns cannot hold every slot), and its reply is not sent if it ever comes.
+# The turn itself cannot be stopped though: it keeps its worker in this pool until it returns.
+
+REPLY_DEADLINE = 4.0 # Seconds after the request came in. Leaves a margin under WeChat's 5s
+TURN_TIMEOUT = 60.0 # Seconds after the request came in. A turn still running by then has failed, its late reply is not sent
+EMPTY_REPLY = b"success" # WeChat's "got it, no reply"
+DEFAULT_LATE_WORKERS = 32
+
+CUSTOM_SEND_PATH = "/cgi-bin/message/custom/send"
+
+# Sends text to a user outside of a reply, through WeChat's customer service message API.
+# Anything with send_text(user_ID, content) can be used instead, e.g. pointed at http_wechat_stub.py for tests.
+class CustomerServiceSender:
+    def __init__(self, api_base = WECHAT_API_BASE, token_manager = None):
+        self.api_base = api_base
+        self.sender = RequestSender()
+        if token_manager is None:
+            token_manager = get_token_manager() if api_base == WECHAT_API_BASE else TokenManager(api_base)
+        self.tokens = token_manager
+
+    def send_text(self, user_ID, content):
+        msg = {
+            "touser": user_ID,
+            "msgtype": "text",
+            "text": {"content": content}
+        }
+        for attempt in range(2):
+            token = self.tokens.get_access_token()
+            reply = self.sender.post_json(self.api_base + CUSTOM_SEND_PATH, msg, {"access_token": token})
+            if not reply.get("errcode", 0) in INVALID_TOKEN_ERRCODES:
+                break
+            self.tokens.invalidate_token(token) # Token was refreshed somewhere else, get the new one and try again
+        if reply.get("errcode", 0) != 0:
+            raise Exception("Customer service message to {} failed: {}".format(user_ID, reply))
+        return reply
+
+class LateReplyKeeper:
+    METRIC_COUNTERS = ("on_time", "late", "late_sent", "late_failed", "given_up") # Keys of get_metrics that only go up
+
+    def __init__(self, sender = None, deadline = REPLY_DEADLINE, workers = DEFAULT_LATE_WORKERS, turn_timeout = TURN_TIMEOUT):
+        self.sender = sender or CustomerServiceSender()
+        self.deadline = deadline
+        self.turn_timeout = turn_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.metrics = {"on_time": 0, "late": 0, "late_sent": 0, "late_failed": 0, "given_up": 0}
+
+    def _count(self, key):
+        with self.lock:
+            self.metrics[key] += 1
+
+    # make_message() returns the WechatTextMessage answering the request, it is run on the pool.
+    # Returns the reply XML bytes if it is ready before started_at + deadline, else EMPTY_REPLY.
+    # on_give_up() is called if the turn is still running at started_at + turn_timeout
+    def answer(self, user_ID, make_message, started_at, on_give_up = None):
+        future = self.executor.submit(make_message)
+        time_left = started_at + self.deadline - time.time()
+        try:
+            msgclass = future.result(timeout=max(time_left, 0))
+        except FutureTimeout:
+            log.warning("<LATE REPLY> Turn for %s missed the %ss deadline, replying later", user_ID, self.deadline)
+            self._count("late")
+            give_up_at = started_at + self.turn_timeout
+            timer = threading.Timer(max(give_up_at - time.time(), 0), self._give_up, (user_ID, future, on_give_up))
+            timer.daemon = True
+            timer.start()
+            future.add_done_callback(lambda f: timer.cancel())
+            future.add_done_callback(lambda f: self._send_late(user_ID, f, give_up_at))
+            return EMPTY_REPLY
+        self._count("on_time")
+        return msgclass.to_wechat_reply_bytes()
+
+    def _give_up(self, user_ID, future, on_give_up):
+        if future.done():
+            return
+        log.error("<LATE REPLY> Turn for %s still running after %ss, giving up on it", user_ID, self.turn_timeout)
+        self._count("given_up")
+        if on_give_up is not None:
+            on_give_up()
+
+    def _send_late(self, user_ID, future, give_up_at):
+        if time.time() > give_up_at:
+            return # Given up on, the user has moved on
+        try:
+            msgclass = future.result()
+            self.sender.send_text(user_ID, msgclass.get_reply_content())
+            self._count("late_sent")
+        except Exception as e:
+            self._count("late_failed")
+            log.error("<LATE REPLY> Could not deliver the late reply to %s: %s", user_ID, e)
+
+    def get_metrics(self):
+        with self.lock:
+            return self.metrics.copy()
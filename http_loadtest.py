@@ -0,0 +1,314 @@
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib import parse
+
+# Load generator for the WeChat endpoint served by http_server.py
+# Sends WeChat style XML POSTs from many different FromUserNames at a fixed concurrency,
+# then reports throughput and latency percentiles.
+# Compare the serving modes by running the server both ways:
+#   python http_server.py 8081 single
+#   python http_server.py 8081
+#   python http_shard_server.py 8081 4
+#   python http_loadtest.py --url http://localhost:8081 --requests 2000 --users 200 --concurrency 32
+# --keep-alive reuses one connection per worker like WeChat's proxies do, --get PATH hits a page (e.g. /callback_landing.html) instead.
+#
+# What is sent:
+#   (default)          every user walks through DEFAULT_MESSAGES
+#   --messages testset every user sends random messages from embedding/nlp_utils.test_set
+#   --replay FILE      the POSTs in a capture file (JSON lines, see http_capture.py), in order
+# How fast:
+#   (default)          closed loop, each of --concurrency workers sends the next request when it gets a reply
+#   --rate R           open loop, R requests a second whatever the server does (--poisson for random gaps).
+#                      Latency is counted from when a request was due, so a server falling behind shows up in it
+# Baselines:
+#   --save-baseline FILE  keeps this run's numbers
+#   --compare FILE        compares against them, exits with 1 if p95 or throughput got worse by more than --tolerance
+
+DEFAULT_URL = "http://localhost:8081"
+DEFAULT_MESSAGES = ["你好", "1", "2", "上海", "1", "0"]
+DEFAULT_TOLERANCE = 0.10
+BUSY_MARK = "现在咨询的人太多了".encode("utf-8") # Start of http_wx_xml.BUSY_CONTENT. A 200 that was shed by admission control
+
+WECHAT_TEXT_TEMPLATE = (
+    "<xml>"
+    "<ToUserName><![CDATA[{to_user}]]></ToUserName>"
+    "<FromUserName><![CDATA[{from_user}]]></FromUserName>"
+    "<CreateTime>{create_time}</CreateTime>"
+    "<MsgType><![CDATA[text]]></MsgType>"
+    "<Content><![CDATA[{content}]]></Content>"
+    "<MsgId>{msg_id}</MsgId>"
+    "</xml>"
+)
+
+def make_wechat_text_xml(from_user, content, msg_id, to_user = "gh_loadtest"):
+    return WECHAT_TEXT_TEMPLATE.format(
+        to_user=to_user,
+        from_user=from_user,
+        create_time=int(time.time()),
+        content=content,
+        msg_id=msg_id
+    )
+
+# MsgIds the server has not seen, so its reply cache does not answer a second run from the first one
+def fresh_msg_id_base():
+    return int(time.time() * 1000) * 1000
+
+# Builds the list of (user, body) to send. Each user walks through the same short conversation.
+def build_synthetic_plan(n_requests, n_users, messages = DEFAULT_MESSAGES, msg_id_base = 0):
+    plan = []
+    for i in range(n_requests):
+        user = "loadtest_user_{}".format(i % n_users)
+        turn = i // n_users
+        content = messages[turn % len(messages)]
+        plan.append((user, make_wechat_text_xml(user, content, msg_id=msg_id_base + i + 1)))
+    return plan
+
+# Like build_synthetic_plan, but every user says random things from the NLP test set (greetings, questions, city names...)
+def build_testset_plan(n_requests, n_users, seed = 0, msg_id_base = 0):
+    from embedding.nlp_utils import test_set
+
+    rng = random.Random(seed)
+    messages = [text for text, intent in test_set]
+    plan = []
+    for i in range(n_requests):
+        user = "loadtest_user_{}".format(i % n_users)
+        plan.append((user, make_wechat_text_xml(user, rng.choice(messages), msg_id=msg_id_base + i + 1)))
+    return plan
+
+# GETs of one path, e.g. the landing page WeChat's in-app browser opens after the auth link. No user, so no per-user ordering
+def build_get_plan(n_requests):
+    return [(None, None)] * n_requests
+
+# A decoded message (the dict decode_post gives) back to WeChat XML
+def request_to_xml(info):
+    parts = ["<xml>"]
+    for key, value in info.items():
+        if key == "xml" or value is None:
+            continue
+        if key in ("CreateTime", "MsgId"):
+            parts.append("<{0}>{1}</{0}>".format(key, value))
+        else:
+            parts.append("<{0}><![CDATA[{1}]]></{0}>".format(key, str(value).replace("]]>", "]]]]><![CDATA[>")))
+    parts.append("</xml>")
+    return "".join(parts)
+
+# Reads the POSTs of a capture file. Lines are {"method": "POST", "request": <decoded message>, ...} (see http_capture.py)
+# MsgIds are renumbered from msg_id_base unless it is None, so replays against a running server are not answered from its reply cache
+def build_replay_plan(filepath, n_requests = None, msg_id_base = 0):
+    plan = []
+    with open(filepath, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # Cut off by a crash or a rotation
+            if record.get("method", "POST") != "POST" or not isinstance(record.get("request"), dict):
+                continue
+            info = dict(record["request"])
+            if msg_id_base is not None and info.get("MsgId"):
+                info["MsgId"] = msg_id_base + len(plan) + 1
+            plan.append((info.get("FromUserName", ""), request_to_xml(info)))
+            if n_requests is not None and len(plan) >= n_requests:
+                break
+    if not plan:
+        raise Exception("No POSTs to replay in {}".format(filepath))
+    return plan
+
+# Returns the value at percentile pct (0-100) of a sorted list
+def percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return 0.0
+    idx = int(round((pct / 100.0) * (len(sorted_vals) - 1)))
+    return sorted_vals[idx]
+
+# Result kinds of one request
+RESULT_OK = "ok"
+RESULT_SHED = "shed" # 200 with the busy reply
+RESULT_ERROR = "error"
+
+class LoadRunner:
+    def __init__(self, url, concurrency, timeout = 10, keep_alive = False):
+        parsed = parse.urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.path = parsed.path or "/"
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.local = threading.local() # The worker's connection when keep_alive
+        self.user_locks = {}
+        self.user_locks_lock = threading.Lock()
+
+    # Mimics WeChat: one user never has two messages in flight
+    def _user_lock(self, user):
+        with self.user_locks_lock:
+            if not user in self.user_locks:
+                self.user_locks[user] = threading.Lock()
+            return self.user_locks[user]
+
+    # Returns (response status, response body)
+    def _request(self, method, body):
+        conn = getattr(self.local, "conn", None) if self.keep_alive else None
+        if conn is None:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            if body is None:
+                conn.request(method, self.path)
+            else:
+                conn.request(method, self.path, body=body.encode("utf-8"), headers={"Content-Type": "text/xml"})
+            resp = conn.getresponse()
+            content = resp.read()
+        except Exception:
+            conn.close()
+            self.local.conn = None
+            raise
+        if self.keep_alive:
+            self.local.conn = conn # http.client reconnects by itself if the server said Connection: close
+        else:
+            conn.close()
+        return resp.status, content
+
+    # Returns (result kind, latency in seconds). user None means a GET of the path.
+    # due is the perf_counter() time the request should have gone out (open loop), latency counts from then
+    def send_one(self, user, body, due = None):
+        if due is not None:
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if user is None:
+            return self._timed("GET", None, due)
+        with self._user_lock(user):
+            return self._timed("POST", body, due)
+
+    def _timed(self, method, body, due = None):
+        start = time.perf_counter() if due is None else due
+        reused = self.keep_alive and getattr(self.local, "conn", None) is not None
+        try:
+            try:
+                status, content = self._request(method, body)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                status, content = self._request(method, body) # The server closed the idle connection. Like a browser, try once on a new one
+            if status != 200:
+                kind = RESULT_ERROR
+            elif BUSY_MARK in content:
+                kind = RESULT_SHED
+            else:
+                kind = RESULT_OK
+        except Exception:
+            kind = RESULT_ERROR
+        return (kind, time.perf_counter() - start)
+
+    # rate: requests a second for an open loop run, None for closed loop. poisson: random gaps with that mean rate
+    def run(self, plan, rate = None, poisson = False, seed = 0):
+        start = time.perf_counter()
+        jobs = []
+        if rate:
+            rng = random.Random(seed)
+            due = start
+            for user, body in plan:
+                jobs.append((user, body, due))
+                due += rng.expovariate(rate) if poisson else 1.0 / rate
+        else:
+            jobs = [(user, body, None) for user, body in plan]
+        # Open loop needs a worker free when a request is due, closed loop keeps exactly concurrency in flight
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            results = list(pool.map(lambda j: self.send_one(*j), jobs))
+        elapsed = time.perf_counter() - start
+        return summarize(results, elapsed)
+
+def summarize(results, elapsed):
+    latencies = sorted(lat for kind, lat in results if kind == RESULT_OK)
+    errors = sum(1 for kind, lat in results if kind == RESULT_ERROR)
+    shed = sum(1 for kind, lat in results if kind == RESULT_SHED)
+    total = len(results)
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": (errors / total) if total else 0.0,
+        "shed": shed,
+        "shed_rate": (shed / total) if total else 0.0,
+        "elapsed_s": elapsed,
+        "throughput_rps": (total / elapsed) if elapsed > 0 else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+def print_summary(summary):
+    print("Requests: {requests} | Errors: {errors} ({error_rate:.2%}) | Shed: {shed} ({shed_rate:.2%}) | Elapsed: {elapsed_s:.2f}s".format(**summary))
+    print("Throughput: {throughput_rps:.1f} req/s".format(**summary))
+    print("Latency p50: {p50_ms:.1f}ms | p95: {p95_ms:.1f}ms | p99: {p99_ms:.1f}ms".format(**summary))
+
+def save_baseline(filepath, summary, run_args):
+    with open(filepath, "w", encoding="utf-8") as f:
+        json.dump({"summary": summary, "args": run_args, "saved_at": time.time()}, f, ensure_ascii=False, indent=2)
+
+# Prints how summary differs from the saved baseline. Returns False if p95/p99, throughput or the error rate got worse by more than tolerance
+def compare_to_baseline(filepath, summary, tolerance = DEFAULT_TOLERANCE):
+    with open(filepath, encoding="utf-8") as f:
+        baseline = json.load(f)["summary"]
+    worse = []
+    print("Against {}:".format(filepath))
+    for key, higher_is_better in (("throughput_rps", True), ("p50_ms", False), ("p95_ms", False), ("p99_ms", False),
+                                  ("error_rate", False), ("shed_rate", False)):
+        before, now = baseline.get(key, 0.0), summary[key]
+        change = (now - before) / before if before else 0.0
+        print("  {:<15} {:10.2f} -> {:10.2f} ({:+.1%})".format(key, before, now, change))
+        got_worse = -change if higher_is_better else change
+        if key in ("throughput_rps", "p95_ms", "p99_ms") and got_worse > tolerance:
+            worse.append(key)
+        elif key == "error_rate" and now > before + tolerance / 10:
+            worse.append(key)
+    if worse:
+        print("Worse than the baseline by more than {:.0%}: {}".format(tolerance, ", ".join(worse)))
+    return not worse
+
+if __name__ == "__main__":
+    from sys import exit
+
+    argparser = argparse.ArgumentParser(description="Load test the WeChat chatbot endpoint")
+    argparser.add_argument("--url", default=DEFAULT_URL)
+    argparser.add_argument("--requests", type=int, default=1000)
+    argparser.add_argument("--users", type=int, default=100)
+    argparser.add_argument("--concurrency", type=int, default=16)
+    argparser.add_argument("--keep-alive", action="store_true", help="Reuse one connection per worker")
+    argparser.add_argument("--get", default=None, metavar="PATH", help="GET this path instead of sending messages")
+    argparser.add_argument("--messages", choices=["default", "testset"], default="default", help="What synthetic users say")
+    argparser.add_argument("--replay", default=None, metavar="FILE", help="Send the POSTs captured in FILE (JSON lines)")
+    argparser.add_argument("--keep-ids", action="store_true", help="Replay with the captured MsgIds")
+    argparser.add_argument("--rate", type=float, default=None, help="Requests a second (open loop). Default: closed loop")
+    argparser.add_argument("--poisson", action="store_true", help="Random gaps between requests at --rate")
+    argparser.add_argument("--seed", type=int, default=0)
+    argparser.add_argument("--save-baseline", default=None, metavar="FILE")
+    argparser.add_argument("--compare", default=None, metavar="FILE")
+    argparser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = argparser.parse_args()
+
+    url = args.url
+    msg_id_base = fresh_msg_id_base()
+    if args.get:
+        url = parse.urljoin(args.url, args.get)
+        plan = build_get_plan(args.requests)
+    elif args.replay:
+        plan = build_replay_plan(args.replay, args.requests, None if args.keep_ids else msg_id_base)
+    elif args.messages == "testset":
+        plan = build_testset_plan(args.requests, args.users, seed=args.seed, msg_id_base=msg_id_base)
+    else:
+        plan = build_synthetic_plan(args.requests, args.users, msg_id_base=msg_id_base)
+    runner = LoadRunner(url, args.concurrency, keep_alive=args.keep_alive)
+    summary = runner.run(plan, rate=args.rate, poisson=args.poisson, seed=args.seed)
+    print_summary(summary)
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, summary, vars(args))
+        print("Saved the baseline to {}".format(args.save_baseline))
+    if args.compare and not compare_to_baseline(args.compare, summary, args.tolerance):
+        exit(1)
@@ -0,0 +1,154 @@
+import logging
+import random
+import threading
+import time
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib import parse
+from urllib3.exceptions import NewConnectionError
+
+log = logging.getLogger(__name__)
+
+# One shared client for every call we make to WeChat (pay requests, openid exchange, customer service messages...)
+# requests.get/post open a new TCP (+TLS) connection every time. A Session keeps them open and reuses them.
+# On top of the pool:
+#   - at most max_per_host requests in flight to one host, the rest wait for a slot
+#   - connect/read timeouts, so a hanging WeChat API can't hold our threads forever
+#   - retries with exponential backoff and full jitter. Failing to connect is always retried (nothing was sent).
+#     Resets, timeouts and 5xx only for requests marked idempotent (GETs by default), a POST may have gone through.
+
+DEFAULT_TIMEOUT = (3.05, 10) # (connect, read) seconds
+DEFAULT_MAX_PER_HOST = 16 # Requests in flight to the same host
+DEFAULT_POOL_SIZE = 32 # Open connections kept per host
+DEFAULT_RETRIES = 2
+BACKOFF_BASE = 0.2 # Seconds. Sleep up to BACKOFF_BASE * 2^attempt before retrying
+RETRY_STATUSES = {500, 502, 503, 504}
+
+# True if the request never left this machine, so it is safe to send again whatever it was
+def never_sent(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+class OutboundClient:
+    def __init__(self, timeout = DEFAULT_TIMEOUT, max_per_host = DEFAULT_MAX_PER_HOST,
+                 pool_size = DEFAULT_POOL_SIZE, retries = DEFAULT_RETRIES):
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.host_slots = {} # host -> BoundedSemaphore
+        self.lock = threading.Lock()
+        self.metrics = {"requests": 0, "retries": 0, "failures": 0}
+
+    def _host_slot(self, url):
+        host = parse.urlparse(url).netloc
+        with self.lock:
+            slot = self.host_slots.get(host)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.max_per_host)
+                self.host_slots[host] = slot
+            return slot
+
+    def _count(self, key):
+        with self.lock:
+            self.metrics[key] += 1
+
+    # Same arguments as requests.request. Returns a requests Response
+    def request(self, method, url, idempotent = None, **kwargs):
+        if idempotent is None:
+            idempotent = method.upper() in ("GET", "HEAD")
+        kwargs.setdefault("timeout", self.timeout)
+        slot = self._host_slot(url)
+        self._count("requests")
+
+        attempt = 0
+        while True:
+            try:
+                with slot:
+                    response = self.session.request(method, url, **kwargs)
+                if not (idempotent and response.status_code in RETRY_STATUSES) or attempt >= self.retries:
+                    return response
+                reason = "status {}".format(response.status_code)
+            except requests.exceptions.ConnectionError as e:
+                # ConnectTimeout is a ConnectionError too
+                if not (idempotent or never_sent(e)) or attempt >= self.retries:
+                    self._count("failures")
+                    raise
+                reason = str(e)
+            except requests.exceptions.Timeout:
+                if not idempotent or attempt >= self.retries:
+                    self._count("failures")
+                    raise
+                reason = "timeout"
+
+            delay = random.uniform(0, BACKOFF_BASE * (2 ** attempt))
+            log.warning("<OUTBOUND> %s %s failed (%s), retrying in %.2fs", method, url, reason, delay)
+            self._count("retries")
+            attempt += 1
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get_metrics(self):
+        with self.lock:
+            return self.metrics.copy()
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+# The client everyone should use, so they share the connection pool
+def get_client():
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = OutboundClient()
+        return _shared_client
+
+# Compares a new connection per request (the old RequestSender) with the pooled client, against http_wechat_stub.py
+# connect_delay plays the handshake cost to the real API (a TLS handshake to api.weixin.qq.com is a few round trips)
+def run_benchmark(n_requests = 500, concurrency = 8, connect_delay = 0.03, port = 9101):
+    from concurrent.futures import ThreadPoolExecutor
+    from http_wechat_stub import start_stub, WeChatStubHandler
+
+    WeChatStubHandler.connect_delay = connect_delay
+    stub = start_stub(port)
+    url = "http://127.0.0.1:{}/cgi-bin/token".format(port)
+
+    def timed(fn):
+        start = time.perf_counter()
+        fn(url).raise_for_status()
+        return time.perf_counter() - start
+
+    def bench(label, fn):
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            start = time.perf_counter()
+            latencies = sorted(pool.map(lambda i: timed(fn), range(n_requests)))
+            elapsed = time.perf_counter() - start
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+        print("{:<10} {:7.1f} req/s | p50 {:6.2f}ms | p99 {:6.2f}ms".format(label, n_requests / elapsed, p50, p99))
+
+    print("{} requests, {} at a time, {}ms per new connection".format(n_requests, concurrency, connect_delay * 1000))
+    client = OutboundClient()
+    bench("new conn", requests.get)
+    bench("pooled", client.get)
+    stub.shutdown()
+
+if __name__ == "__main__":
+    from sys import argv
+
+    # python http_outbound.py [requests] [concurrency] [connect delay in ms]
+    n_requests = int(argv[1]) if len(argv) > 1 else 500
+    concurrency = int(argv[2]) if len(argv) > 2 else 8
+    connect_delay = float(argv[3]) / 1000 if len(argv) > 3 else 0.03
+    run_benchmark(n_requests, concurrency, connect_delay)
@@ -0,0 +1,117 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+# WeChat sends the same POST again (up to 3 times, 5s apart) when it does not get an answer in time.
+# Running a retry through the chatbot would move the conversation on a second time,
+# so the encoded reply of every message is kept for a while and given to its retries.
+# A retry that comes while the first one is still being answered waits for that answer, for at most REPLY_CACHE_WAIT.
+
+REPLY_CACHE_TTL = 60 # Seconds. WeChat stops retrying after ~15s
+REPLY_CACHE_MAX_ENTRIES = 50000
+REPLY_CACHE_WAIT = 4.0 # Seconds a retry waits for the first try. Under WeChat's 5s
+
+# What compute() returns for a reply that only holds for this try, like the busy reply of a shed message.
+# Retries already waiting on the try get it too, but it is not kept: the next retry is computed again
+class Uncached:
+    def __init__(self, reply):
+        self.reply = reply
+
+# Messages have a MsgId. Events (subscribe, menu clicks...) do not, WeChat says to use FromUserName + CreateTime
+def reply_cache_key(post_req_info):
+    msg_ID = post_req_info.get("MsgId")
+    if msg_ID:
+        return "m:" + str(msg_ID)
+    sender = post_req_info.get("FromUserName")
+    create_time = post_req_info.get("CreateTime")
+    if sender and create_time:
+        return "e:{}:{}".format(sender, create_time)
+    return None
+
+class ReplyCache:
+    METRIC_COUNTERS = ("misses", "hits", "waits", "wait_timeouts") # Keys of get_metrics that only go up
+
+    def __init__(self, ttl = REPLY_CACHE_TTL, max_entries = REPLY_CACHE_MAX_ENTRIES, wait = REPLY_CACHE_WAIT):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.wait = wait
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> [done Event, reply, expires_at, failed, keep]. Oldest first
+        self.metrics = {"misses": 0, "hits": 0, "waits": 0, "wait_timeouts": 0}
+
+    # Call with self.lock held. Finished entries are moved to the back, so the oldest expire first.
+    # Entries still being answered are skipped, never dropped: someone may be waiting on them. There are only a few
+    # (one per running turn), so they cannot keep the finished entries behind them from going.
+    def _sweep(self, now):
+        size = len(self.entries)
+        gone = []
+        for key, entry in self.entries.items():
+            if not entry[0].is_set():
+                continue
+            if size <= self.max_entries and entry[2] > now:
+                break
+            gone.append(key)
+            size -= 1
+        for key in gone:
+            del self.entries[key]
+
+    # Returns compute() for the first request with this key and the same reply for its retries (see Uncached for the exception).
+    # A retry still waiting after self.wait seconds gets busy() instead, or an exception if busy is None.
+    # key None means the request cannot be recognized again, it is always computed.
+    def get_or_compute(self, key, compute, busy = None):
+        if key is None:
+            return compute()
+
+        now = time.time()
+        with self.lock:
+            self._sweep(now)
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = [threading.Event(), None, now + self.ttl, False, True]
+                self.entries[key] = entry
+                owner = True
+                self.metrics["misses"] += 1
+            else:
+                owner = False
+                self.metrics["hits" if entry[0].is_set() else "waits"] += 1
+
+        if not owner:
+            if not entry[0].wait(self.wait):
+                with self.lock:
+                    self.metrics["wait_timeouts"] += 1
+                if busy is None:
+                    raise Exception("Reply for {} not ready in {}s".format(key, self.wait))
+                return busy()
+            if entry[3]:
+                raise Exception("Reply for {} failed on the first try".format(key))
+            return entry[1]
+
+        try:
+            reply = compute()
+            if isinstance(reply, Uncached):
+                reply = reply.reply
+                entry[4] = False
+            entry[1] = reply
+        except Exception:
+            entry[3] = True
+            raise
+        finally:
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    if entry[3] or not entry[4]:
+                        self.entries.pop(key) # Let the next retry try again
+                    else:
+                        entry[2] = time.time() + self.ttl
+                        self.entries.move_to_end(key)
+            entry[0].set()
+        return entry[1]
+
+    def get_metrics(self):
+        with self.lock:
+            out = self.metrics.copy()
+            out["entries"] = len(self.entries)
+            return out
+
+    def __len__(self):
+        return len(self.entries)
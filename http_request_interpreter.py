@@ -2,32 +2,62 @@ import logging
 import wechat_dev as wd
 
 from http_auth_control import AuthController
-from http_wx_message import WeChatAuthMessage, WechatTextMessage, WechatPaymentRequest
+from http_expiring import ExpiringMap
+from http_jobs import JobQueue
+from http_wx_message import WeChatAuthMessage, WechatTextMessage, WechatPaymentRequest, send_payment_job
 from http_utils import RequestSender, ENCODING_USED, url_path_to_dict, get_req_sender, get_ip_from_header
 
+REDIRECT_TTL = 60 * 60 # Seconds the redirect url and order number of a state_id are kept
+
+log = logging.getLogger(__name__)
 
 # Called boss because it tells other people what to do. 
 # Don't want to name it 'Manager'
 class RequestBoss:
+    PAYMENT_JOB = "wx_pay"
+
     def __init__(self):
         self.auth_ctrl = AuthController()
         self.sender = RequestSender()
-        self.redirect_map = {}
+        self.redirect_map = ExpiringMap(REDIRECT_TTL) # state_id -> url
+        self.trade_no_map = ExpiringMap(REDIRECT_TTL) # state_id -> out_trade_no. The same auth link always means the same order
+        self.jobs = JobQueue() # Payment requests are sent from here, not from the request handler
+        self.jobs.register(self.PAYMENT_JOB, send_payment_job)
+
+    # Called by the server before it starts taking requests. Also picks up payments left over from the last run
+    def start_jobs(self):
+        self.jobs.start()
 
     # The follow up is to WeChat's API
     # Not A message to the user WechatTextMessage
     # A WeChatPayment Request !
+    # The request is built here, then queued with the callback's code. The job queue exchanges the code for the openid,
+    # signs the request and sends it, so the openid callback can redirect right away and WeChat being slow is retried.
+    # Returns the job (see http_jobs.py)
     def send_auth_followup_message(self, state_id):
-        logging.critical("SENDING AUTH FOLLOWUP")
-        # Sends a POST request to WeChat
+        log.critical("QUEUING AUTH FOLLOWUP")
         # Uses info captured previously for auth message.
         r_action, og_post_req_info = self.auth_ctrl.pop_callback_info(state_id)
-        logging.debug("Cache retrieved POST Request info {}".format(og_post_req_info))
-        open_id = self.auth_ctrl.auth_fetch_open_id(state_id) # Given by WeChat after opening the auth link
+        log.debug("Cache retrieved POST Request info %s", og_post_req_info)
+        code = self.auth_ctrl.auth_fetch_code(state_id) # Given by WeChat after opening the auth link
+        if not code:
+            raise Exception("No openid callback code for state {}".format(state_id))
         spbill_ip = self.auth_ctrl.pop_ip(state_id) # Captured when user is redirected to our domain
-        wx_pay_req = WechatPaymentRequest(r_action, og_post_req_info, open_id, spbill_ip)
-        wx_response = wx_pay_req.get_wx_pay_request() # Includes sending a request to Wechat servers
-        return wx_response
+        wx_pay_req = WechatPaymentRequest(r_action, og_post_req_info, None, spbill_ip) # The job fills in the openid
+        known_trade_no = self.trade_no_map.get(state_id)
+        if known_trade_no is not None:
+            wx_pay_req.set_out_trade_no(known_trade_no) # Callback opened twice
+        out_trade_no = wx_pay_req.get_out_trade_no()
+        self.trade_no_map[state_id] = out_trade_no
+
+        payload = {
+            "out_trade_no": out_trade_no,
+            "user_ID": get_req_sender(og_post_req_info),
+            "code": code,
+            "request_data": wx_pay_req.get_unsigned_data(),
+        }
+        job, is_new = self.jobs.submit(self.PAYMENT_JOB, out_trade_no, payload)
+        return job
 
     def _capture_redirect_url(self, state_id, url):
         self.redirect_map[state_id] = url
@@ -44,61 +74,66 @@ class RequestBoss:
             rd_keys = req_dict.keys()
             for c in wx_req_comp:
                 if not c in rd_keys:
-                    logging.debug("GET is not WeChat Auth. {} is missing".format(c))
+                    log.debug("GET is not WeChat Auth. %s is missing", c)
                     return False
             return True
 
         def is_openid_callback(path):
             r = wd.get_openid_subdomain() in path
-            if r: logging.warn("Request with path: <%s> is an openid_callback" % path)
+            if r: log.warning("Request with path: <%s> is an openid_callback", path)
             return r
             
         def capture_openid(req_dict):
-            logging.warn("Capturing OPENID")
+            log.warning("Capturing OPENID")
             open_id = req_dict.get("code", False)
             state_id = req_dict.get("state", False)
             if not open_id:
-                logging.error("<CAPTURE OPENID> code not found in GET request")
+                log.error("<CAPTURE OPENID> code not found in GET request")
             if not state_id:
-                logging.error("<CAPTURE OPENID> state not found in GET request")
+                log.error("<CAPTURE OPENID> state not found in GET request")
             
             if open_id and state_id:
                 self.auth_ctrl.capture_open_id(state_id, open_id)
-                self.send_auth_followup_message(state_id) # Triggers sending the POST request to Wechat
+                self.send_auth_followup_message(state_id) # Queues the POST request to Wechat
             else:
-                logging.error("Did not send followup. One of the following is missing:")
-                logging.error("OPENID {}| STATEID {}".format(open_id, state_id))
+                log.error("Did not send followup. One of the following is missing:")
+                log.debug("OPENID %s| STATEID %s", open_id, state_id)
 
         def get_wechat_echo_auth(req_dict):
             # isolate echostr
             echostr = req_dict.get("echostr")
-            logging.debug("<DO GET> GET request is WeChat Auth. Sending reply")
-            logging.debug("Sending auth code: {}".format(echostr))
+            log.debug("<DO GET> GET request is WeChat Auth. Sending reply")
+            log.debug("Sending auth code: %s", echostr)
             return echostr
 
         request_dict = url_path_to_dict(path)
-        logging.info("Recieved a GET request,\nPath: %s\nHeaders:\n%s\n", str(request_dict), str(headers))
+        log.info("Recieved a GET request,\nPath: %s\nHeaders:\n%s\n", request_dict, headers)
         
         if is_wechat_echo_msg(request_dict):
             return "text", get_wechat_echo_auth(request_dict)
 
         elif is_openid_callback(path):
-            logging.warn("GET request is WX OpenID callback")
+            log.warning("GET request is WX OpenID callback")
             capture_openid(request_dict)
             return "redirect", "callback_landing.html"
 
         elif "redir" in path:
-            logging.debug("GET request is a redir (a callback from WeChat openid Auth)")
+            log.debug("GET request is a redir (a callback from WeChat openid Auth)")
             state_id = request_dict.get(wd.REDIRECT_CALLBACK_PARAM_NAME)
             self.auth_ctrl.stash_ip(state_id, headers)
             final_target_url = self._get_redirect_url(state_id) # Captured during authreq
             return ("redirect", final_target_url)
 
         else:
-            logging.debug("Ordinary GET request")
+            log.debug("Ordinary GET request")
             return "no_action", ""
 
     def interpret_post(self, r_action, og_reqest_info):
+        msgclass = self.build_reply_message(r_action, og_reqest_info)
+        return msgclass.to_wechat_reply_bytes()
+
+    # Returns the WechatTextMessage (or subclass) answering the POST
+    def build_reply_message(self, r_action, og_reqest_info):
         user_ID = get_req_sender(og_reqest_info)
         if r_action.is_authreq():
             # If an openID authentication is needed
@@ -108,8 +143,6 @@ class RequestBoss:
             self._capture_purchase_callback_info(user_ID, r_action, og_reqest_info)
         else:
             msgclass = WechatTextMessage(r_action, og_reqest_info)
-
-        xml = msgclass.to_wechat_reply_xml()
-        return xml  
+        return msgclass
 
     
\ No newline at end of file
@@ -1,13 +1,22 @@
 import logging
+import re
 import time
 
 from http.server import BaseHTTPRequestHandler, HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
 from urllib import parse
 
+from chatbot.cb_logging import LOGGING_METRIC_COUNTERS, SERVER_LOG_LEVELS, get_logging_metrics, setup_logging, stop_logging
+from chatbot.cb_metrics import METRICS
 from chatbot.chatbot import Chatbot # Defined in ./chatbot
-from http_files_utils import get_file_as_bytes
+from http_capture import BUSY_ACTION, CACHED_ACTION, TrafficCapture
+from http_concurrency import AdmissionControl, UserLockTable
+from http_files_utils import StaticFiles
+from http_late_reply import LateReplyKeeper
+from http_reply_cache import ReplyCache, Uncached, reply_cache_key
 from http_request_interpreter import RequestBoss
-from http_utils import ENCODING_USED, decode_post
+from http_utils import DECODE_ERRORS, ENCODING_USED, MAX_BODY_BYTES, decode_post
+from http_wx_xml import busy_reply
 
 # ! NOTE ! http.server security is low
 
@@ -15,136 +24,339 @@ from http_utils import ENCODING_USED, decode_post
 # Also sends messages back to the WeChat server to reply AND/OR sends a message to internal servers to trigger some action (log database info)
 
 DEFAULT_PORT = 8081
+KEEPALIVE_TIMEOUT = 75 # Seconds an idle keep-alive connection is kept open. Same as http_async_server.py
+METRICS_PATH = "/metrics" # Prometheus scrapes this, see chatbot/cb_metrics.py
+MAX_KEEPALIVE_REQUESTS = 1000 # Requests on one connection before it is closed, so one client cannot hold a thread forever
+
+# Named, not __name__, so SERVER_LOG_LEVELS applies when this file is run as __main__ too
+log = logging.getLogger("http_server")
+access_log = logging.getLogger("http_server.access")
+
+# One thread per connection. Different users are served in parallel, see ChatbotServer.user_locks for ordering.
+# Python 3.6 (see Dockerfile) has no http.server.ThreadingHTTPServer so it is built here.
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True # Don't hold up shutdown for hanging connections
+    request_queue_size = 128 # Default listen backlog of 5 makes bursts wait on SYN retries
+
+CHATBOT_RESOURCE_FILENAME = "wechat_chatbot_resource.json"
+CONTENT_LENGTH_RE = re.compile(r"[0-9]+") # int() also takes signs, "_" and non-ASCII digits
 
 def start_chatbot():
-    print("Starting the chatbot")
-    chatbot_resource_filename = "wechat_chatbot_resource.json"
+    log.info("Starting the chatbot")
     local_chatbot = Chatbot()
-    local_chatbot.start_bot(chatbot_resource_filename, backend_read=False) # Turn off backend read cuz no SQL to read
+    local_chatbot.start_bot(CHATBOT_RESOURCE_FILENAME, backend_read=False) # Turn off backend read cuz no SQL to read
     return local_chatbot
 
 class ChatbotServer(SimpleHTTPRequestHandler):
-    # This cannot be put in 
-    chatbot = start_chatbot()
+    # Made by run() (or http_async_server) if nobody set it before. Anything with get_bot_response(uid, msg) works, see http_shard_server.py
+    chatbot = None
     rb = RequestBoss()
+    user_locks = UserLockTable() # Messages from the same user are answered one at a time and in order
+    reply_cache = ReplyCache() # Retries of a message WeChat did not get an answer for in time get the same reply
+    late_replies = LateReplyKeeper() # Turns that would miss WeChat's 5s window are sent as customer service messages
+    admission = AdmissionControl() # Caps running and waiting turns, and messages per user. The rest get busy_reply
+    static_files = StaticFiles() # index.html, callback_landing.html, .txt downloads... Cached, see http_files_utils.py
+    capture = TrafficCapture() # Samples requests for http_loadtest.py --replay. Off until run() is given a capture rate
+
+    # HTTP/1.1 keeps connections open, so every response needs a Content-Length
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT # Idle connections are closed after this
+    max_keepalive_requests = MAX_KEEPALIVE_REQUESTS
+    # Headers and body go out in one write at the end of the request (handle_one_request flushes),
+    # and small writes are not held back by Nagle waiting for the client's delayed ACK
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def parse_request(self):
+        self.requests_on_connection = getattr(self, "requests_on_connection", 0) + 1
+        return super().parse_request()
+
+    def end_headers(self):
+        if getattr(self, "requests_on_connection", 0) >= self.max_keepalive_requests:
+            self.send_header('Connection', 'close') # Also makes handle() stop after this request
+        super().end_headers()
+
+    # http.server writes these straight to stderr on the request thread. Send them through the logging queue instead
+    def log_message(self, format, *args):
+        access_log.info("%s - " + format, self.address_string(), *args)
+
+    def log_error(self, format, *args):
+        access_log.warning("%s - " + format, self.address_string(), *args)
+
+    def send_response(self, code, message = None):
+        self.status_sent = code # For the capture record
+        super().send_response(code, message)
     
     # Expects a ResponseAction
     def _get_bot_response(self, post_info_dict):
         uid = post_info_dict.get("FromUserName", "")
         msg = post_info_dict.get("Content", "")
-        logging.info("<SERVER GET BOT REPLY> USER <{}>:{}".format(uid, msg))
-        return self.chatbot.get_bot_response(uid, msg)
+        log.info("<SERVER GET BOT REPLY> USER <%s>:%s", uid, msg)
+        with self.user_locks.hold(uid):
+            return self.chatbot.get_bot_response(uid, msg)
         
     def _default_GET_response(self):
         INDEX_PAGE_PATH = "/index.html"
+        path = parse.unquote(parse.urlsplit(self.path).path) # WeChat's browser adds query strings to the landing pages
         # Empty path = "/"
-        if len(self.path) > 1:
-            if "/" in self.path[1:]:
+        if len(path) > 1:
+            if "/" in path[1:]:
                 # Don't let people dig around in subdirectories
                 self._set_not_found_response()
             else:
-                # If its a txt
-                if ".txt" in self.path:
-                    filename = self.path.split("/")[1] # Get whatever is after the backslash
-                    print("Forcing download of text file: %s" % filename)
-                    logging.debug("Retrieving file: %s" % filename)
-                    byte_stream = get_file_as_bytes(filename)
-                    f_length = len(byte_stream)
-                    self._set_txt_file_response(filename, f_length)
-                    self.wfile.write(byte_stream)
-
-                else:
-                    # Use the default
-                    super().do_GET()
-                
-                # logging.debug("HEADERS", self.headers)
+                self._send_static_file(path[1:])
 
         else:
             # Returns redirect to index.html
             self._set_redirect_response(INDEX_PAGE_PATH)
 
+    # From memory for small files, with sendfile for big ones. Honours If-None-Match/If-Modified-Since and Range
+    def _send_static_file(self, filename):
+        asset = self.static_files.get(filename)
+        if asset is None:
+            self._set_not_found_response()
+            return
+        if asset.is_not_modified(self.headers):
+            self.send_response(304)
+            self.send_header('ETag', asset.etag)
+            self.send_header('Last-Modified', asset.last_modified)
+            self.end_headers()
+            return
+
+        byte_range = asset.get_range(self.headers)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(asset.size))
+            self.send_header('Content-Length', 0)
+            self.end_headers()
+            return
+
+        body = asset.data
+        first, last = byte_range if byte_range else (0, asset.size - 1)
+        self.send_response(206 if byte_range else 200)
+        if byte_range:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(first, last, asset.size))
+        elif asset.gzip_data is not None and "gzip" in self.headers.get('Accept-Encoding', ""):
+            body = asset.gzip_data
+            first, last = 0, len(body) - 1
+            self.send_header('Content-Encoding', 'gzip')
+        if asset.gzip_data is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-type', asset.content_type)
+        self.send_header('Content-Length', last - first + 1)
+        self.send_header('ETag', asset.etag)
+        self.send_header('Last-Modified', asset.last_modified)
+        self.send_header('Accept-Ranges', 'bytes')
+        if filename.endswith(".txt"):
+            log.debug("Forcing download of text file: %s", filename)
+            self.send_header('Content-Disposition', 'attachment; filename=%s' % filename)
+        self.end_headers() # Also calls flush_headers()
+
+        if body is not None:
+            self.wfile.write(body[first:last + 1] if byte_range else body)
+        else:
+            self.wfile.flush() # The headers are still in wfile's buffer
+            with open(asset.filepath, "rb") as f:
+                self.connection.sendfile(f, first, last - first + 1) # os.sendfile, the file never passes through Python
+
     def _set_not_found_response(self):
         self.send_response(404)
+        self.send_header('Content-Length', 0)
         self.end_headers()
 
     # Response is text or html
-    def _set_text_response(self):
+    def _set_text_response(self, content_length):
         self.send_response(200)
         self.send_header('Content-type', 'text/html')
-        self.end_headers() # Also calls flush_headers()
-
-    def _set_txt_file_response(self, filename, file_length):
-        self.send_response(200)
-        self.send_header('Content-type', 'text')
-        self.send_header('Content-Length', file_length)
-        self.send_header('Content-Disposition', 'attachment; filename=%s' % filename)
+        self.send_header('Content-Length', content_length)
         self.end_headers() # Also calls flush_headers()
 
     def _set_redirect_response(self, redirect_url):
         self.send_response(303) # Code: "See Other". 301 does not work, because it just changes the subdomain.
         self.send_header('Location', redirect_url)
+        self.send_header('Content-Length', 0)
         self.end_headers() # Also calls flush_headers()
     
-    def get_encoded_xml(self, response_action, post_req_info):
-        raw_xml = self.rb.interpret_post(response_action, post_req_info)
-        encoded = raw_xml.encode(ENCODING_USED)
-        return encoded
+    # Runs the message through the chatbot once, retries of it get the cached reply.
+    # started_at is when the request came in, WeChat's 5s start then.
+    # record is the request's capture record (see http_capture.py) or None, it gets the action and the turn's stages
+    def get_encoded_reply(self, post_req_info, started_at, record = None):
+        release = self.admission.releaser() # Called when the turn ends or is given up on, whichever comes first
+
+        def make_message():
+            if record is not None:
+                METRICS.start_trace()
+            try:
+                response_action = self._get_bot_response(post_req_info)
+                if record is not None:
+                    record["action"] = response_action.action_type
+                return self.rb.build_reply_message(response_action, post_req_info)
+            finally:
+                release() # Held until the turn is done, even if its reply goes out late (but see LateReplyKeeper's turn_timeout)
+                if record is not None:
+                    record["stages"].update(METRICS.stop_trace())
+
+        def answer():
+            uid = post_req_info.get("FromUserName", "")
+            shed_reason = self.admission.acquire(uid)
+            if shed_reason is not None:
+                log.warning("<ADMISSION> Shedding a message from %s: %s", uid, shed_reason)
+                if record is not None:
+                    record["action"] = BUSY_ACTION
+                return Uncached(busy_reply(post_req_info)) # Its retries get another go once there is room
+            return self.late_replies.answer(uid, make_message, started_at, release)
+
+        if record is not None:
+            record["action"] = CACHED_ACTION # Stays so if answer() is not called
+        return self.reply_cache.get_or_compute(reply_cache_key(post_req_info), answer, lambda: busy_reply(post_req_info))
+
+    def _send_metrics(self):
+        e_content = METRICS.render_prometheus().encode(ENCODING_USED)
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', len(e_content))
+        self.end_headers()
+        self.wfile.write(e_content)
 
     def do_GET(self):
-        logging.debug("GET request for {}".format(self.path).encode(ENCODING_USED))
+        log.debug("GET request for %s", self.path)
+        if self.path == METRICS_PATH:
+            self._send_metrics()
+            return
+        record = self.capture.sample("GET", self.path)
+        t0 = time.perf_counter()
         reply_flag, response_content = self.rb.interpret_get(self.path, self.headers)
+        if record is not None:
+            record["stages"]["interpret_get"] = time.perf_counter() - t0
+            record["action"] = reply_flag
         
         if reply_flag == "text":
-            self._set_text_response()
-            logging.info("GET response:\n{}".format(response_content))
+            log.info("GET response:\n%s", response_content)
             e_content = response_content.encode(ENCODING_USED)
+            self._set_text_response(len(e_content))
             self.wfile.write(e_content)
 
         elif reply_flag == "redirect":
-            logging.info("Redirecting GET request")
+            log.info("Redirecting GET request")
             self._set_redirect_response(response_content)    
         
         else:        
-            logging.info("<no_action> Calling the default GET response:\n{}".format(response_content))
+            log.debug("<no_action> Calling the default GET response:\n%s", response_content)
             self._default_GET_response()            
 
+        if record is not None:
+            record["status"] = self.status_sent
+            self.capture.add(record)
+
+    # The POST body size, or None after answering 411 (no Content-Length) or 400 (one that is not a number of bytes).
+    # send_error also sends Connection: close, so an unread body is never taken for the next request
+    def _content_length(self):
+        header = self.headers.get('Content-Length')
+        if header is None:
+            self.send_error(411)
+            return None
+        header = header.strip()
+        if CONTENT_LENGTH_RE.fullmatch(header) is None:
+            log.warning("Refusing a POST with Content-Length %r", header)
+            self.send_error(400, "Bad Content-Length")
+            return None
+        return int(header)
+
     def do_POST(self):
         def send_post_request(req_info, encoded_content):
-            self._set_text_response()
+            self._set_text_response(len(encoded_content))
             self.wfile.write(encoded_content)
 
-        content_length = int(self.headers['Content-Length']) # <--- Gets the size of data
+        started_at = time.time()
+        record = self.capture.sample("POST", self.path)
+        content_length = self._content_length() # <--- Gets the size of data
+        if content_length is None:
+            return # Already answered, the connection is closed since the body was not read
+        if content_length > MAX_BODY_BYTES:
+            log.warning("Refusing a POST body of %s bytes", content_length)
+            self.send_error(413)
+            return
         post_data_raw = self.rfile.read(content_length) # <--- Gets the data itself
-        post_req_info = decode_post(post_data_raw)
+        t0 = time.perf_counter()
+        try:
+            post_req_info = decode_post(post_data_raw)
+        except DECODE_ERRORS as e:
+            log.warning("Refusing a POST body that does not decode: %s", e)
+            self.send_error(400)
+            return
+        t1 = time.perf_counter()
+        METRICS.observe("decode_post", t1 - t0)
 
-        logging.info("POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
+        log.debug("POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
                 str(self.path), str(self.headers), post_req_info)
 
-        response_action = self._get_bot_response(post_req_info)
-        encoded = self.get_encoded_xml(response_action, post_req_info)
+        t2 = time.perf_counter()
+        encoded = self.get_encoded_reply(post_req_info, started_at, record)
+        t3 = time.perf_counter()
+        METRICS.observe("get_encoded_reply", t3 - t2)
         send_post_request(post_req_info, encoded)
+
+        if record is not None:
+            record["stages"]["decode_post"] = t1 - t0
+            record["stages"]["get_encoded_reply"] = t3 - t2
+            record["status"] = 200
+            self.capture.add(record, post_req_info)
         
 
+# Puts the counters of the shared server parts on /metrics
+def register_metrics(handler_class):
+    def session_metrics():
+        chatbot = handler_class.chatbot
+        return chatbot.get_session_metrics() if hasattr(chatbot, "get_session_metrics") else {}
+
+    METRICS.add_collector("admission", handler_class.admission.get_metrics, handler_class.admission.METRIC_COUNTERS)
+    METRICS.add_collector("reply_cache", handler_class.reply_cache.get_metrics, handler_class.reply_cache.METRIC_COUNTERS)
+    METRICS.add_collector("late_replies", handler_class.late_replies.get_metrics, handler_class.late_replies.METRIC_COUNTERS)
+    METRICS.add_collector("static_files", handler_class.static_files.get_metrics, handler_class.static_files.METRIC_COUNTERS)
+    METRICS.add_collector("jobs", handler_class.rb.jobs.get_metrics, handler_class.rb.jobs.METRIC_COUNTERS)
+    METRICS.add_collector("users", lambda: {"active": handler_class.user_locks.active_users()})
+    METRICS.add_collector("sessions", session_metrics, Chatbot.SESSION_METRIC_COUNTERS)
+    METRICS.add_collector("capture", handler_class.capture.get_metrics, handler_class.capture.METRIC_COUNTERS)
+    METRICS.add_collector("logging", get_logging_metrics, LOGGING_METRIC_COUNTERS)
+
 # The main function to run a server for real
-def run(server_class=HTTPServer, handler_class=ChatbotServer, port=DEFAULT_PORT):
+# Pass server_class=HTTPServer for the old single threaded mode
+# capture_rate: share of requests (0-1) written to capture.jsonl for replays, see http_capture.py
+# log_levels: per module levels on top of logging_level, see chatbot/cb_logging.py
+def run(server_class=ThreadedHTTPServer, handler_class=ChatbotServer, port=DEFAULT_PORT, capture_rate=None, log_levels=SERVER_LOG_LEVELS):
     logging_level = logging.INFO # Others include logging.DEBUG, logging.WARNING 
 
-    logging.basicConfig(level=logging_level)
+    setup_logging(logging_level, log_levels)
+    if handler_class.chatbot is None:
+        handler_class.chatbot = start_chatbot()
+    handler_class.rb.start_jobs()
+    if capture_rate:
+        handler_class.capture = TrafficCapture(sample_rate=capture_rate)
+    handler_class.capture.start()
+    register_metrics(handler_class)
     server_address = ('0.0.0.0', port)
     httpd = server_class(server_address, handler_class)
-    logging.info('Starting http server on {}...\n'.format(server_address))
+    log.info('Starting http server on %s...\n', server_address)
     try:
         print("Serving forever on localhost:{}...".format(port))
         httpd.serve_forever()
     except KeyboardInterrupt:
         pass
     httpd.server_close()
-    logging.critical('Stopping http server...\n')
+    handler_class.capture.stop()
+    log.critical('Stopping http server...\n')
+    stop_logging()
 
 if __name__ == '__main__':
     from sys import argv
 
-    if len(argv) == 2:
-        run(port=int(argv[1]))
+    # python http_server.py [port] [single] [capture=RATE]
+    port = int(argv[1]) if len(argv) > 1 else DEFAULT_PORT
+    capture_rate = None
+    for arg in argv[2:]:
+        if arg.startswith("capture="):
+            capture_rate = float(arg[len("capture="):])
+    if "single" in argv[2:]:
+        run(server_class=HTTPServer, port=port, capture_rate=capture_rate)
     else:
-        run()
+        run(port=port, capture_rate=capture_rate)
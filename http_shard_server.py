@@ -0,0 +1,203 @@
+import gc
+import logging
+import multiprocessing
+import os
+import threading
+import zlib
+
+from multiprocessing.connection import Connection
+from multiprocessing.reduction import recv_handle, send_handle
+
+from chatbot.cb_logging import SERVER_LOG_LEVELS, setup_logging
+from chatbot.chatbot import Chatbot # Defined in ./chatbot
+from chatbot.initalizers import master_initalize
+import http_server
+from http_server import ChatbotServer, CHATBOT_RESOURCE_FILENAME, DEFAULT_PORT
+from http_late_reply import TURN_TIMEOUT
+
+log = logging.getLogger("http_shard_server") # Named, not __name__, so it is the same when run as __main__
+
+# Prefork version of http_server.py to use more than one core.
+# The resources are read once by master_initalize, then N worker processes are forked and share them copy-on-write.
+# Workers are forked by a supervisor process, itself forked before the front process starts any thread,
+# so a worker (also one replacing a dead worker) never inherits a lock held by some other thread.
+# Each worker owns a Chatbot (its own chats, journal and database file) and answers the users hashed to it.
+# The front process stays a normal http_server: it decodes the WeChat XML, keeps the per-user ordering
+# and the RequestBoss (openid callbacks, payments), and only asks the worker for the ResponseAction.
+# NOTE: users are hashed by the number of shards. Changing it moves users to a shard that does not have their journal.
+
+DEFAULT_SHARDS = os.cpu_count() or 1
+JOURNAL_FILENAME = "sessions.{}.journal"
+DB_FILENAME = "database.{}.json"
+
+# Same shard for the same user across restarts (hash() of a str is not)
+def shard_of(user_ID, n_shards):
+    return zlib.crc32(user_ID.encode("utf-8")) % n_shards
+
+# Main loop of a worker process. Answers (req_ID, user_ID, msg) with (req_ID, ok, ResponseAction or error text)
+def _shard_main(conn, shard_ID, components):
+    setup_logging(logging.INFO, SERVER_LOG_LEVELS) # The parent's log writer thread does not survive the fork
+    bot = Chatbot(journal_path=os.path.join(os.getcwd(), JOURNAL_FILENAME.format(shard_ID)))
+    bot.start_bot(components=components, backend_read=False, db_filename=DB_FILENAME.format(shard_ID))
+    log.info("<SHARD %s> Worker %s ready", shard_ID, os.getpid())
+    while True:
+        try:
+            req_ID, user_ID, msg = conn.recv()
+        except EOFError:
+            break # Front process is gone
+        try:
+            out = (req_ID, True, bot.get_bot_response(user_ID, msg))
+        except Exception as e:
+            log.exception("<SHARD %s> Turn failed for %s", shard_ID, user_ID)
+            out = (req_ID, False, "{}: {}".format(type(e).__name__, e))
+        conn.send(out)
+
+# Main loop of the supervisor. Single threaded, it only forks workers.
+# Reads a shard ID, forks a worker for it and sends back the front's end of the pipe to that worker.
+def _supervisor_main(conn, components):
+    while True:
+        try:
+            shard_ID = conn.recv()
+        except EOFError:
+            break # Front process is gone
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG) # Reap dead workers
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+        parent_conn, child_conn = multiprocessing.Pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                conn.close()
+                parent_conn.close()
+                _shard_main(child_conn, shard_ID, components)
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code) # Never go back into the supervisor loop
+        child_conn.close()
+        send_handle(conn, parent_conn.fileno(), None)
+        parent_conn.close()
+
+# Front process side of the supervisor
+class ShardSupervisor:
+    def __init__(self, components, mp_context):
+        self.lock = threading.Lock() # One request at a time on conn
+        self.conn, child_conn = mp_context.Pipe()
+        self.process = mp_context.Process(target=_supervisor_main, args=(child_conn, components), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    # Forks a new worker for shard_ID. Returns the connection to it
+    def start_worker(self, shard_ID):
+        with self.lock:
+            try:
+                self.conn.send(shard_ID)
+                fd = recv_handle(self.conn)
+            except (EOFError, OSError) as e:
+                raise Exception("Shard supervisor is down: {}".format(e))
+        return Connection(fd)
+
+# Front process side of one worker. Any number of request threads can ask at once,
+# a reader thread hands each reply to the thread waiting for it.
+class Shard:
+    def __init__(self, shard_ID, supervisor, timeout = TURN_TIMEOUT):
+        self.shard_ID = shard_ID
+        self.supervisor = supervisor
+        self.timeout = timeout
+        self.lock = threading.Lock() # Guards conn, waiting and next_ID
+        self.waiting = {} # req_ID -> [Event, ok, result]
+        self.next_ID = 0
+        self.conn = None
+        self._attach(supervisor.start_worker(shard_ID))
+
+    # Call with self.lock held (or from __init__)
+    def _attach(self, conn):
+        self.conn = conn
+        reader = threading.Thread(target=self._read_replies, args=(conn,), daemon=True)
+        reader.start()
+
+    def _read_replies(self, conn):
+        while True:
+            try:
+                req_ID, ok, result = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                slot = self.waiting.pop(req_ID, None)
+            if slot is not None:
+                slot[1] = ok
+                slot[2] = result
+                slot[0].set()
+
+        # The worker died. Fail everyone waiting on it and have the supervisor start a new one
+        log.critical("<SHARD %s> Worker exited, starting a new one", self.shard_ID)
+        conn.close()
+        with self.lock:
+            self.conn = None
+            waiting, self.waiting = self.waiting, {}
+        for slot in waiting.values():
+            slot[2] = "Worker exited"
+            slot[0].set()
+        try:
+            new_conn = self.supervisor.start_worker(self.shard_ID)
+        except Exception as e:
+            log.critical("<SHARD %s> Could not start a new worker: %s", self.shard_ID, e)
+            return
+        with self.lock:
+            self._attach(new_conn)
+
+    # Blocks until the worker answers, for at most self.timeout seconds. Returns a ResponseAction
+    def ask(self, user_ID, msg):
+        slot = [threading.Event(), False, None]
+        with self.lock:
+            if self.conn is None:
+                raise Exception("Shard {} is down".format(self.shard_ID))
+            self.next_ID += 1
+            req_ID = self.next_ID
+            self.waiting[req_ID] = slot
+            try:
+                self.conn.send((req_ID, user_ID, msg))
+            except (OSError, ValueError) as e:
+                self.waiting.pop(req_ID, None)
+                raise Exception("Shard {} is down: {}".format(self.shard_ID, e))
+        if not slot[0].wait(self.timeout):
+            with self.lock:
+                self.waiting.pop(req_ID, None) # The reply, if it ever comes, is dropped
+            raise Exception("Shard {} did not answer in {}s".format(self.shard_ID, self.timeout))
+        if not slot[1]:
+            raise Exception("Shard {} could not answer: {}".format(self.shard_ID, slot[2]))
+        return slot[2]
+
+# Stands in for the Chatbot of ChatbotServer. Make it before starting any thread (logging included)
+class ShardPool:
+    def __init__(self, n_shards, components, timeout = TURN_TIMEOUT):
+        mp_context = multiprocessing.get_context("fork") # Workers must inherit the loaded components
+        self.supervisor = ShardSupervisor(components, mp_context)
+        self.shards = [Shard(i, self.supervisor, timeout) for i in range(n_shards)]
+
+    def get_bot_response(self, chatID, msg, op_print = True):
+        return self.shards[shard_of(chatID, len(self.shards))].ask(chatID, msg)
+
+def run(port = DEFAULT_PORT, n_shards = DEFAULT_SHARDS):
+    # No setup_logging yet, its writer thread must not exist when the supervisor is forked. Warnings still go to stderr
+    components = master_initalize(CHATBOT_RESOURCE_FILENAME)
+    if hasattr(gc, "freeze"):
+        gc.freeze() # Python 3.7+. Keeps the collector from touching (and so copying) the shared pages in the workers
+    pool = ShardPool(n_shards, components)
+    setup_logging(logging.INFO, SERVER_LOG_LEVELS)
+    log.info("Started %s chatbot shards", n_shards)
+    ChatbotServer.chatbot = pool
+    http_server.run(port=port)
+
+if __name__ == "__main__":
+    from sys import argv
+
+    # python http_shard_server.py [port] [shards]
+    port = int(argv[1]) if len(argv) > 1 else DEFAULT_PORT
+    n_shards = int(argv[2]) if len(argv) > 2 else DEFAULT_SHARDS
+    run(port=port, n_shards=n_shards)
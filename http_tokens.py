@@ -0,0 +1,223 @@
+import logging
+import threading
+import time
+import wechat_dev as wd
+
+from collections import OrderedDict
+
+from http_utils import RequestSender
+
+log = logging.getLogger(__name__)
+
+# Access tokens and openids from WeChat, fetched as rarely as possible.
+# - The access token (for the customer service API etc.) is cached until shortly before it expires.
+#   In the last TOKEN_REFRESH_MARGIN seconds one thread refreshes it in the background while everyone keeps using the old one.
+# - The code from the openid callback is exchanged for an openid once. The answer is kept for as long as the code lives,
+#   WeChat refuses a code the second time.
+# - Concurrent requests for the same thing wait on one upstream call (single-flight) instead of all going out.
+
+WECHAT_API_BASE = "https://api.weixin.qq.com"
+TOKEN_PATH = "/cgi-bin/token"
+OAUTH_PATH = "/sns/oauth2/access_token"
+
+TOKEN_REFRESH_MARGIN = 300 # Seconds before expiry when the token is refreshed
+CODE_TTL = 5 * 60 # A callback code is good for 5 minutes
+MAX_CACHED_CODES = 10000
+INVALID_TOKEN_ERRCODES = {40001, 40014, 42001} # Answers that mean our access token is no good anymore
+
+# Runs fn once for all the threads asking for the same key at the same time
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {} # key -> [done Event, result, error]
+
+    def in_flight(self, key):
+        with self.lock:
+            return key in self.calls
+
+    # Returns (result of fn, True if it was another thread's call)
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = [threading.Event(), None, None]
+                self.calls[key] = call
+
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1], True
+
+        try:
+            call[1] = fn()
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key)
+            call[0].set()
+        return call[1], False
+
+class TokenManager:
+    def __init__(self, api_base = WECHAT_API_BASE, refresh_margin = TOKEN_REFRESH_MARGIN, code_ttl = CODE_TTL):
+        self.api_base = api_base
+        self.refresh_margin = refresh_margin
+        self.code_ttl = code_ttl
+        self.sender = RequestSender()
+        self.flights = SingleFlight()
+        self.lock = threading.Lock()
+        self.token = None
+        self.token_expiry = 0
+        self.codes = OrderedDict() # code -> (OAuth reply, expires_at). Oldest first
+        self.metrics = {
+            "token_requests": 0,
+            "token_upstream": 0,
+            "code_requests": 0,
+            "code_upstream": 0,
+            "shared_waits": 0,
+        }
+
+    def _count(self, key):
+        with self.lock:
+            self.metrics[key] += 1
+
+    def _fetch_token(self):
+        self._count("token_upstream")
+        params = {
+            "grant_type": "client_credential",
+            "appid": wd.get_wechat_app_id(),
+            "secret": wd.get_secret_key(),
+        }
+        reply = self.sender.get_json(self.api_base + TOKEN_PATH, params)
+        if not "access_token" in reply:
+            raise Exception("Could not get an access token: {}".format(reply))
+        with self.lock:
+            self.token = reply["access_token"]
+            self.token_expiry = time.time() + int(reply.get("expires_in", 7200))
+        return reply["access_token"]
+
+    def _refresh_in_background(self):
+        def refresh():
+            try:
+                self.flights.do("token", self._fetch_token)
+            except Exception as e:
+                log.error("<TOKENS> Background token refresh failed: %s", e)
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def get_access_token(self):
+        self._count("token_requests")
+        now = time.time()
+        with self.lock:
+            token = self.token
+            expiry = self.token_expiry
+        if token is not None and now < expiry:
+            if now > expiry - self.refresh_margin and not self.flights.in_flight("token"):
+                self._refresh_in_background()
+            return token
+
+        token, shared = self.flights.do("token", self._fetch_token)
+        if shared:
+            self._count("shared_waits")
+        return token
+
+    # Call when WeChat says the token is invalid (see INVALID_TOKEN_ERRCODES), the next caller gets a new one
+    def invalidate_token(self, token):
+        with self.lock:
+            if self.token == token:
+                self.token = None
+
+    # Cached before the flight ends, so nobody sends the same code twice
+    def _fetch_openid(self, code):
+        cached = self._cached_code(code)
+        if cached is not None:
+            return cached # A flight for this code ended between our cache miss and now
+        self._count("code_upstream")
+        params = {
+            "appid": wd.get_wechat_app_id(),
+            "secret": wd.get_secret_key(),
+            "code": code,
+            "grant_type": "authorization_code",
+        }
+        reply = self.sender.get_json(self.api_base + OAUTH_PATH, params)
+        if not "openid" in reply:
+            raise Exception("Could not exchange code {}: {}".format(code, reply))
+
+        now = time.time()
+        with self.lock:
+            self.codes[code] = (reply, now + self.code_ttl)
+            # Codes expire in the order they came in
+            while self.codes:
+                oldest_reply, expires_at = next(iter(self.codes.values()))
+                if expires_at > now and len(self.codes) <= MAX_CACHED_CODES:
+                    break
+                self.codes.popitem(last=False)
+        return reply
+
+    def _cached_code(self, code):
+        with self.lock:
+            cached = self.codes.get(code)
+            if cached is not None and cached[1] > time.time():
+                return cached[0]
+        return None
+
+    # Returns WeChat's OAuth reply for the code (openid, access_token, scope...)
+    def exchange_code(self, code):
+        self._count("code_requests")
+        cached = self._cached_code(code)
+        if cached is not None:
+            return cached
+
+        reply, shared = self.flights.do("code:" + code, lambda: self._fetch_openid(code))
+        if shared:
+            self._count("shared_waits")
+        return reply
+
+    # Upstream calls saved = requests - upstream
+    def get_metrics(self):
+        with self.lock:
+            out = self.metrics.copy()
+        out["upstream_saved"] = (out["token_requests"] + out["code_requests"]) - (out["token_upstream"] + out["code_upstream"])
+        return out
+
+_shared_manager = None
+_shared_manager_lock = threading.Lock()
+
+# The manager everyone should use, so the token is fetched once per process
+def get_token_manager():
+    global _shared_manager
+    with _shared_manager_lock:
+        if _shared_manager is None:
+            _shared_manager = TokenManager()
+        return _shared_manager
+
+# Many threads asking for tokens and openids at once, against http_wechat_stub.py
+def run_demo(n_threads = 200, n_codes = 20, api_delay = 0.05, port = 9103):
+    from concurrent.futures import ThreadPoolExecutor
+    from http_wechat_stub import start_stub, WeChatStubHandler
+
+    WeChatStubHandler.api_delay = api_delay
+    stub = start_stub(port)
+    manager = TokenManager(api_base="http://127.0.0.1:{}".format(port))
+
+    def one(i):
+        manager.get_access_token()
+        return manager.exchange_code("code{}".format(i % n_codes))["openid"]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=50) as pool:
+        openids = list(pool.map(one, range(n_threads)))
+    elapsed = time.perf_counter() - start
+    stub.shutdown()
+
+    metrics = manager.get_metrics()
+    print("{} callers, {} distinct codes, {:.0f}ms per upstream call".format(n_threads, n_codes, api_delay * 1000))
+    print("Token requests: {token_requests} -> upstream {token_upstream}".format(**metrics))
+    print("Code exchanges: {code_requests} -> upstream {code_upstream}".format(**metrics))
+    print("Upstream calls saved: {} | Waited on another call: {} | Took {:.2f}s".format(metrics["upstream_saved"], metrics["shared_waits"], elapsed))
+    assert len(set(openids)) == n_codes
+
+if __name__ == "__main__":
+    run_demo()
@@ -1,36 +1,50 @@
+import json
 import logging
-import requests
+import re
 import urllib.parse as parse
 
+from http_outbound import get_client
 from xml.etree import ElementTree
 
 ENCODING_USED = "utf-8"
+MAX_BODY_BYTES = 64 * 1024 # WeChat messages are a few hundred bytes. Anything much bigger is not from WeChat
+
+log = logging.getLogger(__name__)
 
 # Class to handle the sending of simple GET and POST requests
+# Goes through the shared pooled client in http_outbound.py, so connections to WeChat are reused
 class RequestSender:
+    def __init__(self, client = None):
+        self.client = client or get_client()
+
     # Returns a Request object
     def send_GET(self, url, req_params = ""):
         param_dict = {
             "body":req_params
         }
-        return requests.get(url, params=param_dict)
+        return self.client.get(url, params=param_dict)
 
     # Returns a Request object
     def send_POST(self, url, data = {}):
         headers = {'Content-Type': 'text/html'}
         e_data = data.encode(ENCODING_USED)
-        return requests.post(url=url, data=e_data, headers = headers)
+        return self.client.post(url=url, data=e_data, headers = headers)
+
+    # For the WeChat JSON APIs. Returns the decoded JSON reply
+    def get_json(self, url, params = None):
+        return self.client.get(url, params=params).json()
+
+    # For the WeChat JSON APIs. Returns the decoded JSON reply
+    def post_json(self, url, obj, params = None):
+        headers = {'Content-Type': 'application/json'}
+        e_data = json.dumps(obj, ensure_ascii=False).encode(ENCODING_USED) # WeChat wants the Chinese as is, not \u escaped
+        return self.client.post(url=url, params=params, data=e_data, headers = headers).json()
 
 ############# HTTP Request utils #############
 # Converts "A=B&C=D" to {'A':B, 'C':D}
+# Values are url-decoded, a key given twice keeps the last value
 def html_msg_to_dict(hmsg):
-    hmsg = "'" + hmsg
-    hmsg = hmsg.replace("&", "', '")
-    hmsg = hmsg.replace("=", "' :'")
-    hmsg = hmsg + "'"
-    hmsg_str = "{" + hmsg + "}"
-    c_dict = eval(hmsg_str)
-    return c_dict
+    return dict(parse.parse_qsl(hmsg, keep_blank_values=True))
 
 # Puts all the url query arguments into a dict
 def url_path_to_dict(url_path):
@@ -56,17 +70,21 @@ def get_req_sender(r):
 
 # Takes in a dict
 def get_ip_from_header(header_dict):
-    logging.debug("HEADERS {}".format(list(header_dict.items())))
+    log.debug("HEADERS %s", list(header_dict.items()))
     ip = header_dict["X-Forwarded-For"]
     return ip
 
 ############# DATA UTILITIES #############
-# Wechat can send data in the form of XML or JSON.
+DECODE_ERRORS = (ValueError, ElementTree.ParseError) # What decode_post raises for a body it cannot read. Answer those with a 400
+
+# Wechat can send data in the form of XML or JSON. Our own test tools send url-encoded forms.
 # Takes in a string of bytes (encoded)
 # Returns a dict
 def decode_post(byte_string):
+    if len(byte_string) > MAX_BODY_BYTES:
+        raise ValueError("POST body of {} bytes is over the {} byte limit".format(len(byte_string), MAX_BODY_BYTES))
     decoded_str = byte_string.decode(ENCODING_USED)
-    logging.info("Decoded post:{}".format(decoded_str))
+    log.debug("Decoded post:%s", decoded_str)
     if is_xml(decoded_str):
         return decode_post_xml(decoded_str)
     else:
@@ -77,8 +95,49 @@ def is_xml(data_string):
         return data_string[:5] == "<xml>"
     return False
 
+# One flat child of <xml>: <Tag><![CDATA[text]]></Tag> or <Tag>text</Tag>
+XML_FIELD_RE = re.compile(r"<([A-Za-z_][\w.-]*)>(?:<!\[CDATA\[(.*?)\]\]>|([^<>&]*))</\1>\s*", re.S)
+XML_HEAD_RE = re.compile(r"<xml>(\s*)")
+XML_TAIL_RE = re.compile(r"</xml>\s*$")
+
+# Fast path for what WeChat sends: <xml> with flat fields (ToUserName, FromUserName, CreateTime, MsgType, Content, MsgId, Event...)
+# Gives the same dict as decode_post_xml_generic, or None if the message has any other shape
+# (nested tags, attributes, entities, split CDATA...) and needs the real parser
+def decode_post_xml_fast(xml_data_string):
+    if "\r" in xml_data_string:
+        return None # The XML parser turns \r\n into \n, leave that to it
+    head = XML_HEAD_RE.match(xml_data_string)
+    if head is None:
+        return None
+    data_d = {"xml": head.group(1) or None}
+    pos = head.end()
+    match_field = XML_FIELD_RE.match
+    while True:
+        m = match_field(xml_data_string, pos)
+        if m is None:
+            break
+        tag, cdata, text = m.groups()
+        if cdata is not None:
+            if "]]>" in cdata:
+                return None # Two CDATA sections back to back
+            data_d[tag] = cdata or None
+        else:
+            data_d[tag] = text or None
+        pos = m.end()
+    if XML_TAIL_RE.match(xml_data_string, pos) is None:
+        return None
+    return data_d
+
 # Return a dict of the arguments
 def decode_post_xml(xml_data_string):
+    data_d = decode_post_xml_fast(xml_data_string)
+    if data_d is None:
+        data_d = decode_post_xml_generic(xml_data_string)
+    log.debug("XML decoded data: %s", data_d)
+    return data_d
+
+# Any XML. Every element's tag -> its text, the root included
+def decode_post_xml_generic(xml_data_string):
     def dict_from_root(root):
         d = {}
         for n in root.iter():
@@ -88,15 +147,23 @@ def decode_post_xml(xml_data_string):
 
         return d
     root = ElementTree.fromstring(xml_data_string)
-    logging.info("XML root object: {}".format(root))
-    data_d = dict_from_root(root)
-    
-    logging.info("XML decoded data: {}".format(data_d))
-    return data_d
+    return dict_from_root(root)
 
+# JSON events ({"ToUserName": ..., "MsgType": "event", ...}) or a url-encoded form ("userID=..&message=..")
 def decode_post_json(data_string):
-    data_d = eval(data_string)
-    print("<DECODE POST JSON>\r\nIS dict:", isinstance(data_d, dict))
-    print("IS set:", isinstance(data_d, set))
-    return data_d 
+    stripped = data_string.strip()
+    if stripped[:1] == "{":
+        try:
+            data_d = json.loads(stripped)
+        except ValueError as e:
+            raise ValueError("POST body is not valid JSON: {}".format(e))
+        except RecursionError:
+            raise ValueError("POST body is JSON nested too deep to decode")
+    elif "=" in stripped:
+        data_d = html_msg_to_dict(stripped)
+    else:
+        raise ValueError("POST body is neither XML, JSON nor a form: {!r}".format(stripped[:100]))
 
+    if not isinstance(data_d, dict):
+        raise ValueError("POST body decoded to a {}, not a dict".format(type(data_d).__name__))
+    return data_d
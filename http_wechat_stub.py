@@ -0,0 +1,141 @@
+import json
+import logging
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib import parse
+
+log = logging.getLogger(__name__)
+
+# Local stand-in for the WeChat APIs the server calls, for testing without a real official account.
+#   GET  /cgi-bin/token                  -> a fake access token
+#   GET  /sns/oauth2/access_token        -> openid "o_<code>" for the code
+#   POST /cgi-bin/message/custom/send    -> records the customer service message
+#   POST /pay/unifiedorder               -> records the order, answers SUCCESS (or FAIL for the next pay_failures orders)
+# http_outbound.py also benchmarks against it.
+# Point the senders at it, e.g. LateReplyKeeper(sender=CustomerServiceSender(api_base="http://localhost:9100"))
+
+DEFAULT_STUB_PORT = 9100
+STUB_ACCESS_TOKEN = "STUB_ACCESS_TOKEN"
+
+class WeChatStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, every reply has a Content-Length
+    disable_nagle_algorithm = True # Headers and body are written separately. With Nagle a kept-alive reply waits ~40ms on the ACK
+    connect_delay = 0 # Seconds added to every new connection, to play the TCP+TLS handshake to the real API
+    api_delay = 0 # Seconds added to every token/openid call, to play a slow WeChat
+    received = [] # Customer service messages, in the order they came in
+    orders = [] # out_trade_no of every pay request
+    pay_failures = 0 # Answer this many pay requests with FAIL, to test retries
+    calls = {} # Path -> number of calls
+    lock = threading.Lock()
+
+    def setup(self):
+        if self.connect_delay:
+            time.sleep(self.connect_delay)
+        super().setup()
+
+    def _count_call(self, path):
+        with self.lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+
+    def _send_json(self, obj, code = 200):
+        encoded = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', len(encoded))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def do_GET(self):
+        url = parse.urlparse(self.path)
+        self._count_call(url.path)
+        query = dict(parse.parse_qsl(url.query))
+        if self.api_delay:
+            time.sleep(self.api_delay)
+
+        if url.path == "/cgi-bin/token":
+            self._send_json({"access_token": STUB_ACCESS_TOKEN, "expires_in": 7200})
+        elif url.path == "/sns/oauth2/access_token":
+            code = query.get("code")
+            if not code:
+                self._send_json({"errcode": 40029, "errmsg": "invalid code"})
+                return
+            self._send_json({
+                "access_token": "STUB_OAUTH_TOKEN",
+                "expires_in": 7200,
+                "refresh_token": "STUB_REFRESH_TOKEN",
+                "openid": "o_" + code,
+                "scope": "snsapi_base"
+            })
+        else:
+            self._send_json({"errcode": 404, "errmsg": "no such api"}, code=404)
+
+    def do_POST(self):
+        url = parse.urlparse(self.path)
+        self._count_call(url.path)
+        content_length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(content_length)
+        query = dict(parse.parse_qsl(url.query))
+
+        if url.path == "/pay/unifiedorder":
+            self._answer_pay_request(body.decode("utf-8"))
+        elif url.path == "/cgi-bin/message/custom/send":
+            if query.get("access_token") != STUB_ACCESS_TOKEN:
+                self._send_json({"errcode": 40001, "errmsg": "invalid credential"})
+                return
+            with self.lock:
+                self.received.append(json.loads(body.decode("utf-8")))
+            self._send_json({"errcode": 0, "errmsg": "ok"})
+        else:
+            self._send_json({"errcode": 404, "errmsg": "no such api"}, code=404)
+
+    def _answer_pay_request(self, xml):
+        found = re.search(r"<out_trade_no>(.*?)</out_trade_no>", xml)
+        with self.lock:
+            self.orders.append(found.group(1) if found else None)
+            failing = WeChatStubHandler.pay_failures > 0
+            if failing:
+                WeChatStubHandler.pay_failures -= 1
+        if failing:
+            reply = "<xml><return_code><![CDATA[FAIL]]></return_code><return_msg><![CDATA[SYSTEMERROR]]></return_msg></xml>"
+        else:
+            reply = ("<xml><return_code><![CDATA[SUCCESS]]></return_code><return_msg><![CDATA[OK]]></return_msg>"
+                     "<result_code><![CDATA[SUCCESS]]></result_code><prepay_id><![CDATA[wx_stub_prepay]]></prepay_id></xml>")
+        encoded = reply.encode("utf-8")
+        self.send_response(200)
+        self.send_header('Content-type', 'text/xml')
+        self.send_header('Content-Length', len(encoded))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        log.debug("<WECHAT STUB> " + format, *args)
+
+class ThreadedStubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+# Starts the stub on a background thread and returns the server. Call server.shutdown() to stop it
+def start_stub(port = DEFAULT_STUB_PORT):
+    httpd = ThreadedStubServer(('127.0.0.1', port), WeChatStubHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+def run(port = DEFAULT_STUB_PORT):
+    logging.basicConfig(level=logging.DEBUG)
+    httpd = ThreadedStubServer(('0.0.0.0', port), WeChatStubHandler)
+    print("WeChat stub serving on localhost:{}...".format(port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.server_close()
+
+if __name__ == "__main__":
+    from sys import argv
+
+    # python http_wechat_stub.py [port]
+    run(port=int(argv[1]) if len(argv) > 1 else DEFAULT_STUB_PORT)
@@ -1,16 +1,20 @@
 import logging
-import time
 import wechat_dev as wd
 import http_auth_control as auth_ctrl
 
 from urllib import parse
-from http_utils import RequestSender, decode_post
+from http_tokens import get_token_manager
+from http_utils import RequestSender, decode_post, ENCODING_USED
+from http_wx_xml import text_reply, flat_xml
 
 NONCE_STR = "1add1a30ac87aa2db72f57a2375d8fec"
 
+log = logging.getLogger(__name__)
+
 # Class to carry message contents.
 class WechatMessage():
-    def to_wechat_reply_xml(self):
+    # The reply XML as bytes, ready to send
+    def to_wechat_reply_bytes(self):
         pass
 
 class WechatTextMessage(WechatMessage):
@@ -24,25 +28,13 @@ class WechatTextMessage(WechatMessage):
     def init_extra(self, extra_args):
         pass
 
-    def to_wechat_reply_xml(self):
-        msg_info = self.og_req_info
-        xml = (
-            "<xml>"
-            "<ToUserName><![CDATA[%s]]></ToUserName>"
-            "<FromUserName><![CDATA[%s]]></FromUserName>"
-            "<CreateTime>%s</CreateTime>"
-            "<MsgType><![CDATA[text]]></MsgType>"
-            "<Content><![CDATA[%s]]></Content>"
-            "</xml>"
-        ) % (
-        msg_info['FromUserName'], 
-        msg_info['ToUserName'],
-        time.gmtime(),
-        self.reply_content
-        )
-        # Because its a reply, the from and to are swapped
-        logging.info("POST reponse:\n{}".format(self.reply_content))
-        return xml
+    # The text shown to the user. Also used when the reply is sent later as a customer service message
+    def get_reply_content(self):
+        return self.reply_content
+
+    def to_wechat_reply_bytes(self):
+        log.info("POST reponse:\n%s", self.reply_content)
+        return text_reply(self.og_req_info, self.reply_content) # Because its a reply, the from and to are swapped
 
 class WeChatAuthMessage(WechatTextMessage):
     # super(WechatPaymentRequest, self).__init__(r_action, og_reqest_info) # Superclass initalizer for reference
@@ -52,7 +44,7 @@ class WeChatAuthMessage(WechatTextMessage):
     def init_extra(self, extra_args):
         def build_callback_url(state_id):
             encoded_url = parse.quote_plus(wd.get_openid_notify_url()) # urllib's parse encodes the url
-            print("<WECHAT AUTH MSG BUILD URL>", encoded_url)
+            log.debug("<WECHAT AUTH MSG BUILD URL> %s", encoded_url)
             params = {
                 "app_id": wd.get_wechat_app_id(),
                 "notify_url": encoded_url,
@@ -111,6 +103,19 @@ class WechatPaymentRequest(WechatTextMessage):
     def set_openid(self, openid):
         self.curr_open_id = openid
 
+    # The same order must keep the same out_trade_no, WeChat uses it to spot duplicates
+    def set_out_trade_no(self, out_trade_no):
+        self.request_data["out_trade_no"] = out_trade_no
+
+    def get_out_trade_no(self):
+        return self.request_data["out_trade_no"]
+
+    # The request before it is signed. For the payment job, which fills in the openid and signs it
+    def get_unsigned_data(self):
+        out = dict(self.request_data)
+        out.pop("sign", None)
+        return out
+
     def _get_request_data(self):
         return self.request_data
     
@@ -139,7 +144,7 @@ class WechatPaymentRequest(WechatTextMessage):
         def add_data_to_reply_content(data):
             return_flag = data.get("return_code")
             return_msg = data.get("return_msg")
-            logging.warn("RETURN FLAG IS %s with msg: %s" % (return_flag, return_msg))
+            log.warning("RETURN FLAG IS %s with msg: %s", return_flag, return_msg)
             if return_flag == "FAIL":
                 content = "联系失败"
             elif return_flag == "SUCCESS":
@@ -154,8 +159,8 @@ class WechatPaymentRequest(WechatTextMessage):
             return
         wx_pay_link_reply = self._send_request_pay_link()
         wx_pl_dict = decode_post(wx_pay_link_reply)
-        logging.critical("<GET_WX_PAY_REQUEST> PAY REQUEST RESPONSE {}".format(wx_pl_dict))
-        logging.info("<RESPONSE_TO_XML> PAY REQUEST RESPONSE {}".format(wx_pl_dict))
+        log.critical("<GET_WX_PAY_REQUEST> PAY REQUEST RESPONSE %s", wx_pl_dict)
+        log.info("<RESPONSE_TO_XML> PAY REQUEST RESPONSE %s", wx_pl_dict)
         add_data_to_reply_content(wx_pl_dict)
         return wx_pl_dict
 
@@ -187,13 +192,32 @@ class WechatPaymentRequest(WechatTextMessage):
         
         self._add_signature() # This adds signature to request_data
         
-        xml_formatted = "<xml>"
-        for param_name, param_val in self._get_request_data().items():
-            xml_formatted += "<{0}>{1}</{0}>".format(param_name, param_val) # XML entry format
-        xml_formatted += "</xml>"
-        logging.info(("PAYMENT XML FORMATTED:", xml_formatted))
+        xml_formatted = flat_xml(self._get_request_data()).decode(ENCODING_USED) # Str, it is kept in the job queue's JSON
+        log.info("PAYMENT XML FORMATTED: %s", xml_formatted)
         return xml_formatted
 
+# Job handler for the payment job queue (see http_jobs.py and RequestBoss)
+# payload: {"out_trade_no", "user_ID", "code": the openid callback's code, "request_data": WechatPaymentRequest.get_unsigned_data()}
+# The code is exchanged for the openid here, off the callback request. The token manager keeps the answer for CODE_TTL,
+# so a retry after a failed POST does not spend the (single use) code again.
+# Jobs queued by older versions carry the signed "xml" instead.
+# Raises if WeChat did not take the request, so that the queue tries again
+def send_payment_job(payload, token_manager = None):
+    xml = payload.get("xml")
+    if xml is None:
+        tokens = token_manager or get_token_manager()
+        request_data = dict(payload["request_data"])
+        request_data["open_id"] = tokens.exchange_code(payload["code"])["openid"]
+        request_data["sign"] = auth_ctrl.get_signature(request_data, wd.get_secret_key())
+        xml = flat_xml(request_data).decode(ENCODING_USED)
+    sender = RequestSender()
+    response_obj = sender.send_POST(wd.get_api_url(), xml)
+    wx_pl_dict = decode_post(response_obj.content)
+    log.info("<PAYMENT JOB> %s PAY REQUEST RESPONSE %s", payload["out_trade_no"], wx_pl_dict)
+    if wx_pl_dict.get("return_code") != "SUCCESS":
+        raise Exception("Pay request {} failed: {}".format(payload["out_trade_no"], wx_pl_dict.get("return_msg")))
+    return wx_pl_dict
+
 # Template of a successful reply from WeChat
 # <xml>
 #    <return_code><![CDATA[SUCCESS]]></return_code>
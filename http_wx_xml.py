@@ -0,0 +1,113 @@
+import re
+import time
+
+from http_utils import ENCODING_USED
+
+# XML going out to WeChat, built from templates that are parsed once at import.
+# A template is the XML with {Field} where values go. A field inside <![CDATA[...]]> is CDATA escaped,
+# any other field is XML text escaped, and a bytes value is taken as already serialized XML and put in as is.
+# Replies come out as bytes ready to write to the socket, so the server does not encode them again.
+#   TEXT_REPLY.render({"ToUserName": ..., "FromUserName": ..., "CreateTime": int(time.time()), "Content": ...})
+
+BUSY_CONTENT = "现在咨询的人太多了，请稍后再发一次~" # Sent when the server sheds a message, see http_concurrency.AdmissionControl
+
+FIELD_RE = re.compile(r"\{(\w+)\}")
+CDATA_OPEN = "<![CDATA["
+
+# "]]>" would end the section early, so it is split over two sections
+def escape_cdata(text):
+    return text.replace("]]>", "]]]]><![CDATA[>")
+
+def escape_text(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+class XmlTemplate:
+    def __init__(self, template):
+        parts = FIELD_RE.split(template)
+        literals = parts[0::2]
+        self.fields = parts[1::2]
+        self.literals = [l.encode(ENCODING_USED) for l in literals]
+        self.escapes = [escape_cdata if literals[i].endswith(CDATA_OPEN) else escape_text for i in range(len(self.fields))]
+
+    def render(self, values):
+        out = bytearray(self.literals[0])
+        for i, name in enumerate(self.fields):
+            value = values[name]
+            if isinstance(value, bytes):
+                out += value
+            else:
+                out += self.escapes[i](str(value)).encode(ENCODING_USED)
+            out += self.literals[i + 1]
+        return bytes(out)
+
+TEXT_REPLY = XmlTemplate(
+    "<xml>"
+    "<ToUserName><![CDATA[{ToUserName}]]></ToUserName>"
+    "<FromUserName><![CDATA[{FromUserName}]]></FromUserName>"
+    "<CreateTime>{CreateTime}</CreateTime>"
+    "<MsgType><![CDATA[text]]></MsgType>"
+    "<Content><![CDATA[{Content}]]></Content>"
+    "</xml>"
+)
+
+NEWS_REPLY = XmlTemplate(
+    "<xml>"
+    "<ToUserName><![CDATA[{ToUserName}]]></ToUserName>"
+    "<FromUserName><![CDATA[{FromUserName}]]></FromUserName>"
+    "<CreateTime>{CreateTime}</CreateTime>"
+    "<MsgType><![CDATA[news]]></MsgType>"
+    "<ArticleCount>{ArticleCount}</ArticleCount>"
+    "<Articles>{Articles}</Articles>"
+    "</xml>"
+)
+
+NEWS_ARTICLE = XmlTemplate(
+    "<item>"
+    "<Title><![CDATA[{Title}]]></Title>"
+    "<Description><![CDATA[{Description}]]></Description>"
+    "<PicUrl><![CDATA[{PicUrl}]]></PicUrl>"
+    "<Url><![CDATA[{Url}]]></Url>"
+    "</item>"
+)
+
+# Replies swap the sender and receiver of the message they answer
+def _reply_header(og_req_info):
+    return {
+        "ToUserName": og_req_info["FromUserName"],
+        "FromUserName": og_req_info["ToUserName"],
+        "CreateTime": int(time.time()),
+    }
+
+# Text replies. Auth links are text replies too, with the link in the content
+def text_reply(og_req_info, content):
+    values = _reply_header(og_req_info)
+    values["Content"] = content
+    return TEXT_REPLY.render(values)
+
+# The reply to a message the server had no room for
+def busy_reply(og_req_info):
+    return text_reply(og_req_info, BUSY_CONTENT)
+
+# articles: dicts with Title, Description, PicUrl and Url. WeChat shows at most 8
+def news_reply(og_req_info, articles):
+    values = _reply_header(og_req_info)
+    values["ArticleCount"] = len(articles)
+    values["Articles"] = b"".join(NEWS_ARTICLE.render(a) for a in articles)
+    return NEWS_REPLY.render(values)
+
+_tag_cache = {} # name -> (b"<name>", b"</name>")
+
+# Flat <xml><key>value</key>...</xml> in the dict's order, for the pay API (unifiedorder)
+# The keys differ from order to order so the tags are cached instead of a fixed template
+def flat_xml(params):
+    out = bytearray(b"<xml>")
+    for name, value in params.items():
+        tags = _tag_cache.get(name)
+        if tags is None:
+            tags = ("<{}>".format(name).encode(ENCODING_USED), "</{}>".format(name).encode(ENCODING_USED))
+            _tag_cache[name] = tags
+        out += tags[0]
+        out += escape_text(str(value)).encode(ENCODING_USED)
+        out += tags[1]
+    out += b"</xml>"
+    return bytes(out)
@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("pymssql") # http_async_server imports http_server, which imports the chatbot
+pytest.importorskip("wechat_dev")
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from concurrent.futures import ThreadPoolExecutor
+
+from http_async_server import AsyncChatbotFrontend
+from http_capture import TrafficCapture
+
+class FakeBoss:
+    def interpret_get(self, path, headers):
+        if path.startswith("/redir"):
+            return "redirect", "https://example.com/"
+        return "text", "echo"
+
+# A front end without a chatbot, enough for GETs
+def make_frontend():
+    frontend = AsyncChatbotFrontend.__new__(AsyncChatbotFrontend)
+    frontend.rb = FakeBoss()
+    frontend.capture = TrafficCapture(sample_rate=1)
+    frontend.executor = ThreadPoolExecutor(max_workers=1)
+    frontend.max_pending = 4
+    frontend.pending = None
+    return frontend
+
+def test_gets_are_sampled_with_their_status():
+    frontend = make_frontend()
+
+    async def go():
+        app = web.Application()
+        app.router.add_get("/{tail:.*}", frontend.handle_get)
+        async with TestClient(TestServer(app)) as client:
+            assert (await client.get("/?echostr=x")).status == 200
+            assert (await client.get("/redir?state=s", allow_redirects=False)).status == 303
+
+    asyncio.run(go())
+    frontend.executor.shutdown()
+    records = list(frontend.capture.ring)
+    assert [(r["method"], r["action"], r["status"]) for r in records] == [("GET", "text", 200), ("GET", "redirect", 303)]
+    assert "interpret_get" in records[0]["stages"]
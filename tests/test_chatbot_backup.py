@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pymssql") # chatbot_be imports cb_sql
+
+from chatbot.chatbot import Chatbot
+from chatbot.chatbot_be import DatabaseRunner
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(DatabaseRunner, "trigger_backup", lambda self: None)
+    bot = Chatbot(use_journal=False)
+    bot.start_bot("wechat_chatbot_resource.json", backend_read=False)
+    return bot
+
+def test_trigger_schedules_one_backup(bot, monkeypatch):
+    alarms = []
+    monkeypatch.setattr(Chatbot, "set_backup_alarm", lambda self: alarms.append(1))
+    start = threading.Barrier(20)
+
+    def trigger():
+        start.wait()
+        bot.trigger_backup()
+
+    threads = [threading.Thread(target=trigger) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(alarms) == 1
+
+# A chat in the middle of a turn (its lock held) is written only after the turn
+def test_backup_waits_for_the_turn(bot, monkeypatch):
+    monkeypatch.setattr(Chatbot, "set_backup_alarm", lambda self: None)
+    bot.get_bot_response("u1", "1", op_print=False)
+    chat_mgr = bot.sessions.checkout_resident("u1")
+    bot.sessions.checkin("u1")
+    written = []
+    monkeypatch.setattr(chat_mgr, "backup_chat", lambda: written.append(time.perf_counter()))
+
+    with chat_mgr.lock:
+        backup = threading.Thread(target=bot.backup_chats)
+        backup.start()
+        time.sleep(0.2)
+        turn_end = time.perf_counter()
+    backup.join()
+    assert len(written) == 1 and written[0] > turn_end
+
+def test_checkout_resident_does_not_make_chats(bot):
+    assert bot.sessions.checkout_resident("nobody") is None
+    assert "nobody" not in bot.sessions
+
+def test_delete_chat_forgets_the_chat(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Chatbot, "set_backup_alarm", lambda self: None)
+    monkeypatch.setattr(DatabaseRunner, "trigger_backup", lambda self: None)
+    bot = Chatbot()
+    bot.start_bot("wechat_chatbot_resource.json", backend_read=False)
+    bot.get_bot_response("u1", "1", op_print=False)
+    assert "u1" in bot.journal
+    bot.delete_chat("u1")
+    assert "u1" not in bot.sessions and "u1" not in bot.journal
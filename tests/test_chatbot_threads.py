@@ -0,0 +1,75 @@
+import random
+import threading
+
+import pytest
+
+pytest.importorskip("pymssql") # chatbot_be imports cb_sql
+
+from chatbot.chatbot import Chatbot
+from chatbot.chatbot_be import DatabaseRunner
+
+RESOURCE = "wechat_chatbot_resource.json"
+USERS = 12
+TURNS = 15
+
+# Menu choices and cities, so chats go through states that ask for info and keep their gate closed between turns
+MESSAGES = ["1", "2", "3", "4", "0", "上海", "北京", "苏州", "12000"]
+
+def script_for(n):
+    rng = random.Random(n)
+    return [rng.choice(MESSAGES) for i in range(TURNS)]
+
+def new_bot():
+    bot = Chatbot(use_journal=False)
+    bot.start_bot(RESOURCE, backend_read=False)
+    return bot
+
+def replies(bot, user, script):
+    return [bot.get_bot_response(user, msg, op_print=False).get_replytext() for msg in script]
+
+@pytest.fixture(autouse=True)
+def pinned(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # database.json and chatlogs
+    monkeypatch.setattr(random, "choice", lambda seq: seq[0]) # Replies are picked at random
+    # Backups run on timers that would outlive the test
+    monkeypatch.setattr(Chatbot, "set_backup_alarm", lambda self: None)
+    monkeypatch.setattr(DatabaseRunner, "trigger_backup", lambda self: None)
+
+# Each user alone on a fresh bot
+@pytest.fixture
+def reference():
+    scripts = {"user{}".format(n): script_for(n) for n in range(USERS)}
+    return scripts, {user: replies(new_bot(), user, script) for user, script in scripts.items()}
+
+# One turn of every user in turn, on one bot. The shared Calculator, ReqGatekeeper and ReplyGenerator must not carry anything between users
+def test_interleaved_users_match_alone(reference):
+    scripts, expected = reference
+    bot = new_bot()
+    got = {user: [] for user in scripts}
+    for i in range(TURNS):
+        for user, script in scripts.items():
+            got[user].append(bot.get_bot_response(user, script[i], op_print=False).get_replytext())
+    assert got == expected
+
+@pytest.mark.parametrize("run", range(3))
+def test_one_thread_per_user_match_alone(reference, run):
+    scripts, expected = reference
+    bot = new_bot()
+    got = {}
+    errors = []
+    start = threading.Barrier(len(scripts))
+
+    def chat(user, script):
+        try:
+            start.wait()
+            got[user] = replies(bot, user, script)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=chat, args=item) for item in scripts.items()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert got == expected
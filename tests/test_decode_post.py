@@ -0,0 +1,140 @@
+import http.client
+import os
+import random
+import socket
+import threading
+
+import pytest
+
+from xml.etree import ElementTree
+
+import http_utils
+from http_utils import DECODE_ERRORS, MAX_BODY_BYTES, decode_post, decode_post_xml_fast, decode_post_xml_generic
+
+WECHAT_TEXT_XML = ("<xml><ToUserName><![CDATA[gh_123456789abc]]></ToUserName><FromUserName><![CDATA[o_user_0001]]></FromUserName>"
+                   "<CreateTime>1600000000</CreateTime><MsgType><![CDATA[text]]></MsgType><Content><![CDATA[你好，我想买东西]]></Content>"
+                   "<MsgId>1234567890123456</MsgId></xml>")
+WECHAT_EVENT_XML = ("<xml>\n<ToUserName><![CDATA[gh_123456789abc]]></ToUserName>\n<FromUserName><![CDATA[o_user_0001]]></FromUserName>\n"
+                    "<CreateTime>1600000000</CreateTime>\n<MsgType><![CDATA[event]]></MsgType>\n<Event><![CDATA[CLICK]]></Event>\n"
+                    "<EventKey><![CDATA[]]></EventKey>\n</xml>")
+
+def mutate(rng, body, alphabet, max_edits):
+    for j in range(rng.randint(1, max_edits)):
+        pos = rng.randrange(len(body))
+        op = rng.random()
+        if op < 0.4:
+            body[pos] = rng.choice(alphabet)
+        elif op < 0.7:
+            del body[pos]
+        else:
+            body.insert(pos, rng.choice(alphabet))
+    return body
+
+def test_no_eval_in_http_utils():
+    assert not [name for name in dir(http_utils) if "eval" in name]
+
+def test_decodes_wechat_json_and_forms():
+    assert decode_post(b'{"FromUserName": "o_1", "MsgType": "event"}') == {"FromUserName": "o_1", "MsgType": "event"}
+    assert decode_post("userID=u1&message=%E4%BD%A0%E5%A5%BD".encode("utf-8")) == {"userID": "u1", "message": "你好"}
+    assert decode_post(WECHAT_TEXT_XML.encode("utf-8"))["Content"] == "你好，我想买东西"
+
+# Malformed and hostile bodies: every one must give a dict or raise one of DECODE_ERRORS, and none may run code
+def test_fuzzed_bodies_decode_or_are_refused(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bodies = [
+        b"__import__('os').mkdir('pwned')",
+        b"{'a': __import__('os').mkdir('pwned')}",
+        b"{\"a\": 1", b"{\"a\": }", b"[1, 2, 3]", b"\"just a string\"", b"123", b"null",
+        b"", b"   ", b"{}", b"=", b"&&&", b"a=1&a=2", b"a==b", b"%zz=%", b"a=%E4%BD",
+        b"\xff\xfe\x00garbage", b"<xml><a>1</a>", b"{\"a\": NaN}", b"{" * 100000,
+        b'{"a":' + b"[" * 30000, b'{"a":' + b"[" * 30000 + b"]" * 30000 + b"}",
+        b"x" * (MAX_BODY_BYTES + 1),
+    ]
+    seeds = [b'{"ToUserName":"gh_1","FromUserName":"o_1","MsgType":"event","Event":"CLICK"}',
+             b"userID=u1&message=%E4%BD%A0%E5%A5%BD&msg_type=raw"]
+    rng = random.Random(0)
+    for i in range(20000):
+        bodies.append(bytes(mutate(rng, bytearray(rng.choice(seeds)), b"{}[]\"'=&%:,\\ " + bytes(range(256)), 8)))
+
+    refused = 0
+    for body in bodies:
+        try:
+            out = decode_post(body)
+        except DECODE_ERRORS:
+            refused += 1
+            continue
+        assert isinstance(out, dict), body
+    assert refused > 0
+    assert not os.path.exists("pwned")
+
+# The fast XML path must give exactly what the parser gives, whenever it does not hand the message over to it
+def test_fast_xml_path_matches_the_parser():
+    shapes = [WECHAT_TEXT_XML, WECHAT_EVENT_XML, "<xml></xml>", "<xml><a>1</a><a>2</a></xml>",
+              "<xml><a><b>nested</b></a></xml>", "<xml><a x=\"1\">attr</a></xml>", "<xml><a>&lt;x&gt;</a></xml>",
+              "<xml><a><![CDATA[x]]]]><![CDATA[>y]]></a></xml>", "<xml><a><![CDATA[x]]> </a></xml>",
+              "<xml><a>1\r\n2</a></xml>", "<xml>text<a>1</a></xml>", "<xml><a>1</a>tail</xml>", "<xml><a>1</b></xml>"]
+    rng = random.Random(0)
+    for i in range(20000):
+        shapes.append("".join(mutate(rng, list(rng.choice(shapes[:2])), "<>/[]!&;x \n", 4)))
+
+    on_fast_path = 0
+    for body in shapes:
+        fast = decode_post_xml_fast(body)
+        if fast is None:
+            continue
+        try:
+            generic = decode_post_xml_generic(body)
+        except ElementTree.ParseError:
+            continue # Broken XML the fast path still reads, e.g. a stray "]]" inside text
+        assert fast == generic, body
+        on_fast_path += 1
+    assert on_fast_path > 0
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    pytest.importorskip("pymssql") # http_server imports the chatbot
+    pytest.importorskip("wechat_dev")
+    monkeypatch.chdir(tmp_path)
+    from http_server import ChatbotServer, ThreadedHTTPServer
+
+    class Handler(ChatbotServer):
+        chatbot = object() # Never reached
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadedHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd.server_address
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_undecodable_post_gets_400_and_keeps_the_connection(server):
+    conn = http.client.HTTPConnection(*server, timeout=5)
+    for body in (b"{not json", b"<xml><a>1</b></xml>", b"\xff\xfe", b"[1, 2]"):
+        conn.request("POST", "/", body=body)
+        reply = conn.getresponse()
+        content = reply.read()
+        assert reply.status == 400
+        assert int(reply.getheader("Content-Length")) == len(content)
+    conn.close()
+
+# Raw requests, http.client would fill in a good Content-Length
+def raw_request(address, head):
+    with socket.create_connection(address, timeout=5) as sock:
+        sock.sendall(head + b"\r\n\r\n{}")
+        reply = b""
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break # The server closed the connection
+            reply += chunk
+    return reply
+
+@pytest.mark.parametrize("length, status", [(b"abc", 400), (b"-5", 400), (b"+2", 400), (b"1_0", 400), (None, 411)])
+def test_bad_content_length_is_refused_and_closes(server, length, status):
+    head = b"POST / HTTP/1.1\r\nHost: x"
+    if length is not None:
+        head += b"\r\nContent-Length: " + length
+    reply = raw_request(server, head)
+    assert reply.startswith("HTTP/1.1 {}".format(status).encode())
+    assert b"Connection: close" in reply
@@ -0,0 +1,79 @@
+import logging
+import os
+import time
+
+import pytest
+
+from http_expiring import ExpiringMap
+
+def wheel_keys(m):
+    return m.get_metrics()["wheel_keys"]
+
+def test_entries_expire():
+    m = ExpiringMap(0.05, resolution=0.01)
+    m["a"] = 1
+    assert m["a"] == 1
+    time.sleep(0.1)
+    m["b"] = 2 # Writes sweep
+    assert "a" not in m and len(m) == 1
+
+def test_rewrites_keep_one_wheel_entry_per_key():
+    m = ExpiringMap(60, resolution=0.001)
+    for i in range(1000):
+        m["a"] = i
+    assert m["a"] == 999
+    assert wheel_keys(m) == 1
+
+def test_removed_and_evicted_keys_leave_the_wheel():
+    m = ExpiringMap(60, max_entries=10)
+    for i in range(100):
+        m[i] = i
+    assert len(m) == 10 and wheel_keys(m) == 10
+    assert m.pop(99) == 99
+    assert wheel_keys(m) == 9
+
+def test_expired_get_leaves_the_wheel():
+    m = ExpiringMap(60)
+    m.set("a", 1, ttl=0)
+    assert m.get("a") is None
+    assert wheel_keys(m) == 0
+
+# The auth flow maps of a RequestBoss over many flows, with a short TTL: nothing may grow with the number of flows.
+# SOAK_FLOWS=1000000 for the full soak
+def test_auth_flow_maps_stay_flat(tmp_path, monkeypatch):
+    pytest.importorskip("wechat_dev")
+    import http_auth_control
+    import http_customer_manager
+    import http_request_interpreter
+
+    n_flows = int(os.environ.get("SOAK_FLOWS", 100000))
+    ttl = 0.2
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(http_auth_control, "AUTH_STATE_TTL", ttl)
+    monkeypatch.setattr(http_customer_manager, "CUSTOMER_TTL", ttl)
+    monkeypatch.setattr(http_request_interpreter, "REDIRECT_TTL", ttl)
+    logging.disable(logging.WARNING) # "Manager already exists" on every flow
+    try:
+        rb = http_request_interpreter.RequestBoss()
+        auth_ctrl = rb.auth_ctrl
+        maps = [auth_ctrl.user_state_map, auth_ctrl.state_user_map, auth_ctrl.user_callbacks,
+                auth_ctrl.cust_master.managers, rb.redirect_map, rb.trade_no_map]
+        headers = {"X-Forwarded-For": "10.0.0.1"}
+        sizes = [] # Biggest map (or wheel) every 1000 flows
+        for i in range(n_flows):
+            user_ID = "soak_user_{}".format(i)
+            state_id = auth_ctrl.generate_state_id(user_ID)
+            rb._capture_redirect_url(state_id, "https://example.com/pay?state=" + state_id)
+            rb._capture_purchase_callback_info(user_ID, None, {"FromUserName": user_ID})
+            auth_ctrl.stash_ip(state_id, headers)
+            auth_ctrl.capture_open_id(state_id, "code_{}".format(i))
+            rb.trade_no_map[state_id] = "OTN{}".format(i)
+            if i % 1000 == 0:
+                sizes.append(max([len(m) for m in maps] + [wheel_keys(m) for m in maps]))
+    finally:
+        logging.disable(logging.NOTSET)
+
+    # Flat: the second half of the run holds no more than the first (once a TTL and a bucket have gone by)
+    half = len(sizes) // 2
+    assert max(sizes[half:]) <= 1.5 * max(sizes[:half]) + 1000
+    assert max(sizes) < n_flows / 2
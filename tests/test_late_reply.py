@@ -0,0 +1,62 @@
+import threading
+import time
+
+from http_concurrency import AdmissionControl
+from http_late_reply import EMPTY_REPLY, LateReplyKeeper
+
+class FakeSender:
+    def __init__(self):
+        self.sent = []
+
+    def send_text(self, user_ID, content):
+        self.sent.append((user_ID, content))
+
+class FakeMessage:
+    def get_reply_content(self):
+        return "late"
+
+    def to_wechat_reply_bytes(self):
+        return b"<xml>on time</xml>"
+
+def run_turn(keeper, admission, turn):
+    assert admission.acquire("u1") is None
+    release = admission.releaser()
+
+    def make_message():
+        try:
+            return turn()
+        finally:
+            release()
+    return keeper.answer("u1", make_message, time.time(), release)
+
+def test_late_reply_is_sent_and_frees_the_slot():
+    sender = FakeSender()
+    keeper = LateReplyKeeper(sender, deadline=0.05, turn_timeout=5)
+    admission = AdmissionControl(max_turns=1, pending_timeout=0)
+    assert run_turn(keeper, admission, lambda: time.sleep(0.2) or FakeMessage()) == EMPTY_REPLY
+    time.sleep(0.4)
+    assert sender.sent == [("u1", "late")]
+    assert admission.get_metrics()["running"] == 0
+
+def test_hung_turn_gives_its_slot_back_and_is_not_sent():
+    sender = FakeSender()
+    keeper = LateReplyKeeper(sender, deadline=0.05, turn_timeout=0.2)
+    admission = AdmissionControl(max_turns=1, pending_timeout=0)
+    hang = threading.Event()
+    assert run_turn(keeper, admission, lambda: hang.wait() and FakeMessage()) == EMPTY_REPLY
+    assert admission.acquire("u2") is not None # The hung turn still holds the only slot
+    time.sleep(0.4)
+    assert keeper.get_metrics()["given_up"] == 1
+    assert admission.get_metrics()["running"] == 0
+    hang.set() # The turn ends after all: its reply is dropped and the slot is not given back twice
+    time.sleep(0.1)
+    assert sender.sent == []
+    assert admission.get_metrics()["running"] == 0
+
+def test_releaser_releases_once():
+    admission = AdmissionControl(max_turns=2)
+    assert admission.acquire("u1") is None and admission.acquire("u2") is None
+    release = admission.releaser()
+    release()
+    release()
+    assert admission.get_metrics()["running"] == 1
@@ -0,0 +1,60 @@
+import logging
+import threading
+
+import pytest
+
+import chatbot.cb_logging as cb_logging
+import chatbot.chatbot_utils as cu
+
+@pytest.fixture
+def fresh(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cb_logging, "_logger_handlers", [])
+    monkeypatch.setattr(cu, "_error_journal", None)
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield tmp_path
+    cb_logging.stop_logging()
+    journal = logging.getLogger(cu.ERROR_LOG_NAME)
+    for handler in list(journal.handlers):
+        journal.removeHandler(handler)
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+class ThreadHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def emit(self, record):
+        self.threads.append(threading.current_thread())
+
+def test_error_journal_is_written_by_the_log_writer(fresh):
+    cb_logging.setup_logging(logging.INFO, handlers=[logging.NullHandler()])
+    cu.log_error("bad formula")
+    spy = ThreadHandler()
+    cb_logging.add_logger_handler(cu.ERROR_LOG_NAME, spy)
+    cu.log_error("bad formula again")
+    cb_logging.stop_logging()
+
+    assert logging.getLogger(cu.ERROR_LOG_NAME).handlers == [] # Nothing is written on the caller's thread
+    assert spy.threads and threading.current_thread() not in spy.threads
+    lines = (fresh / cu.ERROR_LOG_FILENAME).read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 2 and "bad formula again" in lines[1]
+
+def test_error_journal_before_setup_logging_moves_to_the_writer(fresh):
+    cu.log_error("early")
+    assert logging.getLogger(cu.ERROR_LOG_NAME).handlers != []
+    cb_logging.setup_logging(logging.INFO, handlers=[logging.NullHandler()])
+    cu.log_error("late")
+    cb_logging.stop_logging()
+
+    assert logging.getLogger(cu.ERROR_LOG_NAME).handlers == []
+    assert len((fresh / cu.ERROR_LOG_FILENAME).read_text(encoding="utf-8").splitlines()) == 2
+
+def test_other_loggers_stay_out_of_the_error_journal(fresh):
+    cb_logging.setup_logging(logging.INFO, handlers=[logging.NullHandler()])
+    cu.log_error("bad formula")
+    logging.getLogger("chatbot.chatclass").error("not a journal line")
+    cb_logging.stop_logging()
+    assert "not a journal line" not in (fresh / cu.ERROR_LOG_FILENAME).read_text(encoding="utf-8")
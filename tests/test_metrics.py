@@ -0,0 +1,31 @@
+from chatbot.cb_metrics import MetricsRegistry
+from http_concurrency import AdmissionControl
+from http_jobs import JobQueue
+
+def types(text):
+    return dict(line.split()[2:4] for line in text.splitlines() if line.startswith("# TYPE"))
+
+def test_collector_counters_get_total_suffix():
+    registry = MetricsRegistry()
+    registry.add_collector("cache", lambda: {"hits": 3, "entries": 10, "journal": {"appends": 2, "chats": 1}},
+                           ("hits", "journal_appends"))
+    text = registry.render_prometheus()
+    assert types(text) == {
+        "chatbot_stage_seconds": "histogram",
+        "chatbot_cache_hits_total": "counter",
+        "chatbot_cache_entries": "gauge",
+        "chatbot_cache_journal_appends_total": "counter",
+        "chatbot_cache_journal_chats": "gauge",
+    }
+    assert "chatbot_cache_hits_total 3" in text
+
+def test_counted_names_are_counters():
+    registry = MetricsRegistry()
+    registry.count("formula_evaluations", 5)
+    text = registry.render_prometheus()
+    assert types(text)["chatbot_formula_evaluations_total"] == "counter"
+    assert "chatbot_formula_evaluations_total 5" in text
+
+def test_counter_keys_are_in_get_metrics(tmp_path):
+    for part in (AdmissionControl(), JobQueue(str(tmp_path / "jobs.journal"))):
+        assert set(part.METRIC_COUNTERS) <= set(part.get_metrics())
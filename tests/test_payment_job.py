@@ -0,0 +1,67 @@
+import pytest
+
+pytest.importorskip("wechat_dev")
+
+import http_wx_message
+from http_request_interpreter import RequestBoss
+from http_wx_message import send_payment_job
+
+class FakeTokens:
+    def __init__(self):
+        self.codes = []
+
+    def exchange_code(self, code):
+        self.codes.append(code)
+        return {"openid": "openid-of-" + code}
+
+class PayAction:
+    def get_replytext(self):
+        return "pay"
+
+    def get_payload(self):
+        return {"total_fee": 1, "body": "test"}
+
+class FakeResponse:
+    content = b"<xml><return_code>SUCCESS</return_code><return_msg>OK</return_msg></xml>"
+
+@pytest.fixture
+def sent(monkeypatch):
+    posts = []
+    monkeypatch.setattr(http_wx_message.RequestSender, "send_POST", lambda self, url, xml: posts.append(xml) or FakeResponse())
+    return posts
+
+@pytest.fixture
+def tokens(monkeypatch):
+    tokens = FakeTokens()
+    monkeypatch.setattr(http_wx_message, "get_token_manager", lambda: tokens)
+    return tokens
+
+# The openid callback only queues the job, the code is exchanged by the job
+def test_callback_queues_the_code_without_exchanging_it(tmp_path, monkeypatch, tokens):
+    monkeypatch.chdir(tmp_path)
+    boss = RequestBoss()
+    submitted = []
+    monkeypatch.setattr(boss.jobs, "submit", lambda kind, key, payload: submitted.append(payload) or (payload, True))
+
+    user = "user1"
+    state_id = boss.auth_ctrl.generate_state_id(user)
+    boss.auth_ctrl.stash_callback_info(user, PayAction(), {"FromUserName": user, "ToUserName": "us"})
+    boss.auth_ctrl.stash_ip(state_id, {"X-Forwarded-For": "1.2.3.4"})
+    boss.auth_ctrl.capture_open_id(state_id, "code1")
+    boss.send_auth_followup_message(state_id)
+
+    assert tokens.codes == []
+    payload = submitted[0]
+    assert payload["code"] == "code1" and not "xml" in payload
+    assert not "sign" in payload["request_data"]
+
+def test_job_exchanges_the_code_and_signs(tokens, sent):
+    payload = {"out_trade_no": "OTN1", "user_ID": "user1", "code": "code1", "request_data": {"total_fee": 1, "open_id": None}}
+    assert send_payment_job(payload)["return_code"] == "SUCCESS"
+    assert tokens.codes == ["code1"]
+    assert "<open_id>openid-of-code1</open_id>" in sent[0] and "<sign>" in sent[0]
+    assert payload["request_data"]["open_id"] is None # The stored payload is left as it was, a retry starts over
+
+def test_job_queued_before_the_change_sends_its_xml(tokens, sent):
+    send_payment_job({"out_trade_no": "OTN1", "user_ID": "user1", "xml": "<xml></xml>"})
+    assert sent == ["<xml></xml>"] and tokens.codes == []
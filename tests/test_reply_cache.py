@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+from http_reply_cache import ReplyCache, Uncached
+
+# Starts compute for key on a thread and returns once it is running. Set the returned Event to let it finish
+def start_slow(cache, key, reply = b"slow"):
+    running = threading.Event()
+    finish = threading.Event()
+
+    def compute():
+        running.set()
+        finish.wait()
+        return reply
+
+    t = threading.Thread(target=cache.get_or_compute, args=(key, compute))
+    t.start()
+    running.wait()
+    return finish, t
+
+def test_retry_gets_the_first_reply():
+    cache = ReplyCache()
+    calls = []
+    assert cache.get_or_compute("k", lambda: calls.append(1) or b"a") == b"a"
+    assert cache.get_or_compute("k", lambda: calls.append(1) or b"b") == b"a"
+    assert len(calls) == 1
+
+def test_sweep_skips_entries_being_answered():
+    cache = ReplyCache(ttl=60, max_entries=5)
+    finish, t = start_slow(cache, "slow")
+    for n in range(20):
+        cache.get_or_compute("k{}".format(n), lambda: b"x")
+    assert len(cache) <= 6 # The cap, plus the one being answered
+    assert "slow" in cache.entries
+    finish.set()
+    t.join()
+
+def test_sweep_expires_behind_an_entry_being_answered():
+    cache = ReplyCache(ttl=0.05)
+    finish, t = start_slow(cache, "slow")
+    cache.get_or_compute("old", lambda: b"x")
+    time.sleep(0.1)
+    cache.get_or_compute("new", lambda: b"x")
+    assert "old" not in cache.entries and "slow" in cache.entries
+    finish.set()
+    t.join()
+
+def test_waiting_retry_falls_back_to_busy():
+    cache = ReplyCache(wait=0.1)
+    finish, t = start_slow(cache, "k")
+    assert cache.get_or_compute("k", lambda: b"again", lambda: b"busy") == b"busy"
+    with pytest.raises(Exception):
+        cache.get_or_compute("k", lambda: b"again")
+    assert cache.get_metrics()["wait_timeouts"] == 2
+    finish.set()
+    t.join()
+    assert cache.get_or_compute("k", lambda: b"again") == b"slow"
+
+def test_uncached_reply_is_not_given_to_later_retries():
+    cache = ReplyCache()
+    assert cache.get_or_compute("k", lambda: Uncached(b"busy")) == b"busy"
+    assert "k" not in cache.entries
+    assert cache.get_or_compute("k", lambda: b"answer") == b"answer"
+    assert cache.get_or_compute("k", lambda: b"again") == b"answer"
@@ -0,0 +1,81 @@
+import json
+import time
+
+from chatbot.cb_journal import SessionJournal
+
+DAY = 24 * 60 * 60
+
+def open_journal(tmp_path, **kwargs):
+    return SessionJournal(str(tmp_path / "sessions.journal"), **kwargs)
+
+def test_latest_snapshot_survives_restart(tmp_path):
+    journal = open_journal(tmp_path)
+    journal.append("u1", b'{"a": 1}')
+    journal.append("u1", b'{"a": 2}')
+    journal.close()
+    journal = open_journal(tmp_path)
+    assert journal.load("u1") == b'{"a": 2}'
+
+def test_old_lines_without_time_are_read(tmp_path):
+    path = tmp_path / "sessions.journal"
+    path.write_bytes(b'{"u":"u1","s":{"a": 1}}\n')
+    journal = open_journal(tmp_path)
+    assert journal.load("u1") == b'{"a": 1}'
+
+def test_delete_drops_the_chat_and_stays_deleted(tmp_path):
+    journal = open_journal(tmp_path)
+    journal.append("u1", b'{"a": 1}')
+    journal.append("u2", b'{"a": 2}')
+    journal.delete("u1")
+    assert "u1" not in journal.index and "u1" not in journal.checksums
+    journal.close()
+    journal = open_journal(tmp_path)
+    assert journal.load("u1") is None
+    assert journal.load("u2") == b'{"a": 2}'
+
+def test_expire_drops_old_chats_and_compaction_removes_them(tmp_path):
+    journal = open_journal(tmp_path, retention=DAY)
+    journal.append("old", b'{"a": 1}')
+    journal.append("new", b'{"a": 2}')
+    offset, length, written = journal.index["old"]
+    journal.index["old"] = (offset, length, written - 2 * DAY)
+    assert journal.expire() == 1
+    assert "old" not in journal.index and "old" not in journal.checksums
+    journal.compact()
+    lines = (tmp_path / "sessions.journal").read_bytes().splitlines()
+    assert [json.loads(line)["u"] for line in lines] == ["new"]
+    assert journal.live_bytes == sum(len(line) + 1 for line in lines)
+
+# After a restart, before any expire pass: an expired chat must not be loaded
+def test_expired_chat_is_not_loaded_after_restart(tmp_path):
+    old = int(time.time()) - 2 * DAY
+    (tmp_path / "sessions.journal").write_bytes(b'{"u":"old","t":' + str(old).encode() + b',"s":{"a": 1}}\n')
+    journal = open_journal(tmp_path, retention=DAY)
+    assert "old" not in journal and journal.load("old") is None
+
+def test_chat_expiring_before_the_expire_pass_is_not_loaded(tmp_path):
+    journal = open_journal(tmp_path, retention=DAY)
+    journal.append("old", b'{"a": 1}')
+    offset, length, written = journal.index["old"]
+    journal.index["old"] = (offset, length, written - 2 * DAY)
+    assert journal.load("old") is None
+    assert "old" not in journal and journal.get_metrics()["expired"] == 1
+
+def test_release_forgets_the_checksum(tmp_path):
+    journal = open_journal(tmp_path)
+    journal.append("u1", b'{"a": 1}')
+    journal.append("u1", b'{"a": 1}')
+    assert journal.get_metrics()["skipped"] == 1
+    journal.release("u1")
+    assert journal.checksums == {}
+    journal.append("u1", b'{"a": 1}')
+    assert journal.get_metrics()["appends"] == 2
+
+# The checksum map only holds chats that are in memory, not every chat ever journaled
+def test_checksums_are_not_loaded_at_startup(tmp_path):
+    journal = open_journal(tmp_path)
+    for n in range(100):
+        journal.append("u{}".format(n), b'{"a": 1}')
+    journal.close()
+    journal = open_journal(tmp_path)
+    assert len(journal.index) == 100 and journal.checksums == {}
@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+from chatbot.cb_sessions import SessionStore
+
+class Manager:
+    def __init__(self, chatID, history = ""):
+        self.chatID = chatID
+        self.history = history
+
+def dump(manager):
+    return manager.history.encode("utf-8")
+
+def load(chatID, data):
+    return Manager(chatID, data.decode("utf-8"))
+
+def blank(chatID):
+    return Manager(chatID)
+
+def spilled_store(tmp_path, load_fn = load):
+    store = SessionStore(dump, load_fn, max_sessions=1, spill_dir=str(tmp_path))
+    store.checkout("u1", lambda chatID: Manager(chatID, "hello"))
+    store.checkin("u1")
+    store.checkout("u2", blank) # Pushes u1 out to disk
+    store.checkin("u2")
+    assert "u1" not in store
+    return store
+
+def test_failed_load_keeps_the_spilled_chat(tmp_path):
+    calls = []
+    def flaky_load(chatID, data):
+        calls.append(chatID)
+        if len(calls) == 1:
+            raise Exception("disk hiccup")
+        return load(chatID, data)
+
+    store = spilled_store(tmp_path, flaky_load)
+    with pytest.raises(Exception, match="hiccup"):
+        store.checkout("u1", blank)
+    assert store.checkout("u1", blank).history == "hello"
+
+def test_checkout_during_a_load_waits_for_it(tmp_path):
+    loading = threading.Event()
+    finish = threading.Event()
+    def slow_load(chatID, data):
+        loading.set()
+        finish.wait()
+        return load(chatID, data)
+
+    store = spilled_store(tmp_path, slow_load)
+    got = []
+    first = threading.Thread(target=lambda: got.append(store.checkout("u1", blank)))
+    first.start()
+    loading.wait()
+    second = threading.Thread(target=lambda: got.append(store.checkout("u1", blank)))
+    second.start()
+    second.join(0.2)
+    assert second.is_alive() # Waiting on the first load, not making a blank chat
+    finish.set()
+    first.join()
+    second.join()
+    assert got[0] is got[1] and got[0].history == "hello"
+
+def test_spilling_does_not_hold_up_other_chats(tmp_path):
+    dumping = threading.Event()
+    finish = threading.Event()
+    def slow_dump(manager):
+        dumping.set()
+        finish.wait()
+        return dump(manager)
+
+    store = SessionStore(slow_dump, load, max_sessions=1, spill_dir=str(tmp_path))
+    store.checkout("u1", lambda chatID: Manager(chatID, "hello"))
+    store.checkin("u1")
+    spiller = threading.Thread(target=store.checkout, args=("u2", blank))
+    spiller.start()
+    dumping.wait() # u1 is on its way to disk
+
+    other = threading.Thread(target=store.checkout, args=("u3", blank))
+    other.start()
+    other.join(2)
+    assert not other.is_alive()
+    returning = []
+    back = threading.Thread(target=lambda: returning.append(store.checkout("u1", blank)))
+    back.start()
+    back.join(0.2)
+    assert back.is_alive() # u1 is neither in memory nor on disk yet
+    finish.set()
+    spiller.join()
+    back.join()
+    assert returning[0].history == "hello"
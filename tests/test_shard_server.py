@@ -0,0 +1,67 @@
+import os
+import signal
+import time
+
+import pytest
+
+pytest.importorskip("pymssql") # chatbot_be imports cb_sql
+pytest.importorskip("wechat_dev") # http_server
+
+from chatbot.chatbot import Chatbot
+from chatbot.chatbot_be import DatabaseRunner
+from chatbot.initalizers import master_initalize
+from http_shard_server import ShardPool
+
+RESOURCE = "wechat_chatbot_resource.json"
+
+@pytest.fixture(scope="module")
+def components():
+    return master_initalize(RESOURCE)
+
+@pytest.fixture(autouse=True)
+def quiet(tmp_path, monkeypatch):
+    # Workers are forked from the test process, so they get these too
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Chatbot, "set_backup_alarm", lambda self: None)
+    monkeypatch.setattr(DatabaseRunner, "trigger_backup", lambda self: None)
+
+def worker_pid(pool):
+    return pool.get_bot_response("u1", "pid").get_replytext()[0]
+
+@pytest.fixture
+def pid_pool(components, monkeypatch):
+    monkeypatch.setattr(Chatbot, "get_bot_response", lambda self, user_ID, msg: PidReply())
+    return ShardPool(1, components, timeout=10)
+
+class PidReply:
+    def __init__(self):
+        self.pid = os.getpid()
+        self.parent = os.getppid()
+
+    def get_replytext(self):
+        return self.pid, self.parent
+
+def test_dead_worker_is_replaced(pid_pool):
+    first = worker_pid(pid_pool)
+    os.kill(first, signal.SIGKILL)
+    for i in range(100):
+        try:
+            second = worker_pid(pid_pool)
+            break
+        except Exception:
+            time.sleep(0.05) # The new worker is on its way
+    assert second != first
+    assert worker_pid(pid_pool) == second
+
+def test_workers_are_forked_by_the_supervisor(pid_pool):
+    pid, parent = pid_pool.get_bot_response("u1", "pid").get_replytext()
+    assert parent == pid_pool.supervisor.process.pid
+
+def test_hung_turn_fails_after_the_timeout(components, monkeypatch):
+    monkeypatch.setattr(Chatbot, "get_bot_response", lambda self, user_ID, msg: time.sleep(60))
+    pool = ShardPool(1, components, timeout=0.5)
+    started = time.time()
+    with pytest.raises(Exception, match="did not answer"):
+        pool.get_bot_response("u1", "hello")
+    assert time.time() - started < 5
+    assert pool.shards[0].waiting == {}
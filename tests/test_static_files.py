@@ -0,0 +1,27 @@
+import pytest
+
+from http_files_utils import StaticFiles
+
+SERVER_FILES = ["jobs.journal", "sessions.journal", "sessions.0.journal", "capture.jsonl", "errorlog.txt",
+                "database.json", "database.0.json", "wechat_dev.py"]
+
+@pytest.fixture
+def static(tmp_path):
+    for name in SERVER_FILES + ["index.html", "callback_landing.html", "MP_verify_abc123.txt"]:
+        (tmp_path / name).write_bytes(b"x" * 1000)
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "index.html").write_bytes(b"x")
+    return StaticFiles(str(tmp_path))
+
+def test_serves_the_allowlisted_files(static):
+    for name in ("index.html", "callback_landing.html", "MP_verify_abc123.txt"):
+        asset = static.get(name)
+        assert asset is not None and asset.data == b"x" * 1000
+
+@pytest.mark.parametrize("name", SERVER_FILES + ["sub/index.html", "../index.html", "..", "", "sub"])
+def test_other_files_are_not_served_or_cached(static, name):
+    assert static.get(name) is None
+    assert static.get_metrics()["cached"] == 0
+
+def test_missing_allowlisted_file(static):
+    assert static.get("favicon.ico") is None
@@ -0,0 +1,21 @@
+from http_utils import ENCODING_USED, decode_post_xml
+from http_wx_xml import flat_xml, news_reply, text_reply
+
+OG = {"ToUserName": "gh_123456789abc", "FromUserName": "o_user_0001"}
+TRICKY = "a]]>b <c> & ]]]]> d" # Would break the markup if it went in as is
+
+def test_text_reply_round_trips():
+    reply = decode_post_xml(text_reply(OG, TRICKY).decode(ENCODING_USED))
+    assert reply["Content"] == TRICKY
+    assert reply["ToUserName"] == OG["FromUserName"] and reply["FromUserName"] == OG["ToUserName"]
+    assert reply["CreateTime"].isdigit()
+
+def test_news_reply_counts_articles():
+    news = news_reply(OG, [{"Title": TRICKY, "Description": "", "PicUrl": "", "Url": "https://example.com/?a=1&b=2"}])
+    assert b"<ArticleCount>1</ArticleCount>" in news
+    assert decode_post_xml(news.decode(ENCODING_USED))["Title"] == TRICKY
+
+def test_flat_xml_round_trips():
+    payment = {"body": TRICKY, "total_fee": 100, "out_trade_no": "1415659990"}
+    pay = decode_post_xml(flat_xml(payment).decode(ENCODING_USED))
+    assert pay["body"] == TRICKY and pay["total_fee"] == "100"